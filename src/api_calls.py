@@ -3,9 +3,19 @@ Implementing the different API calls for structured outputs
 """
 
 from enum import Enum
-from typing import Type, TypeVar
+from typing import Optional, Type, TypeVar
 from pydantic import BaseModel, ValidationError
+from llm_cache import get_cache, make_key
+from resilience import acall_guarded, call_guarded
+from task_bundle import compile_task, get_prompt_usage
+from telemetry import CACHE_HIT, current_call, get_telemetry
+from token_count import count_tokens
+import fake_provider
+import asyncio
 import json
+import logging
+import threading
+import weakref
 
 T = TypeVar("T", bound=BaseModel)
 
@@ -15,6 +25,7 @@ class Provider(str, Enum):
     GEMINI = "gemini"
     MISTRAL = "mistral"
     GROQ = "groq"
+    FAKE = "fake"  # offline provider for load testing (see fake_provider)
 
 
 MODELS = {
@@ -22,8 +33,203 @@ MODELS = {
     Provider.GEMINI: "gemini-2.5-pro",
     Provider.MISTRAL: "open-mistral-7b",  # free tier
     Provider.GROQ: "moonshotai/kimi-k2-instruct-0905",  # https://console.groq.com/docs/structured-outputs#supported-models
+    Provider.FAKE: "fake",
 }
 
+# maximum number of simultaneous requests per provider in concurrent mode
+CONCURRENCY = {
+    Provider.OPENAI: 16,
+    Provider.GEMINI: 8,
+    Provider.MISTRAL: 1,  # free tier is limited to 1 request per second
+    Provider.GROQ: 4,
+    Provider.FAKE: 64,
+}
+
+API_KEY_ENV = {
+    Provider.OPENAI: "OPENAI_API_KEY",
+    Provider.GEMINI: "GEMINI_API_KEY",
+    Provider.MISTRAL: "MISTRAL_API_KEY",
+    Provider.GROQ: "GROQ_API_KEY",
+}
+
+# HTTP settings of the provider clients, see configure_clients
+POOL_SIZE = 32  # kept-alive connections per client
+TIMEOUT = 120.0  # seconds
+BASE_URLS = {}  # optional endpoint override per provider (e.g. a local stand-in server)
+
+# one sync client per provider for the whole process (httpx clients are thread-safe)
+# and one async client per provider and per event loop, {loop: {provider: (version, client)}}
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+_clients_version = 0  # settings of the async clients, bumped by configure_clients
+_closing = set()  # tasks closing the async clients built with previous settings
+
+
+def configure_clients(
+    pool_size: Optional[int] = None,
+    timeout: Optional[float] = None,
+    base_urls: Optional[dict] = None,
+) -> None:
+    """
+    Change the HTTP settings of the provider clients
+    the sync clients already created are closed, and the async ones are closed in their
+    event loop when it asks for a client again (see get_client), so that the next calls
+    use the new settings without leaking the connection pools
+    """
+    global POOL_SIZE, TIMEOUT, BASE_URLS, _clients_version
+    with _clients_lock:
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        if timeout is not None:
+            TIMEOUT = timeout
+        if base_urls is not None:
+            BASE_URLS = dict(base_urls)
+        for client in _clients.values():
+            close_client(client)
+        _clients.clear()
+        _clients_version += 1
+
+
+def close_client(client) -> None:
+    """
+    Close the connection pool of a sync SDK client (Mistral closes it on exit only)
+    """
+    try:
+        if hasattr(client, "close"):
+            client.close()
+        else:
+            client.__exit__(None, None, None)
+    except Exception as e:
+        logging.warning(f"Client {type(client).__name__} not closed: {e}")
+
+
+async def aclose_client(client) -> None:
+    """
+    Close the connection pool of an async SDK client, in the event loop which owns it
+    """
+    try:
+        if hasattr(client, "aio"):  # Gemini : the async calls go through client.aio
+            await client.aio.aclose()
+        elif hasattr(client, "close"):
+            await client.close()
+        else:
+            await client.__aexit__(None, None, None)
+    except Exception as e:
+        logging.warning(f"Client {type(client).__name__} not closed: {e}")
+
+
+def build_client(provider: Provider, asynchronous: bool = False):
+    """
+    Create a new SDK client for the provider with a pooled HTTP client
+    Prefer get_client, which reuses the clients between calls
+    """
+    import httpx
+    import os
+
+    api_key = os.getenv(API_KEY_ENV[provider])
+    base_url = BASE_URLS.get(provider)
+    limits = httpx.Limits(
+        max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE
+    )
+
+    if provider == Provider.OPENAI:
+        import openai
+
+        if asynchronous:
+            return openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=TIMEOUT,
+                max_retries=0,  # retried by resilience
+                http_client=openai.DefaultAsyncHttpxClient(limits=limits),
+            )
+        return openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=TIMEOUT,
+            max_retries=0,  # retried by resilience
+            http_client=openai.DefaultHttpxClient(limits=limits),
+        )
+
+    elif provider == Provider.GEMINI:
+        from google import genai
+        from google.genai import types
+
+        return genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                base_url=base_url,
+                timeout=int(TIMEOUT * 1000),  # milliseconds
+                client_args={"limits": limits},
+                async_client_args={"limits": limits},
+            ),
+        )
+
+    elif provider == Provider.MISTRAL:
+        from mistralai import Mistral
+
+        if asynchronous:
+            return Mistral(
+                api_key=api_key,
+                server_url=base_url,
+                async_client=httpx.AsyncClient(limits=limits, timeout=TIMEOUT),
+            )
+        return Mistral(
+            api_key=api_key,
+            server_url=base_url,
+            client=httpx.Client(limits=limits, timeout=TIMEOUT),
+        )
+
+    elif provider == Provider.GROQ:
+        import groq
+
+        if asynchronous:
+            return groq.AsyncGroq(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=TIMEOUT,
+                max_retries=0,  # retried by resilience
+                http_client=groq.DefaultAsyncHttpxClient(limits=limits),
+            )
+        return groq.Groq(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=TIMEOUT,
+            max_retries=0,  # retried by resilience
+            http_client=groq.DefaultHttpxClient(limits=limits),
+        )
+
+    else:
+        raise ValueError(f"Unknown provider: {provider}")
+
+
+def get_client(provider: Provider, asynchronous: bool = False):
+    """
+    Return the client of the provider, created on first use and then reused
+    so that the HTTP connections are kept alive between calls
+    async clients are bound to the running event loop, and dropped with it
+    """
+    if not asynchronous:
+        with _clients_lock:
+            if provider not in _clients:
+                _clients[provider] = build_client(provider)
+            return _clients[provider]
+
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        version, client = loop_clients.get(provider, (None, None))
+        if version != _clients_version:
+            if client is not None:
+                # built with the previous settings (see configure_clients)
+                task = loop.create_task(aclose_client(client))
+                _closing.add(task)
+                task.add_done_callback(_closing.discard)
+            client = build_client(provider, asynchronous=True)
+            loop_clients[provider] = (_clients_version, client)
+        return client
+
 
 def wrap_result(result):
     """
@@ -41,61 +247,162 @@ def wrap_result(result):
         raise TypeError(f"Don't know how to handle type {type(result)}")
 
 
+def validate_chat_result(content, schema_model: Type[T]) -> T:
+    """
+    Validate the message content returned by chat-completion style APIs (Mistral, Groq)
+    input : content as the API output, schema_model the expected pydantic model
+    returns : the validated schema_model instance
+    """
+    try:
+        result = wrap_result(content)
+    except Exception as e:
+        raise RuntimeError(f"Could not infer type of the result: {e}")
+    try:
+        return schema_model.model_validate_json(result)
+    except ValidationError:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Unexpected error while validating JSON: {e}")
+
+
+def add_usage(
+    provider: Provider, input_tokens: int, cached_tokens: int, output_tokens: int
+) -> None:
+    """
+    Add the token usage of a response to the prompt usage and to the call in progress
+    """
+    get_prompt_usage().record(provider, input_tokens, cached_tokens)
+    record = current_call()
+    if record is not None:
+        record.input_tokens += input_tokens or 0
+        record.cached_tokens += cached_tokens or 0
+        record.output_tokens += output_tokens or 0
+
+
+def record_usage(provider: Provider, response) -> None:
+    """
+    Add the input, cached input and output tokens reported in the response (see add_usage)
+    """
+    if provider == Provider.OPENAI:
+        usage = response.usage
+        input_tokens = getattr(usage, "input_tokens", 0)
+        details = getattr(usage, "input_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0)
+        output = getattr(usage, "output_tokens", 0)
+    elif provider == Provider.GEMINI:
+        usage = response.usage_metadata
+        input_tokens = getattr(usage, "prompt_token_count", 0)
+        cached = getattr(usage, "cached_content_token_count", 0)
+        # the thinking tokens are billed as output
+        output = (getattr(usage, "candidates_token_count", 0) or 0) + (
+            getattr(usage, "thoughts_token_count", 0) or 0
+        )
+    else:  # chat completions
+        usage = response.usage
+        input_tokens = getattr(usage, "prompt_tokens", 0)
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0)
+        output = getattr(usage, "completion_tokens", 0)
+    add_usage(provider, input_tokens, cached, output)
+
+
 def call_llm_structured(
     provider: Provider,
     model: str,
     instruction: str,
     unstructured_text: str,
     schema_model: Type[T],
+    use_cache: bool = True,
 ) -> T:
-    if provider == Provider.OPENAI:
-        from openai import OpenAI
-        import os
+    """
+    Structured extraction of unstructured_text following instruction and schema_model
+    byte-identical calls are answered from the persistent cache (see llm_cache)
+    unless use_cache is False
+    """
+    with get_telemetry().track(provider, model) as record:
+        cache = get_cache() if use_cache else None
+        if cache is not None:
+            key = make_key(
+                provider, model, instruction, unstructured_text, schema_model
+            )
+            cached = cache.get(key, schema_model)
+            if cached is not None:
+                record.status = CACHE_HIT
+                return cached
+
+        result = call_guarded(
+            provider,
+            request_llm_structured,
+            provider,
+            model,
+            instruction,
+            unstructured_text,
+            schema_model,
+        )
+    if provider != Provider.FAKE:
+        fake_provider.record_response(instruction, unstructured_text, result)
+    if cache is not None:
+        cache.set(key, result, provider, model)
+    return result
+
+
+def request_llm_structured(
+    provider: Provider,
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+) -> T:
+    """
+    Send the request to the provider API, without cache
+    the instruction and schema come first, the patient text last (see task_bundle)
+    """
+    task = compile_task(instruction, schema_model)
+    if provider == Provider.FAKE:
+        result = fake_provider.fake_call(
+            model, instruction, unstructured_text, schema_model
+        )
+        add_usage(
+            provider,
+            *fake_provider.fake_usage(task.system_message, unstructured_text),
+            count_tokens(result.model_dump_json()),
+        )
+        return result
 
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    elif provider == Provider.OPENAI:
+        client = get_client(provider)
         response = client.responses.parse(
             model=model,
             instructions=instruction,
             input=unstructured_text,
             text_format=schema_model,
             temperature=0.0,
+            prompt_cache_key=task.prefix_key,
         )
+        record_usage(provider, response)
         return response.output_parsed
 
     elif provider == Provider.GEMINI:
-        from google import genai
-        import os
-
-        client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+        client = get_client(provider)
         response = client.models.generate_content(
             model=model,
-            contents=("\n").join([instruction, unstructured_text]),
+            contents=("\n").join([task.instruction, unstructured_text]),
             config={
                 "response_mime_type": "application/json",
-                "response_schema": schema_model.model_json_schema(),
+                "response_schema": task.schema,
                 "temperature": 0,
             },
         )
+        record_usage(provider, response)
         return schema_model.model_validate_json(response.text)
 
     elif provider == Provider.MISTRAL:
-        from mistralai import Mistral
-        import os
-
-        client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
-
-        system_msg = ("\n").join(
-            [
-                instruction,
-                "You MUST produce JSON that matches this schema exactly :",
-                json.dumps(schema_model.model_json_schema()),
-            ]
-        )
+        client = get_client(provider)
 
         response = client.chat.complete(
             model=model,
             messages=[
-                {"role": "system", "content": system_msg},
+                {"role": "system", "content": task.system_message},
                 {"role": "user", "content": unstructured_text},
             ],
             response_format={
@@ -103,58 +410,158 @@ def call_llm_structured(
             },
         )
 
-        try:
-            result = wrap_result(response.choices[0].message.content)
-        except Exception as e:
-            raise RuntimeError(f"Could not infer type of the result: {e}")
-        try:
-            return schema_model.model_validate_json(result)
-        except ValidationError:
-            raise
-        except Exception as e:
-            raise RuntimeError(f"Unexpected error while validating JSON: {e}")
+        record_usage(provider, response)
+        return validate_chat_result(response.choices[0].message.content, schema_model)
 
     elif provider == Provider.GROQ:
-        from groq import Groq
-        import os
+        client = get_client(provider)
 
-        client = Groq(
-            api_key=os.environ.get("GROQ_API_KEY"),
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": task.system_message},
+                {"role": "user", "content": unstructured_text},
+            ],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "product_review",
+                    "schema": task.schema,
+                },
+            },
         )
 
-        system_msg = ("\n").join(
-            [
-                instruction,
-                "You MUST produce JSON that matches this schema exactly :",
-                json.dumps(schema_model.model_json_schema()),
-            ]
+        record_usage(provider, response)
+        return validate_chat_result(response.choices[0].message.content, schema_model)
+
+    else:
+        raise ValueError(f"Unknown provider: {provider}")
+
+
+async def acall_llm_structured(
+    provider: Provider,
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+    use_cache: bool = True,
+) -> T:
+    """
+    Same as call_llm_structured, using the async clients shipped by each SDK
+    so that several calls can be awaited concurrently
+    """
+    with get_telemetry().track(provider, model) as record:
+        cache = get_cache() if use_cache else None
+        if cache is not None:
+            key = make_key(
+                provider, model, instruction, unstructured_text, schema_model
+            )
+            cached = cache.get(key, schema_model)
+            if cached is not None:
+                record.status = CACHE_HIT
+                return cached
+
+        result = await acall_guarded(
+            provider,
+            arequest_llm_structured,
+            provider,
+            model,
+            instruction,
+            unstructured_text,
+            schema_model,
         )
+    if provider != Provider.FAKE:
+        fake_provider.record_response(instruction, unstructured_text, result)
+    if cache is not None:
+        cache.set(key, result, provider, model)
+    return result
 
-        response = client.chat.completions.create(
+
+async def arequest_llm_structured(
+    provider: Provider,
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+) -> T:
+    """
+    Send the request to the provider API with the async client, without cache
+    the instruction and schema come first, the patient text last (see task_bundle)
+    """
+    task = compile_task(instruction, schema_model)
+    if provider == Provider.FAKE:
+        result = await fake_provider.afake_call(
+            model, instruction, unstructured_text, schema_model
+        )
+        add_usage(
+            provider,
+            *fake_provider.fake_usage(task.system_message, unstructured_text),
+            count_tokens(result.model_dump_json()),
+        )
+        return result
+
+    elif provider == Provider.OPENAI:
+        client = get_client(provider, asynchronous=True)
+        response = await client.responses.parse(
+            model=model,
+            instructions=instruction,
+            input=unstructured_text,
+            text_format=schema_model,
+            temperature=0.0,
+            prompt_cache_key=task.prefix_key,
+        )
+        record_usage(provider, response)
+        return response.output_parsed
+
+    elif provider == Provider.GEMINI:
+        client = get_client(provider, asynchronous=True)
+        response = await client.aio.models.generate_content(
+            model=model,
+            contents=("\n").join([task.instruction, unstructured_text]),
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": task.schema,
+                "temperature": 0,
+            },
+        )
+        record_usage(provider, response)
+        return schema_model.model_validate_json(response.text)
+
+    elif provider == Provider.MISTRAL:
+        client = get_client(provider, asynchronous=True)
+
+        response = await client.chat.complete_async(
+            model=model,
+            messages=[
+                {"role": "system", "content": task.system_message},
+                {"role": "user", "content": unstructured_text},
+            ],
+            response_format={
+                "type": "json_object",
+            },
+        )
+        record_usage(provider, response)
+        return validate_chat_result(response.choices[0].message.content, schema_model)
+
+    elif provider == Provider.GROQ:
+        client = get_client(provider, asynchronous=True)
+
+        response = await client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "system", "content": system_msg},
+                {"role": "system", "content": task.system_message},
                 {"role": "user", "content": unstructured_text},
             ],
             response_format={
                 "type": "json_schema",
                 "json_schema": {
                     "name": "product_review",
-                    "schema": schema_model.model_json_schema(),
+                    "schema": task.schema,
                 },
             },
         )
-
-        try:
-            result = wrap_result(response.choices[0].message.content)
-        except Exception as e:
-            raise RuntimeError(f"Could not infer type of the result: {e}")
-        try:
-            return schema_model.model_validate_json(result)
-        except ValidationError:
-            raise
-        except Exception as e:
-            raise RuntimeError(f"Unexpected error while validating JSON: {e}")
+        record_usage(provider, response)
+        return validate_chat_result(response.choices[0].message.content, schema_model)
 
     else:
         raise ValueError(f"Unknown provider: {provider}")
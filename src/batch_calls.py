@@ -0,0 +1,383 @@
+"""
+Batch-API submission of the structured extraction for bulk cohorts
+
+Provider batch jobs trade latency (results within 24h) for a lower price and higher rate limits.
+The patients of api_df are written to a batch file (OpenAI Batch JSONL or Gemini batch JSONL),
+submitted, polled, then the results are validated with the same schema models as the interactive calls
+The job submitted is written to a job file in batch_dir, with the rghc and cache key of each
+request : an interrupted run waits for the same job instead of submitting (and paying) again.
+The results are written to the cache of the interactive calls (see llm_cache), and the calls
+already cached are not submitted.
+"""
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Type
+from pydantic import BaseModel
+import json
+import logging
+import time
+
+import pandas as pd
+
+from api_calls import Provider, get_client, validate_chat_result
+from corpus_store import iter_patients, sql_value
+from llm_cache import get_cache, make_key
+from task_bundle import compile_task
+
+BATCH_PROVIDERS = (Provider.OPENAI, Provider.GEMINI)
+POLL_INTERVAL = 60  # seconds
+BATCH_DIR = Path(".") / "src/results/batches/"
+
+OPENAI_DONE = {"completed", "failed", "expired", "cancelled"}
+GEMINI_DONE = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+
+def build_batch_requests(
+    api_df: pd.DataFrame | Iterable[Tuple],
+    provider: Provider,
+    model: str,
+    instruction: str,
+    schema_model: Type[BaseModel],
+) -> Iterator[dict]:
+    """
+    One batch request per patient of api_df ("rghc" and "text" columns, or (rghc, text) pairs),
+    identified by its rghc ; the requests are generated lazily
+    """
+    task = compile_task(instruction, schema_model)
+    for rghc, text in iter_patients(api_df):
+        if provider == Provider.OPENAI:
+            yield (
+                {
+                    "custom_id": str(rghc),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model,
+                        "temperature": 0,
+                        "prompt_cache_key": task.prefix_key,
+                        "messages": [
+                            {"role": "system", "content": instruction},
+                            {"role": "user", "content": text},
+                        ],
+                        "response_format": {
+                            "type": "json_schema",
+                            "json_schema": {
+                                "name": schema_model.__name__,
+                                "schema": task.schema,
+                            },
+                        },
+                    },
+                }
+            )
+        elif provider == Provider.GEMINI:
+            yield (
+                {
+                    "key": str(rghc),
+                    "request": {
+                        "contents": [
+                            {
+                                "role": "user",
+                                "parts": [{"text": ("\n").join([instruction, text])}],
+                            }
+                        ],
+                        "generation_config": {
+                            "response_mime_type": "application/json",
+                            "response_json_schema": task.schema,
+                            "temperature": 0,
+                        },
+                    },
+                }
+            )
+        else:
+            raise ValueError(f"No batch API for provider: {provider}")
+
+
+def write_batch_file(requests: Iterable[dict], path) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    return path
+
+
+def submit_batch(path, provider: Provider, model: str) -> str:
+    """
+    Upload the batch file and create the batch job
+    returns : the job identifier
+    """
+    client = get_client(provider)
+    if provider == Provider.OPENAI:
+        with open(path, "rb") as f:
+            batch_file = client.files.create(file=f, purpose="batch")
+        job = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return job.id
+    elif provider == Provider.GEMINI:
+        batch_file = client.files.upload(
+            file=path,
+            config={"display_name": Path(path).stem, "mime_type": "jsonl"},
+        )
+        job = client.batches.create(
+            model=model, src=batch_file.name, config={"display_name": Path(path).stem}
+        )
+        return job.name
+    else:
+        raise ValueError(f"No batch API for provider: {provider}")
+
+
+def wait_batch(
+    job_id: str, provider: Provider, poll_interval: float = POLL_INTERVAL
+) -> str:
+    """
+    Poll the batch job until it is over
+    returns : the identifier of the results file
+    """
+    client = get_client(provider)
+    while True:
+        if provider == Provider.OPENAI:
+            job = client.batches.retrieve(job_id)
+            state, output = job.status, job.output_file_id
+            done = state in OPENAI_DONE
+        elif provider == Provider.GEMINI:
+            job = client.batches.get(name=job_id)
+            state = job.state.value if job.state else None
+            output = job.dest.file_name if job.dest else None
+            done = state in GEMINI_DONE
+        else:
+            raise ValueError(f"No batch API for provider: {provider}")
+
+        logging.info(f"Batch {job_id} status : {state}")
+        if done:
+            if output is None:
+                raise RuntimeError(f"Batch {job_id} ended without results ({state})")
+            return output
+        time.sleep(poll_interval)
+
+
+def download_batch_results(output_id: str, provider: Provider) -> List[dict]:
+    client = get_client(provider)
+    if provider == Provider.OPENAI:
+        content = client.files.content(output_id).text
+    elif provider == Provider.GEMINI:
+        content = client.files.download(file=output_id).decode("utf-8")
+    else:
+        raise ValueError(f"No batch API for provider: {provider}")
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def parse_batch_results(
+    lines: List[dict], provider: Provider, schema_model: Type[BaseModel]
+) -> Dict[str, BaseModel | Exception]:
+    """
+    Validate every result line with schema_model
+    returns : {rghc: validated result, or the exception raised for this patient}
+    """
+    results = {}
+    for line in lines:
+        try:
+            if provider == Provider.OPENAI:
+                rghc = line["custom_id"]
+                response = line.get("response") or {}
+                if line.get("error") or response.get("status_code") != 200:
+                    raise RuntimeError(
+                        f"Batch request failed: {line.get('error') or response}"
+                    )
+                content = response["body"]["choices"][0]["message"]["content"]
+            elif provider == Provider.GEMINI:
+                rghc = line["key"]
+                if "error" in line:
+                    raise RuntimeError(f"Batch request failed: {line['error']}")
+                parts = line["response"]["candidates"][0]["content"]["parts"]
+                content = "".join(part.get("text", "") for part in parts)
+            else:
+                raise ValueError(f"No batch API for provider: {provider}")
+            results[rghc] = validate_chat_result(content, schema_model)
+        except Exception as e:
+            results[line.get("custom_id", line.get("key"))] = e
+    return results
+
+
+def job_path(batch_dir, provider: Provider) -> Path:
+    """
+    The job file of the batch in progress of the provider
+    """
+    return Path(batch_dir) / f"{provider.value}_job.json"
+
+
+def collect_batch(
+    job: dict,
+    provider: Provider,
+    schema_model: Type[BaseModel],
+    on_result: Callable[[str, BaseModel], None],
+    on_error: Callable[[str, Exception], None],
+    batch_dir=BATCH_DIR,
+    poll_interval: float = POLL_INTERVAL,
+) -> List[str]:
+    """
+    Wait for the job of a job file, then hand its results to on_result (and to the cache)
+    and its failures to on_error ; a job ended without results fails all its patients
+    returns : the list of rghc whose extraction failed
+    """
+    requests = job["requests"]  # {custom_id: [rghc, cache key]}
+    try:
+        output_id = wait_batch(job["job_id"], provider, poll_interval)
+    except RuntimeError as e:
+        logging.error(f"Batch extraction failed for {len(requests)} rghc: {e}")
+        for rghc, _ in requests.values():
+            on_error(rghc, e)
+        return [rghc for rghc, _ in requests.values()]
+    lines = download_batch_results(output_id, provider)
+    write_batch_file(
+        lines, Path(batch_dir) / f"{provider.value}_{job['timestamp']}_output.jsonl"
+    )
+
+    cache = get_cache()
+    failed = []
+    for rghc_id, result in parse_batch_results(lines, provider, schema_model).items():
+        rghc, key = requests.get(rghc_id, (rghc_id, None))
+        if isinstance(result, Exception):
+            logging.error(f"Batch extraction failed for {rghc}: {result}")
+            failed.append(rghc)
+            on_error(rghc, result)
+            continue
+        if cache is not None and key is not None:
+            cache.set(key, result, provider, job["model"])
+        try:
+            on_result(rghc, result)
+        except Exception as e:
+            logging.error(e)
+            failed.append(rghc)
+            on_error(rghc, e)
+
+    missing = set(requests) - {
+        str(line.get("custom_id", line.get("key"))) for line in lines
+    }
+    for rghc_id in missing:
+        rghc = requests[rghc_id][0]
+        failed.append(rghc)
+        on_error(rghc, RuntimeError("Missing from the batch results"))
+    return failed
+
+
+def run_batch(
+    api_df: pd.DataFrame | Iterable[Tuple],
+    provider: Provider,
+    model: str,
+    instruction: str,
+    schema_model: Type[BaseModel],
+    on_result: Callable[[str, BaseModel], None],
+    is_done: Callable[[str], bool] = lambda rghc: False,
+    on_error: Callable[[str, Exception], None] = lambda rghc, e: None,
+    batch_dir=BATCH_DIR,
+    poll_interval: float = POLL_INTERVAL,
+) -> List[str]:
+    """
+    Build, submit and wait for the batch of the patients not processed yet,
+    then hand every validated result to on_result (rghc, result) like the interactive modes,
+    and every failure to on_error (rghc, exception)
+    A job left by an interrupted run is waited for first, its patients are not submitted again
+    returns : the list of rghc whose extraction failed
+    """
+    path = job_path(batch_dir, provider)
+    failed, submitted = [], set()
+    if path.exists():
+        job = json.loads(path.read_text())
+        logging.info(f"Resuming batch {job['job_id']} of {len(job['requests'])} rghc")
+        failed += collect_batch(
+            job, provider, schema_model, on_result, on_error, batch_dir, poll_interval
+        )
+        submitted = {rghc for rghc, _ in job["requests"].values()}
+        path.unlink()
+
+    cache = get_cache()
+    requests = {}  # {custom_id: [rghc, cache key]}
+
+    def todo():
+        # streamed to the batch file, the texts are never all in memory
+        for rghc, text in iter_patients(api_df):
+            rghc = sql_value(rghc)
+            if is_done(rghc) or rghc in submitted:
+                continue
+            key = make_key(provider, model, instruction, text, schema_model)
+            cached = cache.get(key, schema_model) if cache is not None else None
+            if cached is not None:
+                try:
+                    on_result(rghc, cached)
+                except Exception as e:
+                    logging.error(e)
+                    failed.append(rghc)
+                    on_error(rghc, e)
+                continue
+            requests[str(rghc)] = [rghc, key]
+            yield rghc, text
+
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+    input_path = write_batch_file(
+        build_batch_requests(todo(), provider, model, instruction, schema_model),
+        Path(batch_dir) / f"{provider.value}_{timestamp}_input.jsonl",
+    )
+    if not requests:
+        logging.info("No patient left to process")
+        input_path.unlink()
+        return failed
+    job_id = submit_batch(input_path, provider, model)
+    job = {
+        "job_id": job_id,
+        "model": model,
+        "timestamp": timestamp,
+        "requests": requests,
+    }
+    path.write_text(json.dumps(job))
+    logging.info(f"Batch {job_id} submitted for {len(requests)} rghc")
+
+    failed += collect_batch(
+        job, provider, schema_model, on_result, on_error, batch_dir, poll_interval
+    )
+    path.unlink()
+    return failed
+
+
+if __name__ == "__main__":
+    # end to end run against the local stand-in batch server
+    from api_calls import configure_clients
+    from llm_cache import configure_cache
+    from local_server import start_local_server
+    from structured_treatment import TreatmentLines
+    import os
+    import tempfile
+
+    os.environ.setdefault("OPENAI_API_KEY", "standin")
+    server = start_local_server(
+        content=json.dumps({"linhas": [{"line_number": 1, "inducao_start": "03/2020"}]})
+    )
+    configure_clients(
+        base_urls={Provider.OPENAI: f"http://127.0.0.1:{server.server_port}/v1"}
+    )
+    batch_dir = tempfile.mkdtemp()
+    configure_cache(path=Path(batch_dir) / "llm_cache.sqlite")
+
+    api_df = pd.DataFrame({"rghc": [1, 2, 3], "text": ["a", "b", "c"]})
+    saved = {}
+    failed = run_batch(
+        api_df,
+        Provider.OPENAI,
+        "standin",
+        open(Path(".") / "src/txt/mm_instructions.txt").read(),
+        TreatmentLines,
+        on_result=lambda rghc, result: saved.update({rghc: result}),
+        batch_dir=batch_dir,
+        poll_interval=0.1,
+    )
+    print(f"{len(saved)} results saved, failed : {failed}")
+    print(saved)
+    server.shutdown()
@@ -0,0 +1,222 @@
+"""
+End-to-end benchmark of the pipeline stages on synthetic cohorts
+
+For each cohort size, synthetic Tasy and REDCAP exports are generated (see synthetic_data),
+then every stage runs in its own fresh process so that its peak RSS is measured alone.
+Each stage reports its wall time, peak RSS and rows/sec ; the results are appended as
+json lines to src/results/benchmarks/ so that runs can be diffed across commits.
+
+usage : python src/benchmark.py [n_patients ...]  (default 1000 10000 100000)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+BENCHMARK_DIR = Path(".") / "src/results/benchmarks/"
+SIZES = [1_000, 10_000, 100_000]
+LATEST_TASY_CHUNKSIZE = 50_000  # rows per chunk of the streaming latest_tasy stage
+
+
+def input_rows(work_dir: Path, name: str) -> int:
+    return json.loads((work_dir / "meta.json").read_text())[f"{name}_rows"]
+
+
+def stage_latest_tasy(work_dir: Path) -> int:
+    from latest_tasy import latest_tasy
+
+    latest_tasy(work_dir / "tasy.csv", work_dir / "latest_tasy.csv")
+    return input_rows(work_dir, "tasy")
+
+
+def stage_latest_tasy_streaming(work_dir: Path) -> int:
+    from latest_tasy import latest_tasy
+
+    latest_tasy(
+        work_dir / "tasy.csv",
+        work_dir / "latest_tasy_streaming.csv",
+        chunksize=LATEST_TASY_CHUNKSIZE,
+    )
+    return input_rows(work_dir, "tasy")
+
+
+def stage_redcap_labels(work_dir: Path) -> int:
+    from redcap_treatment_labels import redcap_labels
+
+    redcap_labels(work_dir / "redcap.csv", work_dir / "redcap_labels.csv")
+    return input_rows(work_dir, "redcap")
+
+
+def stage_get_max_redcap_date(work_dir: Path) -> int:
+    from get_update_rghc import get_max_redcap_date
+
+    red_df = pd.read_csv(work_dir / "redcap.csv", sep=";", low_memory=False)
+    red_df.rename(columns={"RGHC": "rghc"}, inplace=True)
+    get_max_redcap_date(red_df)
+    return len(red_df)
+
+
+def stage_extraction(work_dir: Path) -> int:
+    from api_calls import MODELS, Provider, acall_llm_structured
+    from concurrent_extraction import extract_concurrently
+    from structured_treatment import TreatmentLines
+    from functools import partial
+    import asyncio
+
+    api_df = pd.read_csv(work_dir / "latest_tasy.csv")[["rghc", "text"]]
+    dfs = []
+
+    def save_result(rghc, result):
+        df1 = pd.DataFrame(result.model_dump()["linhas"])
+        df1["rghc"] = rghc
+        dfs.append(df1)
+
+    asyncio.run(
+        extract_concurrently(
+            api_df,
+            Provider.FAKE,
+            MODELS[Provider.FAKE],
+            "",
+            TreatmentLines,
+            on_result=save_result,
+            call=partial(acall_llm_structured, use_cache=False),
+        )
+    )
+    pd.concat(dfs).to_csv(work_dir / "api_results.csv", index=False)
+    return len(api_df)
+
+
+def stage_normalize_drugs(work_dir: Path) -> int:
+    from config import str_col_list
+    from drug_normalizer import normalize_drug_column
+
+    api_df = pd.read_csv(work_dir / "api_results.csv")
+    cols = [c for c in str_col_list if c.endswith("medicamentos")]
+    api_df[cols] = api_df[cols].apply(normalize_drug_column)
+    api_df.to_csv(work_dir / "api_normalized.csv", index=False)
+    return len(api_df) * len(cols)
+
+
+def stage_compare_results(work_dir: Path) -> int:
+    from compare_results import compare_df, compare_number_lines
+    from config import label_cols, str_col_list
+    from drug_normalizer import normalize_drug_column
+
+    api_df = pd.read_csv(work_dir / "api_normalized.csv")[label_cols]
+    check_df = pd.read_csv(work_dir / "redcap_labels.csv")
+    check_df = check_df[check_df.rghc.isin(api_df.rghc.tolist())][label_cols]
+    cols = [c for c in str_col_list if c.endswith("medicamentos")]
+    check_df[cols] = check_df[cols].apply(normalize_drug_column, keep_unknown=True)
+
+    line_compare = compare_number_lines(api_df, check_df)
+    diff_id = line_compare[line_compare != 0].index.tolist()
+    df1 = (
+        api_df[~api_df.rghc.isin(diff_id)]
+        .sort_values(by=["rghc", "line_number"])
+        .reset_index(drop=True)
+    )
+    df2 = (
+        check_df[~check_df.rghc.isin(diff_id)]
+        .sort_values(by=["rghc", "line_number"])
+        .reset_index(drop=True)
+    )
+    compare_df(df1, df2)
+    return len(df1)
+
+
+# stages run in this order, each one reads the outputs of the previous ones
+STAGES = {
+    "latest_tasy": stage_latest_tasy,
+    "latest_tasy_streaming": stage_latest_tasy_streaming,
+    "redcap_labels": stage_redcap_labels,
+    "get_max_redcap_date": stage_get_max_redcap_date,
+    "extraction_fake_provider": stage_extraction,
+    "normalize_drugs": stage_normalize_drugs,
+    "compare_results": stage_compare_results,
+}
+
+
+def peak_rss_kb() -> int:
+    """
+    Peak RSS of this process in kB
+    VmHWM is reset by exec, whereas ru_maxrss keeps the peak of the parent process
+    (here the generation of the synthetic data), ru_maxrss is only the fallback
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB on Linux
+
+
+def run_stage(name: str, work_dir: Path) -> dict:
+    """
+    Executed in a fresh process : the peak RSS is then the one of this stage only
+    """
+    start = time.perf_counter()
+    rows = STAGES[name](work_dir)
+    wall = time.perf_counter() - start
+    return {
+        "stage": name,
+        "wall_s": round(wall, 4),
+        "peak_rss_mb": round(peak_rss_kb() / 1024, 1),
+        "rows": rows,
+        "rows_per_s": round(rows / wall, 1) if wall > 0 else None,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run_benchmark(sizes=SIZES, output_dir=BENCHMARK_DIR, stages=None) -> Path:
+    from synthetic_data import write_synthetic_data
+
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = output_dir / f"bench_{timestamp}.jsonl"
+    commit = git_commit()
+
+    for n_patients in sizes:
+        work_dir = output_dir / "work" / f"{n_patients}"
+        write_synthetic_data(n_patients, work_dir)
+        for name in stages or STAGES:
+            # spawn : the stage does not inherit the memory of this process
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                result = pool.submit(run_stage, name, work_dir).result()
+            result = {
+                "commit": commit,
+                "timestamp": timestamp,
+                "n_patients": n_patients,
+                **result,
+            }
+            print(json.dumps(result))
+            with open(output_path, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    return output_path
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or SIZES
+    print(f"Results saved to {run_benchmark(sizes)}")
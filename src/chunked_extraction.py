@@ -0,0 +1,335 @@
+"""
+Chunked (map-reduce) extraction for long patient histories
+
+The text of a patient is split into overlapping windows of a bounded number of tokens,
+on line boundaries. The treatment lines of each window are extracted concurrently (within
+the limit of the provider, shared by the windows of all the patients, see window_limiter),
+then the partial results are merged : the lines describing the same treatment
+(same start date within a tolerance, same regimen once normalized, see drug_normalizer)
+are deduplicated and the merged lines are ordered by date and renumbered.
+Short texts, which fit in a single window, are sent whole as before.
+"""
+
+from datetime import datetime
+from typing import Awaitable, Callable, Iterable, List, Optional, Type, TypeVar
+from pydantic import BaseModel
+import asyncio
+import weakref
+
+from api_calls import (
+    CONCURRENCY,
+    MODELS,
+    Provider,
+    acall_llm_structured,
+    call_llm_structured,
+)
+from date_normalizer import parse_date
+from drug_normalizer import normalize_drugs
+from structured_treatment import TreatmentLine, TreatmentLines
+from token_count import count_tokens
+
+T = TypeVar("T", bound=BaseModel)
+
+WINDOW_TOKENS = 2000  # maximum tokens of text per window
+OVERLAP_TOKENS = 200  # tokens repeated at the start of the next window
+MERGE_TOLERANCE_DAYS = 30  # start dates closer than this belong to the same line
+
+# priority order of the date giving the start of a treatment line
+START_FIELDS = [
+    "inducao_start",
+    "transplant_dt",
+    "consolidacao_start",
+    "manutencao_start",
+    "radio_start",
+]
+DRUG_FIELDS = [
+    "inducao_medicamentos",
+    "consolidacao_medicamentos",
+    "manutencao_medicamentos",
+]
+
+
+def split_windows(
+    text: str,
+    window_tokens: int = WINDOW_TOKENS,
+    overlap_tokens: int = OVERLAP_TOKENS,
+) -> List[str]:
+    """
+    Split text into windows of at most window_tokens, cut between lines (between words for
+    a line longer than a window), each window starting with the last overlap_tokens of the
+    previous one so that a treatment described across a cut is seen whole at least once
+    """
+    pieces = []
+    for line in text.split("\n"):
+        n = count_tokens(line)
+        if n <= window_tokens:
+            pieces.append((line, n))
+            continue
+        words, size = [], 0
+        for word in line.split(" "):
+            m = count_tokens(word)
+            if words and size + m > window_tokens:
+                pieces.append((" ".join(words), size))
+                words, size = [], 0
+            words.append(word)
+            size += m
+        pieces.append((" ".join(words), size))
+
+    windows, current, size = [], [], 0
+    for piece, n in pieces:
+        if current and size + n > window_tokens:
+            windows.append(current)
+            kept, kept_size = [], 0
+            for previous, m in reversed(current):
+                if kept_size + m > overlap_tokens:
+                    break
+                kept.insert(0, (previous, m))
+                kept_size += m
+            current, size = kept, kept_size
+            if size + n > window_tokens:
+                current, size = [], 0
+        current.append((piece, n))
+        size += n
+    if current or not windows:
+        windows.append(current)
+    return ["\n".join(piece for piece, _ in window) for window in windows]
+
+
+def line_start(line: dict) -> Optional[datetime]:
+    for field in START_FIELDS:
+        start = parse_date(line.get(field))
+        if start is not None:
+            return start
+    return None
+
+
+def regimen(line: dict) -> frozenset:
+    """
+    canonical drugs of the first phase of the line with drugs (VCd and "Bortezomibe,
+    Ciclofosfamida, Dexametasona" are the same regimen)
+    """
+    for field in DRUG_FIELDS:
+        drugs = normalize_drugs(line.get(field), keep_unknown=True)
+        if drugs:
+            return frozenset(drugs.split(", "))
+    return frozenset()
+
+
+def same_line(a: dict, b: dict, tolerance_days: int = MERGE_TOLERANCE_DAYS) -> bool:
+    start_a, start_b = line_start(a), line_start(b)
+    regimen_a, regimen_b = regimen(a), regimen(b)
+    if start_a is not None and start_b is not None:
+        close = abs((start_a - start_b).days) <= tolerance_days
+        return close and (not regimen_a or not regimen_b or regimen_a == regimen_b)
+    # without both dates, only an identical regimen identifies the line
+    return bool(regimen_a) and regimen_a == regimen_b
+
+
+def merge_treatment_lines(
+    partials: Iterable[TreatmentLines], tolerance_days: int = MERGE_TOLERANCE_DAYS
+) -> TreatmentLines:
+    """
+    Merge the treatment lines extracted from the windows of a patient text
+    duplicates are merged field by field (the first non null value is kept),
+    the lines are ordered by start date (lines without date last) and renumbered
+    """
+    merged = []
+    for partial in partials:
+        for line in partial.linhas:
+            data = line.model_dump()
+            match = next(
+                (m for m in merged if same_line(m, data, tolerance_days)), None
+            )
+            if match is None:
+                merged.append(data)
+                continue
+            for field, value in data.items():
+                if match.get(field) is None:
+                    match[field] = value
+
+    merged.sort(key=lambda line: (line_start(line) is None, line_start(line) or 0))
+    for number, line in enumerate(merged, start=1):
+        line["line_number"] = number
+    return TreatmentLines(linhas=[TreatmentLine.model_validate(m) for m in merged])
+
+
+# schemas whose partial results can be merged, see acall_chunked
+MERGERS = {TreatmentLines: merge_treatment_lines}
+
+# {event loop: {(provider, limit): semaphore}}, see window_limiter
+_limiters = weakref.WeakKeyDictionary()
+
+
+def window_limiter(
+    provider: Provider, concurrency: Optional[int] = None
+) -> asyncio.Semaphore:
+    """
+    Semaphore of the requests of acall_chunked in the running event loop, shared by all the
+    patients : the caller holds one slot per patient (see extract_concurrently) while its
+    windows are sent, so without it the requests in flight would reach
+    concurrency x windows
+    concurrency defaults to the provider limit in CONCURRENCY
+    """
+    limit = concurrency or CONCURRENCY[provider]
+    limiters = _limiters.setdefault(asyncio.get_running_loop(), {})
+    if (provider, limit) not in limiters:
+        limiters[provider, limit] = asyncio.Semaphore(limit)
+    return limiters[provider, limit]
+
+
+async def acall_chunked(
+    provider: Provider,
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+    window_tokens: int = WINDOW_TOKENS,
+    overlap_tokens: int = OVERLAP_TOKENS,
+    call: Callable[..., Awaitable[T]] = acall_llm_structured,
+    concurrency: Optional[int] = None,
+) -> T:
+    """
+    Same as acall_llm_structured, the texts longer than a window being extracted
+    window by window (concurrently) and merged with the merger of schema_model
+    concurrency : requests in flight for all the patients, see window_limiter
+    """
+    limiter = window_limiter(provider, concurrency)
+
+    async def extract(text: str) -> T:
+        async with limiter:
+            return await call(
+                provider=provider,
+                model=model,
+                instruction=instruction,
+                unstructured_text=text,
+                schema_model=schema_model,
+            )
+
+    windows = split_windows(unstructured_text, window_tokens, overlap_tokens)
+    if len(windows) == 1:
+        return await extract(unstructured_text)
+    if schema_model not in MERGERS:
+        raise ValueError(f"No merge of partial results for {schema_model.__name__}")
+    partials = await asyncio.gather(*(extract(window) for window in windows))
+    return MERGERS[schema_model](partials)
+
+
+def call_chunked(
+    provider: Provider,
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+    window_tokens: int = WINDOW_TOKENS,
+    overlap_tokens: int = OVERLAP_TOKENS,
+    call: Callable[..., T] = call_llm_structured,
+) -> T:
+    """
+    Blocking version of acall_chunked, for the serial loops of the pipelines : the windows
+    are extracted one after the other with the pooled sync client (see api_calls.get_client)
+    """
+    windows = split_windows(unstructured_text, window_tokens, overlap_tokens)
+    if len(windows) == 1:
+        windows = [unstructured_text]
+    elif schema_model not in MERGERS:
+        raise ValueError(f"No merge of partial results for {schema_model.__name__}")
+    partials = [
+        call(
+            provider=provider,
+            model=model,
+            instruction=instruction,
+            unstructured_text=window,
+            schema_model=schema_model,
+        )
+        for window in windows
+    ]
+    return partials[0] if len(partials) == 1 else MERGERS[schema_model](partials)
+
+
+if __name__ == "__main__":
+    # latency on long histories and agreement of the chunked extraction with single-shot
+    # python src/chunked_extraction.py [provider] (the fake provider by default : its
+    # latency grows with the input tokens, its answers are synthetic so the agreement is
+    # only meaningful with a real provider or replayed responses)
+    from compare_results import agreement_matrix, compare_number_lines
+    from config import tasy_tratamento_columns
+    from synthetic_data import make_tasy
+    from functools import partial
+    from pathlib import Path
+    import fake_provider
+    import statistics
+    import sys
+    import time
+
+    import pandas as pd
+
+    provider = Provider(sys.argv[1]) if len(sys.argv) > 1 else Provider.FAKE
+    fake_provider.configure_fake(latency=0.2, latency_per_1k_tokens=0.1)
+    instruction = open(Path(".") / "src/txt/mm_instructions.txt").read()
+    call = partial(acall_llm_structured, use_cache=False)
+
+    # long histories : the notes of 30 consultations of each patient
+    visits = make_tasy(10, visits_per_patient=30)
+    notes = visits[tasy_tratamento_columns].astype(str).agg(" ".join, axis=1)
+    texts = notes.groupby(visits.rghc).agg("\n".join)
+    print(
+        f"{len(texts)} patients, {statistics.mean(map(count_tokens, texts)):.0f} tokens on average"
+    )
+
+    async def run(chunked: bool) -> tuple:
+        latencies, results = [], {}
+
+        async def one(rghc, text):
+            start = time.perf_counter()
+            if chunked:
+                result = await acall_chunked(
+                    provider,
+                    MODELS[provider],
+                    instruction,
+                    text,
+                    TreatmentLines,
+                    call=call,
+                )
+            else:
+                result = await call(
+                    provider=provider,
+                    model=MODELS[provider],
+                    instruction=instruction,
+                    unstructured_text=text,
+                    schema_model=TreatmentLines,
+                )
+            latencies.append(time.perf_counter() - start)
+            results[rghc] = result
+
+        await asyncio.gather(*(one(rghc, text) for rghc, text in texts.items()))
+        return latencies, results
+
+    outputs = {}
+    for chunked in (False, True):
+        latencies, results = asyncio.run(run(chunked))
+        outputs[chunked] = pd.DataFrame(
+            [
+                {**line.model_dump(), "rghc": rghc}
+                for rghc, result in results.items()
+                for line in result.linhas
+            ]
+        )
+        print(
+            f"{'chunked' if chunked else 'single-shot'}: p50 "
+            f"{statistics.median(latencies):.2f}s, max {max(latencies):.2f}s per patient"
+        )
+
+    single, chunked = outputs[False], outputs[True]
+    line_compare = compare_number_lines(single, chunked)
+    same = line_compare[line_compare == 0].index
+    df1 = single[single.rghc.isin(same)].sort_values(["rghc", "line_number"])
+    df2 = chunked[chunked.rghc.isin(same)].sort_values(["rghc", "line_number"])
+    matrix = agreement_matrix(
+        df1.reset_index(drop=True).drop(columns=["rghc", "line_number"]),
+        df2.reset_index(drop=True).drop(columns=["rghc", "line_number"]),
+    )
+    agreement = f"{matrix.to_numpy().mean():.2f}" if matrix.size else "n/a"
+    print(
+        f"same number of lines for {len(same)}/{len(line_compare)} patients, "
+        f"cell agreement {agreement}"
+    )
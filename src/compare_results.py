@@ -9,10 +9,15 @@ Drugs match for each care
 Dates match (distance?) for each care
 """
 
+from functools import partial
+import numpy as np
 import pandas as pd
-from typing import List
+from typing import Callable, List
 from config import date_col_list, str_col_list
-from utils import sort_drugs
+from date_normalizer import parse_date_series
+from drug_lexicon import fold
+from drug_normalizer import normalize_drugs
+from table_io import read_table
 
 
 def compare_number_lines(
@@ -26,84 +31,110 @@ def compare_number_lines(
     )
 
 
-def compare_date(d1, d2) -> bool:
-    """
-    return True if the dates differ are within a 30 days interval
-    False if they are different
-    """
-
-    if pd.isna(d1):
-        if pd.isna(d2):
-            return True
-        else:
-            return False
-    else:
-        if pd.isna(d2):
-            return False
-        else:
-            if (
-                abs(
-                    (
-                        pd.to_datetime(d1, format="%d/%m/%Y")
-                        - pd.to_datetime(d2, format="%d/%m/%Y")
-                    ).days
-                )
-                <= 30
-            ):
-                return True
-            else:
-                return False
+def parse_dates(s1: pd.Series, s2: pd.Series) -> tuple:
+    """
+    parse two date columns to datetime64 (NaT when missing or invalid), see date_normalizer
+    columns already read as datetime64 (parquet files) are used as is
+    """
+    return (
+        parse_date_series(s1).to_numpy("datetime64[ns]"),
+        parse_date_series(s2).to_numpy("datetime64[ns]"),
+    )
+
+
+def normalized_codes(
+    s1: pd.Series, s2: pd.Series, normalize: Callable[[str], str]
+) -> tuple:
+    """
+    normalize the distinct values only, then encode both columns on shared categories
+    so that they can be compared as integer arrays (-1 for missing)
+    """
+    codes, uniques = pd.factorize(pd.concat([s1, s2], ignore_index=True))
+    normalized = [normalize(str(v)) for v in uniques]
+    normalized_codes, _ = pd.factorize(pd.Index(normalized, dtype=object))
+    codes = np.where(codes >= 0, normalized_codes[codes], -1)
+    return codes[: len(s1)], codes[len(s1) :]
 
 
-def compare_str(s1, s2):
+def normalize_drug_codes(s1: pd.Series, s2: pd.Series) -> tuple:
     """
-    return True if the lowercased strings are exactly the same
-    False if they are different
+    codes of the canonical sorted drugs, see drug_normalizer
     """
+    return normalized_codes(s1, s2, partial(normalize_drugs, keep_unknown=True))
 
-    if pd.isna(s1):
-        if pd.isna(s2):
-            return True
-        else:
-            return False
-    else:
-        if pd.isna(s2):
-            return False
-        else:
-            if sort_drugs(s1.lower()) == sort_drugs(s2.lower()):
-                return True
+
+def normalize_text_codes(s1: pd.Series, s2: pd.Series) -> tuple:
+    """
+    codes of the lowercased values without accents nor surrounding spaces (transplant_type)
+    """
+    return normalized_codes(s1, s2, lambda value: fold(value).strip())
+
+
+def agreement_matrix(
+    df1: pd.DataFrame, df2: pd.DataFrame, tolerance_days: int = 30
+) -> pd.DataFrame:
+    """
+    column-wise comparison of the cells of df1 and df2 (aligned on the index of df1)
+    dates agree when both are missing or within tolerance_days (a date which cannot be
+    parsed never agrees), drugs and transplant type when both are missing or equal
+    once normalized
+    returns : a boolean dataframe with one column per compared field
+    """
+    df2 = df2.reindex(df1.index)
+    agreements = {}
+    tolerance = np.timedelta64(tolerance_days, "D")
+    for variable in df1.columns:
+        if variable in date_col_list:
+            d1, d2 = parse_dates(df1[variable], df2[variable])
+            # missing from the cells themselves : an unparseable date is NaT once parsed,
+            # and NaT comparisons are False, so it never agrees
+            both_missing = (df1[variable].isna() & df2[variable].isna()).to_numpy()
+            agreements[variable] = both_missing | (np.abs(d1 - d2) <= tolerance)
+        elif variable in str_col_list:
+            if variable.endswith("medicamentos"):
+                c1, c2 = normalize_drug_codes(df1[variable], df2[variable])
             else:
-                return False
+                c1, c2 = normalize_text_codes(df1[variable], df2[variable])
+            agreements[variable] = c1 == c2
+    return pd.DataFrame(agreements, index=df1.index)
 
 
-def compare_df(df1: pd.DataFrame, df2: pd.DataFrame) -> List[int]:
+def agreement_by_field(matrix: pd.DataFrame) -> pd.DataFrame:
     """
-    count the number of agreements and number of comparisons
+    number of agreements, comparisons and agreement ratio for each field
     """
-    agreements = 0
-    comparisons = 0
+    return pd.DataFrame(
+        {
+            "agreements": matrix.sum(),
+            "comparisons": matrix.count(),
+            "agreement_ratio": matrix.mean(),
+        }
+    )
 
-    for index, row in df1.iterrows():
-        for item in row.items():
-            variable = item[0]
-            if variable in date_col_list:
-                if compare_date(item[1], df2.at[index, variable]):
-                    agreements += 1
-                comparisons += 1
 
-            elif variable in str_col_list:
-                if compare_str(item[1], df1.at[index, variable]):
-                    agreements += 1
-                comparisons += 1
-            else:  # rghc or line number
-                pass
-    return (agreements, comparisons)
+def agreement_by_patient(
+    matrix: pd.DataFrame, ids: pd.Series, id_col: str = "rghc"
+) -> pd.DataFrame:
+    """
+    agreement ratio of each field (and over all fields) for each patient
+    """
+    by_patient = matrix.groupby(ids.reindex(matrix.index).rename(id_col)).mean()
+    by_patient["all_fields"] = by_patient.mean(axis=1)
+    return by_patient
+
+
+def compare_df(df1: pd.DataFrame, df2: pd.DataFrame) -> List[int]:
+    """
+    count the number of agreements and number of comparisons
+    """
+    matrix = agreement_matrix(df1, df2)
+    return (int(matrix.to_numpy().sum()), int(matrix.size))
 
 
 if __name__ == "__main__":
-    from utils import post_process_drugs, sort_drugs
-    from config import label_cols, drugs_ref
-    import pickle
+    from drug_normalizer import normalize_drug_column
+    from config import label_cols
+    from get_update_rghc import up_to_date_rghc
 
     api_result_path = (
         "/home/ohassanaly/work/hemapex/src/results/final_result_1411_303_rghc.csv"
@@ -112,13 +143,19 @@ if __name__ == "__main__":
     individual_compare_path = (
         "/home/ohassanaly/work/hemapex/src/results/testing/individual_compare.csv"
     )
+    patient_agreement_path = (
+        "/home/ohassanaly/work/hemapex/src/results/testing/patient_agreement.csv"
+    )
 
-    update_rghc_path = "/home/ohassanaly/work/hemapex/src/data/updated_rghc.pkl"
+    tasy_src_path = "/home/ohassanaly/work/hemapex/src/data/latest_tasy.csv"
+    redcap_input_path = (
+        "/home/ohassanaly/work/hemapex/src/data/mieloma_multiplo_redcap.csv"
+    )
 
-    # data loading
-    api_df = pd.read_csv(api_result_path)[label_cols]
-    check_df = pd.read_csv(check_label_path)
-    check_df = check_df[check_df.rghc.isin(api_df.rghc.tolist())][label_cols]
+    # data loading, only label_cols are read (csv or parquet, see table_io)
+    api_df = read_table(api_result_path, columns=label_cols)
+    check_df = read_table(check_label_path, columns=label_cols)
+    check_df = check_df[check_df.rghc.isin(api_df.rghc.tolist())]
     # end of data loading
 
     ### preprocessing
@@ -128,16 +165,15 @@ if __name__ == "__main__":
         "manutencao_medicamentos",
     ]
 
-    api_df[cols] = api_df[cols].apply(
-        lambda col: col.apply(post_process_drugs, args=(drugs_ref,))
-    )
-
-    api_df[cols] = api_df[cols].apply(lambda col: col.apply(sort_drugs))
-    check_df[cols] = check_df[cols].apply(lambda col: col.apply(sort_drugs))
+    api_df[cols] = api_df[cols].apply(normalize_drug_column)
+    check_df[cols] = check_df[cols].apply(normalize_drug_column, keep_unknown=True)
 
-    # only keep up to date patients
-    with open(update_rghc_path, "rb") as file:
-        update_rghc_list = pickle.load(file)
+    # only keep the patients whose labels are up to date
+    red_df = pd.read_csv(redcap_input_path, sep=";")
+    red_df.rename(columns={"RGHC": "rghc"}, inplace=True)
+    update_rghc_list = up_to_date_rghc(
+        read_table(tasy_src_path, columns=["rghc", "data_dt"]), red_df
+    )
     api_df = api_df[api_df.rghc.isin(update_rghc_list)]
     check_df = check_df[check_df.rghc.isin(update_rghc_list)]
 
@@ -182,7 +218,10 @@ if __name__ == "__main__":
         "number of rghc where the following comparisons are evaluated :",
         df1.rghc.nunique(),
     )
-    agreement, comparison = compare_df(df1, df2)
+    matrix = agreement_matrix(df1, df2)
+    agreement, comparison = int(matrix.to_numpy().sum()), int(matrix.size)
     print("number of cells where the two methods agree :", agreement)
     print("number of comparisons evaluated:", comparison)
     print("agreement ratio: ", round(agreement / comparison, 2) * 100, "%")
+    print(agreement_by_field(matrix))
+    agreement_by_patient(matrix, df1.rghc).to_csv(patient_agreement_path)
@@ -0,0 +1,127 @@
+"""
+Concurrent execution of the structured API calls over the patients of a pipeline
+
+The calls are almost entirely network wait, so they are awaited concurrently
+with a per-provider limit on the number of requests in flight.
+Each result is handed to a callback as soon as it arrives so that the pipelines
+keep saving their outputs rghc by rghc (and the resume check keeps working).
+"""
+
+import asyncio
+import logging
+from functools import partial
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple, Type
+
+import pandas as pd
+from pydantic import BaseModel
+from tqdm import tqdm
+
+from api_calls import CONCURRENCY, Provider, acall_llm_structured
+from corpus_store import iter_patients
+from telemetry import patient
+
+
+async def extract_concurrently(
+    api_df: pd.DataFrame | Iterable[Tuple],
+    provider: Provider,
+    model: str,
+    instruction: str,
+    schema_model: Type[BaseModel],
+    on_result: Callable[[str, BaseModel], None],
+    is_done: Callable[[str], bool] = lambda rghc: False,
+    on_error: Callable[[str, Exception], None] = lambda rghc, e: None,
+    concurrency: Optional[int] = None,
+    call: Callable[..., Awaitable[BaseModel]] = acall_llm_structured,
+) -> List[str]:
+    """
+    input : api_df with "rghc" and "text" columns, or (rghc, text) pairs such as CorpusStore.texts
+    the patients are read lazily : only about twice the concurrency of texts are in memory
+    on_result is called with (rghc, validated result) as soon as each call returns
+    is_done allows to skip the patients already processed
+    on_error is called with (rghc, exception) for each failed patient
+    concurrency defaults to the provider limit in CONCURRENCY
+    returns : the list of rghc whose call failed (they can be retried on a next run)
+    """
+    limit = concurrency or CONCURRENCY[provider]
+    semaphore = asyncio.Semaphore(limit)
+    failed = []
+
+    async def extract_one(rghc, text):
+        async with semaphore:
+            logging.info(f"Processing rghc : {rghc}")
+            try:
+                with patient(rghc):
+                    result = await call(
+                        provider=provider,
+                        model=model,
+                        instruction=instruction,
+                        unstructured_text=text,
+                        schema_model=schema_model,
+                    )
+            except Exception as e:
+                logging.error(f"API call failed for {rghc}: {e}")
+                failed.append(rghc)
+                on_error(rghc, e)
+                return
+        try:
+            on_result(rghc, result)
+        except Exception as e:
+            logging.error(e)
+            failed.append(rghc)
+            on_error(rghc, e)
+
+    progress = tqdm(total=len(api_df) if hasattr(api_df, "__len__") else None)
+    pending = set()
+    for rghc, text in iter_patients(api_df):
+        if is_done(rghc):
+            logging.info(f"Patient {rghc} already processed")
+            progress.update()
+            continue
+        if len(pending) >= 2 * limit:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            progress.update(len(done))
+        pending.add(asyncio.create_task(extract_one(rghc, text)))
+
+    if pending:
+        await asyncio.wait(pending)
+        progress.update(len(pending))
+    progress.close()
+
+    return failed
+
+
+if __name__ == "__main__":
+    # throughput benchmark against the offline fake provider with a fixed latency
+    from fake_provider import configure_fake
+    from structured_treatment import TreatmentLines
+    import time
+
+    n_patients = 200
+    configure_fake(latency=0.05)  # seconds per call
+
+    api_df = pd.DataFrame(
+        {"rghc": [str(i) for i in range(n_patients)], "text": ["texto"] * n_patients}
+    )
+
+    for concurrency in [1, 4, 16, 64]:
+        saved = []
+        start = time.perf_counter()
+        asyncio.run(
+            extract_concurrently(
+                api_df,
+                Provider.FAKE,
+                "fake",
+                "",
+                TreatmentLines,
+                on_result=lambda rghc, result: saved.append(rghc),
+                concurrency=concurrency,
+                call=partial(acall_llm_structured, use_cache=False),
+            )
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"concurrency {concurrency}: {len(saved)} patients in {elapsed:.2f}s "
+            f"({len(saved) / elapsed:.1f} patients/s)"
+        )
@@ -0,0 +1,215 @@
+"""
+Keyed store of the patient texts produced by latest_tasy
+
+The pipelines only need one text per rghc, for the subset of patients to update.
+Instead of loading the whole latest_tasy csv, they select the rghc in the store index
+and read the texts lazily, a few patients at a time, so that their startup and memory
+do not depend on the size of the corpus.
+"""
+
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+import sqlite3
+import threading
+
+import pandas as pd
+
+from task_bundle import sha256
+
+READ_CHUNK = 100  # texts fetched per query by CorpusStore.texts
+
+
+def corpus_path(csv_path) -> Path:
+    """
+    The store is built next to the latest_tasy csv, with the same name
+    """
+    return Path(csv_path).with_suffix(".sqlite")
+
+
+def sql_value(rghc):
+    """
+    numpy scalars (from pandas columns or pickled lists) are not accepted by sqlite3
+    """
+    return rghc.item() if hasattr(rghc, "item") else rghc
+
+
+def iter_patients(api_df) -> Iterable[Tuple]:
+    """
+    (rghc, text) pairs of a DataFrame with "rghc" and "text" columns,
+    any other iterable of pairs (such as CorpusStore.texts) is returned as is
+    """
+    if isinstance(api_df, pd.DataFrame):
+        return zip(api_df["rghc"], api_df["text"])
+    return api_df
+
+
+class CorpusStore:
+    """
+    SQLite store of the latest consultation text of each patient, indexed by rghc
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS patients (
+                rghc PRIMARY KEY,
+                person_id INTEGER,
+                data TEXT,
+                data_dt TEXT,
+                text TEXT,
+                text_hash TEXT
+            )
+            """
+        )
+        # stores built before the text hashes : they are computed on first use
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(patients)")}
+        if "text_hash" not in columns:
+            self._conn.execute("ALTER TABLE patients ADD COLUMN text_hash TEXT")
+        self._conn.commit()
+
+    def write(self, df: pd.DataFrame) -> int:
+        """
+        Replace the content of the store by the rows of df (latest_tasy output columns)
+        the order of df is kept as the order of the store
+        returns : the number of patients stored
+        """
+        columns = ["rghc", "person_id", "data", "data_dt", "text", "text_hash"]
+        texts = df["text"].fillna("").astype(str).tolist()
+        rows = zip(
+            df["rghc"].tolist(),
+            df["person_id"].tolist(),
+            df["data"].astype(str).tolist(),
+            df["data_dt"].astype(str).tolist(),
+            texts,
+            [sha256(text) for text in texts],
+        )
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM patients")
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO patients ({', '.join(columns)}) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+        return len(self)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def __contains__(self, rghc) -> bool:
+        return self.text(rghc) is not None
+
+    def rghcs(
+        self, subset: Optional[Iterable] = None, limit: Optional[int] = None
+    ) -> List:
+        """
+        rghc of the store (restricted to subset if given), in the order of the store
+        """
+        query = "SELECT rghc FROM patients"
+        with self._lock:
+            if subset is not None:
+                self._conn.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS subset (rghc PRIMARY KEY)"
+                )
+                self._conn.execute("DELETE FROM subset")
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO subset VALUES (?)",
+                    ((sql_value(rghc),) for rghc in subset),
+                )
+                query += " WHERE rghc IN (SELECT rghc FROM subset)"
+            query += " ORDER BY rowid"
+            if limit is not None:
+                query += f" LIMIT {int(limit)}"
+            return [row[0] for row in self._conn.execute(query)]
+
+    def text(self, rghc) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text FROM patients WHERE rghc = ?",
+                (sql_value(rghc),),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def texts(self, rghcs: List, chunk: int = READ_CHUNK) -> Iterator[Tuple]:
+        """
+        Lazy (rghc, text) pairs for the given rghc, read chunk by chunk
+        the rghc absent from the store are skipped
+        """
+        for start in range(0, len(rghcs), chunk):
+            ids = [sql_value(rghc) for rghc in rghcs[start : start + chunk]]
+            with self._lock:
+                found = dict(
+                    self._conn.execute(
+                        "SELECT rghc, text FROM patients "
+                        f"WHERE rghc IN ({', '.join('?' * len(ids))})",
+                        ids,
+                    ).fetchall()
+                )
+            for rghc in ids:
+                if rghc in found:
+                    yield rghc, found[rghc]
+
+    def text_hashes(self, rghcs: List, chunk: int = READ_CHUNK) -> Iterator[Tuple]:
+        """
+        Lazy (rghc, sha256 of the text) pairs for the given rghc, without reading the texts
+        (except once for a store built before the hashes), see manifest.fingerprints
+        """
+        for start in range(0, len(rghcs), chunk):
+            ids = [sql_value(rghc) for rghc in rghcs[start : start + chunk]]
+            placeholders = ", ".join("?" * len(ids))
+            with self._lock:
+                found = dict(
+                    self._conn.execute(
+                        "SELECT rghc, text_hash FROM patients "
+                        f"WHERE rghc IN ({placeholders})",
+                        ids,
+                    ).fetchall()
+                )
+                missing = [rghc for rghc, digest in found.items() if digest is None]
+                if missing:
+                    rows = self._conn.execute(
+                        "SELECT rghc, text FROM patients "
+                        f"WHERE rghc IN ({', '.join('?' * len(missing))})",
+                        missing,
+                    ).fetchall()
+                    hashes = [(sha256(text or ""), rghc) for rghc, text in rows]
+                    self._conn.executemany(
+                        "UPDATE patients SET text_hash = ? WHERE rghc = ?", hashes
+                    )
+                    self._conn.commit()
+                    found.update((rghc, digest) for digest, rghc in hashes)
+            for rghc in ids:
+                if rghc in found:
+                    yield rghc, found[rghc]
+
+    def to_frame(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        The patients of the store, restricted to columns if given (such as the dates only)
+        """
+        selected = "*" if columns is None else ", ".join(columns)
+        with self._lock:
+            return pd.read_sql_query(
+                f"SELECT {selected} FROM patients ORDER BY rowid", self._conn
+            )
+
+
+def build_corpus(df: pd.DataFrame, path) -> CorpusStore:
+    store = CorpusStore(path)
+    store.write(df)
+    return store
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python src/corpus_store.py [latest_tasy csv] : (re)build the store of a csv
+    from table_io import read_table
+
+    csv_path = Path(sys.argv[1] if len(sys.argv) > 1 else "src/data/latest_tasy.csv")
+    store = build_corpus(read_table(csv_path), corpus_path(csv_path))
+    print(f"{len(store)} patients stored in {store.path}")
@@ -0,0 +1,147 @@
+"""
+Lexicon of the drugs, shared by the drug normalizer and the pre-filter
+
+The drugs of config.drugs_ref, their other names (SYNONYMS : english names, brands and
+abbreviations) and the regimen acronyms with the drugs they stand for (REGIMENS, VCd ->
+Bortezomibe, Ciclofosfamida, Dexametasona) are kept here once : drug_normalizer maps the
+cells to their canonical drugs with them, and prefilter searches the notes for the same names.
+The names are matched accent-folded and lowercased (fold). configure_drugs extends the tables
+and clears the caches built on them (registered with on_configure).
+"""
+
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import re
+import unicodedata
+
+from config import drugs_ref
+
+# accented letters (Latin-1 and Latin Extended-A) mapped to their base letter
+_FOLD = str.maketrans(
+    {
+        chr(cp): unicodedata.normalize("NFKD", chr(cp))[0]
+        for cp in range(0xC0, 0x180)
+        if unicodedata.normalize("NFKD", chr(cp))[0] != chr(cp)
+    }
+)
+
+# other names of the drugs of drugs_ref
+SYNONYMS = {
+    "Bortezomibe": ["Bortezomib", "Velcade"],
+    "Lenalidomida": ["Lenalidomide", "Revlimid", "Lenalid"],
+    "Talidomida": ["Thalidomide", "Thalomid", "Talid"],
+    "Dexametasona": ["Dexamethasone", "Dexa", "Dex", "Decadron"],
+    "Ciclofosfamida": ["Cyclophosphamide", "Endoxan", "Genuxal", "CFM"],
+    "Carfilzomibe": ["Carfilzomib", "Kyprolis"],
+    "Daratumumabe": ["Daratumumab", "Dara", "Darzalex"],
+    "Melfalano": ["Melphalan", "Melfalan", "Alkeran"],
+    "Doxorrubicina": ["Doxorubicin", "Adriamicina", "Adriamycin", "Doxo"],
+    "Vincristina": ["Vincristine", "Oncovin"],
+    "Prednisona": ["Prednisone", "Meticorten"],
+    "Cisplatina": ["Cisplatin"],
+    "Etoposideo": ["Etoposide", "Etoposido", "Vepesid"],
+    "Panobinostat": ["Farydak"],
+    "Lomustina": ["Lomustine", "CeeNU"],
+    "Venetoclax": ["Venclexta"],
+}
+
+# regimen acronyms and the drugs they stand for
+REGIMENS = {
+    "VCd": ["Bortezomibe", "Ciclofosfamida", "Dexametasona"],
+    "CyBorD": ["Bortezomibe", "Ciclofosfamida", "Dexametasona"],
+    "VRd": ["Bortezomibe", "Lenalidomida", "Dexametasona"],
+    "RVD": ["Bortezomibe", "Lenalidomida", "Dexametasona"],
+    "VTD": ["Bortezomibe", "Talidomida", "Dexametasona"],
+    "Dara-VRd": ["Daratumumabe", "Bortezomibe", "Lenalidomida", "Dexametasona"],
+    "D-VRd": ["Daratumumabe", "Bortezomibe", "Lenalidomida", "Dexametasona"],
+    "Dara-VTD": ["Daratumumabe", "Bortezomibe", "Talidomida", "Dexametasona"],
+    "DRd": ["Daratumumabe", "Lenalidomida", "Dexametasona"],
+    "DVd": ["Daratumumabe", "Bortezomibe", "Dexametasona"],
+    "KRd": ["Carfilzomibe", "Lenalidomida", "Dexametasona"],
+    "Kd": ["Carfilzomibe", "Dexametasona"],
+    "Rd": ["Lenalidomida", "Dexametasona"],
+    "Td": ["Talidomida", "Dexametasona"],
+    "CTD": ["Ciclofosfamida", "Talidomida", "Dexametasona"],
+    "PAD": ["Bortezomibe", "Doxorrubicina", "Dexametasona"],
+    "VAD": ["Vincristina", "Doxorrubicina", "Dexametasona"],
+    "VMP": ["Bortezomibe", "Melfalano", "Prednisona"],
+    "MPT": ["Melfalano", "Prednisona", "Talidomida"],
+    "MP": ["Melfalano", "Prednisona"],
+    "DCEP": ["Dexametasona", "Ciclofosfamida", "Etoposideo", "Cisplatina"],
+    "VD-PACE": [
+        "Bortezomibe",
+        "Dexametasona",
+        "Cisplatina",
+        "Doxorrubicina",
+        "Ciclofosfamida",
+        "Etoposideo",
+    ],
+}
+
+# cache_clear of the caches built on the tables, called by configure_drugs
+_ON_CONFIGURE: List[Callable[[], None]] = []
+
+
+def fold(text: str) -> str:
+    """
+    lowercase text without accents
+    """
+    return text.lower().translate(_FOLD)
+
+
+def on_configure(cache_clear: Callable[[], None]) -> None:
+    """
+    Register the cache_clear of a cache built on the tables, called by configure_drugs
+    """
+    _ON_CONFIGURE.append(cache_clear)
+
+
+def configure_drugs(
+    synonyms: Optional[Dict[str, List[str]]] = None,
+    regimens: Optional[Dict[str, List[str]]] = None,
+) -> None:
+    """
+    Add synonyms {drug of drugs_ref: other names} and regimens {acronym: drugs} to the lexicon
+    """
+    SYNONYMS.update(synonyms or {})
+    REGIMENS.update(regimens or {})
+    terms.cache_clear()
+    for cache_clear in _ON_CONFIGURE:
+        cache_clear()
+
+
+def drug_names() -> List[str]:
+    """
+    The drugs of drugs_ref (but Outros) and their other names
+    """
+    names = [drug for drug in drugs_ref if drug != "Outros"]
+    return names + [name for others in SYNONYMS.values() for name in others]
+
+
+def regimen_names() -> List[str]:
+    return list(REGIMENS)
+
+
+@lru_cache(maxsize=None)
+def terms() -> Dict[str, Tuple[str, ...]]:
+    """
+    returns : {folded name: its canonical drugs} for the drugs of drugs_ref,
+    their other names and the regimens
+    """
+    found = {fold(drug): (drug,) for drug in drugs_ref}
+    for drug, names in SYNONYMS.items():
+        found.update({fold(name): (drug,) for name in names})
+    found.update({fold(name): tuple(drugs) for name, drugs in REGIMENS.items()})
+    return found
+
+
+def alternation(names: Iterable[str]) -> re.Pattern:
+    """
+    Alternation of the folded names, the longest first, matched at the start of a word ;
+    the short ones (acronyms such as VCd, Dex or TMO) must be whole words
+    """
+    folded = sorted({fold(name) for name in names}, key=len, reverse=True)
+    alternatives = [
+        re.escape(name) + (r"\b" if len(name) <= 4 else "") for name in folded
+    ]
+    return re.compile(r"\b(?:" + "|".join(alternatives) + ")")
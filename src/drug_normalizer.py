@@ -0,0 +1,196 @@
+"""
+Normalization of the drug lists written by the models (and found in the labels)
+
+The lexicon of drug_lexicon (drugs_ref, their SYNONYMS and the REGIMENS expanded to their
+drugs, VCd -> Bortezomibe, Ciclofosfamida, Dexametasona) is compiled once. A cell is
+accent-folded and lowercased, its doses are stripped ("Melfalano 14mg",
+"Bortezomibe 1,3 mg/m2"), then it is split on its separators ("," outside of a number, "+"
+"/" ";" parentheses, " e ", " com ") and each part is looked up in the lexicon, or searched
+for a term of the lexicon ("Bortezomibe semanal"). The result is the canonical sorted set
+of the drugs, joined with ", ".
+normalize_drug_column is the vectorized version for the dataframes, each distinct cell
+being normalized once.
+"""
+
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+import re
+
+import numpy as np
+import pandas as pd
+
+from config import drugs_ref
+from drug_lexicon import (
+    REGIMENS,
+    SYNONYMS,
+    alternation,
+    fold,
+    on_configure,
+    terms,
+)
+
+# a comma between digits is the decimal comma of a dose, not a separator
+SEPARATORS = re.compile(r"[()+/;\n]|(?<!\d),|,(?!\d)|\s+(?:e|com)\s+")
+# a dose, with its unit and the optional unit of the dose (14mg, 1,3 mg/m2, 40 mg/dia)
+DOSE = re.compile(
+    r"\b\d+(?:[.,]\d+)?\s*(?:mg|mcg|g|ui|ml)\b(?:\s*/\s*(?:m2|m²|kg|dia|d|sem))?"
+)
+STRIP = " \t.-:*"
+
+
+@lru_cache(maxsize=None)
+def lexicon() -> Tuple[Dict[str, Tuple[str, ...]], re.Pattern]:
+    """
+    returns : ({folded term: its canonical drugs}, alternation of the terms)
+    """
+    return terms(), alternation(terms())
+
+
+def drug_set(cell: str, keep_unknown: bool = False) -> set:
+    """
+    returns : the canonical drugs of cell ; with keep_unknown, the parts without any drug
+    are kept as folded and without their doses
+    """
+    terms, pattern = lexicon()
+    drugs = set()
+    # the doses go before the split, which would cut their decimal comma and unit
+    for part in SEPARATORS.split(DOSE.sub(" ", fold(cell))):
+        part = part.strip(STRIP)
+        if not part:
+            continue
+        if part in terms:
+            drugs.update(terms[part])
+            continue
+        found = [terms[match] for match in pattern.findall(part)]
+        for canonical in found:
+            drugs.update(canonical)
+        if not found and keep_unknown:
+            drugs.add(" ".join(part.split()))
+    return drugs
+
+
+@lru_cache(maxsize=100_000)
+def normalize_drugs(cell, keep_unknown: bool = False) -> Optional[str]:
+    """
+    returns : the sorted drugs of cell joined with ", ", None when missing or without any drug
+    keep_unknown : keep the names outside of the lexicon (the labels), instead of dropping
+    them (the answers of the models)
+    """
+    if not isinstance(cell, str):
+        return None
+    drugs = drug_set(cell, keep_unknown)
+    return ", ".join(sorted(drugs, key=str.lower)) if drugs else None
+
+
+def normalize_drug_column(values: pd.Series, keep_unknown: bool = False) -> pd.Series:
+    """
+    Vectorized normalize_drugs : object series with the index of values,
+    each distinct cell being normalized once
+    """
+    codes, uniques = pd.factorize(values)
+    normalized = [normalize_drugs(cell, keep_unknown) for cell in uniques]
+    # missing values (code -1) take the None appended last
+    drugs = np.array(normalized + [None], dtype=object)[codes]
+    index = values.index if isinstance(values, pd.Series) else None
+    return pd.Series(drugs, index=index, dtype=object)
+
+
+on_configure(lexicon.cache_clear)
+on_configure(normalize_drugs.cache_clear)
+
+
+if __name__ == "__main__":
+    # throughput on millions of cells against the previous post_process_drugs + sort_drugs,
+    # on the cells it already handled and on the variants written by the models
+    # python src/drug_normalizer.py [n_cells]
+    import random
+    import sys
+    import time
+
+    def post_process_drugs(api_text, drug_list=drugs_ref):
+        """
+        previous filter of the answers of the models
+        """
+        if pd.isna(api_text):
+            return None
+        drugs = [d.strip() for d in re.split(r"[(),]", api_text) if d.strip()]
+        filtered = [d for d in drugs if d in drug_list]
+        return ", ".join(filtered) if filtered else None
+
+    def sort_drugs(s):
+        if not isinstance(s, str):
+            return None
+        return ", ".join(sorted((d.strip() for d in s.split(",")), key=str.lower))
+
+    rng = random.Random(0)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    names = [drug for drug in drugs_ref if drug != "Outros"]
+
+    def clean_cell():
+        return ", ".join(rng.sample(names, rng.randint(1, 4)))
+
+    def variant_cell():
+        regimen = rng.choice(list(REGIMENS))
+        drug = rng.choice(names + [n for v in SYNONYMS.values() for n in v])
+        dose = f" {rng.randint(1, 40)}{rng.choice(['mg', ' mg', 'mg/m2', ' mg/dia'])}"
+        dose = rng.choice([dose, " 1,3 mg/m2", " 500 mg/m²", " 25mg/d"])
+        return rng.choice(
+            [
+                f"{regimen} ({' + '.join(REGIMENS[regimen])})",
+                f"{regimen.upper()} + {drug}{dose}",
+                f"{drug.lower()}{dose} e {rng.choice(names)}",
+                f"{fold(drug)}, {rng.choice(names).upper()}",
+            ]
+        )
+
+    # the doses leave no fragment, with keep_unknown as for the labels
+    for cell, expected in {
+        "Bortezomibe 1,3 mg/m2": "Bortezomibe",
+        "Dexametasona 40 mg/dia": "Dexametasona",
+        "Lenalidomida 25mg/d": "Lenalidomida",
+        "Ciclofosfamida 500 mg/m²": "Ciclofosfamida",
+        "Melfalano 0,25 mg/kg e Prednisona 2 mg/kg": "Melfalano, Prednisona",
+        "VCd (Bortezomibe 1,3 mg/m2, Ciclofosfamida 300 mg/m², Dexametasona 40 mg)": (
+            "Bortezomibe, Ciclofosfamida, Dexametasona"
+        ),
+    }.items():
+        assert normalize_drugs(cell, keep_unknown=True) == expected, cell
+
+    pools = {
+        "clean": [clean_cell() for _ in range(20_000)] + [None] * 2_000,
+        "variants": [variant_cell() for _ in range(20_000)] + [None] * 2_000,
+    }
+    for name, pool in pools.items():
+        cells = pd.Series(rng.choices(pool, k=n), dtype=object)
+        n_unique = cells.nunique()
+        normalize_drugs.cache_clear()
+        start = time.perf_counter()
+        new = normalize_drug_column(cells)
+        vectorized = time.perf_counter() - start
+        start = time.perf_counter()
+        old = cells.apply(post_process_drugs).apply(sort_drugs)
+        previous = time.perf_counter() - start
+        if name == "clean":
+            assert new.equals(old), name
+        found = new.notna().sum()
+        print(
+            f"{name:>8}: {n} cells ({n_unique} distinct), previous {previous:.2f}s "
+            f"({n / previous:.0f} cells/s, {old.notna().sum()} with drugs), "
+            f"compiled {vectorized:.2f}s ({n / vectorized:.0f} cells/s, {found} with drugs)"
+        )
+
+    # distinct cells only : the cost of the compiled lexicon itself
+    unique = [variant_cell() + f" {i}" for i in range(200_000)]
+    normalize_drugs.cache_clear()
+    start = time.perf_counter()
+    for cell in unique:
+        normalize_drugs(cell)
+    elapsed = time.perf_counter() - start
+    print(f"distinct: {len(unique)} cells, {len(unique) / elapsed:.0f} cells/s")
+    print(
+        "examples:",
+        {
+            cell: normalize_drugs(cell)
+            for cell in ["VCd", "Melfalano 14mg", "VRD + dara"]
+        },
+    )
@@ -0,0 +1,324 @@
+"""
+Offline fake provider, to exercise the extraction path without network access nor API keys
+
+Provider.FAKE answers every call with a deterministic response built from the schema model
+(the same patient text always gives the same answer), after a synthetic latency,
+and can inject errors and rate limits (429) at a configurable rate.
+Responses recorded from real providers (see RECORD_DIR), or saved by hand such as
+src/txt/response_*.json, can be replayed instead of the synthetic ones.
+"""
+
+from pathlib import Path
+from typing import List, Optional, Type, TypeVar, get_args, get_origin
+from pydantic import BaseModel
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+
+from config import drugs_ref
+from llm_cache import make_key
+from token_count import count_tokens
+
+T = TypeVar("T", bound=BaseModel)
+
+LATENCY = 0.0  # median latency of a call in seconds
+LATENCY_SIGMA = 0.0  # shape of the lognormal latency, > 0 gives a latency tail
+LATENCY_PER_1K_TOKENS = 0.0  # seconds added per 1000 tokens of patient text
+ERROR_RATE = 0.0  # share of calls failing with a 500
+RATE_LIMIT_RATE = 0.0  # share of calls failing with a 429
+RETRY_AFTER = 1.0  # seconds, sent with the 429 errors
+SEED = 0
+REPLAY_PATHS = []  # recorded response files or directories, served instead of synthetic responses
+RECORD_DIR = None  # when set, every real provider response is recorded there
+MIN_CACHED_PREFIX = 1024  # tokens, shorter prompt prefixes are not cached (as OpenAI)
+
+_random = random.Random(SEED)
+_random_lock = threading.Lock()
+_recordings = None
+_prefix_tokens = {}  # token count of the prompt prefixes already sent
+
+
+class FakeAPIError(Exception):
+    """
+    Error injected by the fake provider, with the attributes of the SDK API errors
+    """
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        self.status_code = status_code
+        self.retry_after = retry_after
+        super().__init__(f"Fake provider error {status_code}")
+
+
+def configure_fake(
+    latency: Optional[float] = None,
+    latency_sigma: Optional[float] = None,
+    latency_per_1k_tokens: Optional[float] = None,
+    error_rate: Optional[float] = None,
+    rate_limit_rate: Optional[float] = None,
+    retry_after: Optional[float] = None,
+    seed: Optional[int] = None,
+    replay_paths: Optional[List] = None,
+    record_dir=None,
+    record: Optional[bool] = None,
+) -> None:
+    """
+    Change the behaviour of Provider.FAKE (and the recording of real responses)
+    record_dir records the real responses there, record=False stops the recording
+    """
+    global \
+        LATENCY, \
+        LATENCY_SIGMA, \
+        LATENCY_PER_1K_TOKENS, \
+        ERROR_RATE, \
+        RATE_LIMIT_RATE, \
+        RETRY_AFTER
+    global SEED, REPLAY_PATHS, RECORD_DIR, _random, _recordings
+    with _random_lock:
+        if latency is not None:
+            LATENCY = latency
+        if latency_sigma is not None:
+            LATENCY_SIGMA = latency_sigma
+        if latency_per_1k_tokens is not None:
+            LATENCY_PER_1K_TOKENS = latency_per_1k_tokens
+        if error_rate is not None:
+            ERROR_RATE = error_rate
+        if rate_limit_rate is not None:
+            RATE_LIMIT_RATE = rate_limit_rate
+        if retry_after is not None:
+            RETRY_AFTER = retry_after
+        if seed is not None:
+            SEED = seed
+        if replay_paths is not None:
+            REPLAY_PATHS = list(replay_paths)
+        if record_dir is not None:
+            RECORD_DIR = Path(record_dir)
+        if record is False:
+            RECORD_DIR = None
+        _random = random.Random(SEED)
+        _recordings = None
+        _prefix_tokens.clear()
+
+
+def text_seed(text: str) -> int:
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def fake_value(name: str, annotation, rng: random.Random, index: int = 1):
+    """
+    Plausible value for a field of the clinical schemas, from its name and type
+    """
+    origin = get_origin(annotation)
+    args = [a for a in get_args(annotation) if a is not type(None)]
+    if origin is not None and origin is not list and args:  # Optional[...]
+        if rng.random() < 0.3:
+            return None
+        return fake_value(name, args[0], rng, index)
+    if origin is list:
+        item = args[0]
+        return [fake_value(name, item, rng, i + 1) for i in range(rng.randint(0, 3))]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return fake_payload(annotation, rng, index)
+    if annotation is bool:
+        return rng.random() < 0.5
+    if annotation is int:
+        return index
+    if name.endswith(("_start", "_end", "_dt")):
+        return f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(2005, 2025)}"
+    if name.endswith("medicamentos"):
+        return ", ".join(rng.sample(drugs_ref, rng.randint(1, 3)))
+    if name == "transplant_type":
+        return rng.choice(["autologo", "alogenico"])
+    return "fake"
+
+
+def fake_payload(schema_model: Type[BaseModel], rng: random.Random, index: int = 1):
+    return {
+        name: fake_value(name, field.annotation, rng, index)
+        for name, field in schema_model.model_fields.items()
+    }
+
+
+def load_recordings() -> dict:
+    """
+    returns : {file name: response} for every json file of REPLAY_PATHS
+    """
+    global _recordings
+    if _recordings is None:
+        recordings = {}
+        for path in REPLAY_PATHS:
+            path = Path(path)
+            files = sorted(path.glob("*.json")) if path.is_dir() else [path]
+            for file in files:
+                recordings[file.name] = json.loads(file.read_text())
+        _recordings = recordings
+    return _recordings
+
+
+def recording_key(
+    instruction: str, unstructured_text: str, schema_model: Type[BaseModel]
+) -> str:
+    """
+    Recordings are addressed independently of the provider and model that answered them
+    """
+    return make_key("", "", instruction, unstructured_text, schema_model)
+
+
+def fake_response(instruction: str, unstructured_text: str, schema_model: Type[T]) -> T:
+    """
+    Replayed response when REPLAY_PATHS is set (the recording of this exact call if any,
+    otherwise one picked from the text hash), synthetic response otherwise
+    packed requests (see packed_extraction) get the response of each of their patients
+    """
+    if hasattr(schema_model, "split_text"):
+        return schema_model.model_validate(
+            {
+                "patients": [
+                    {
+                        "rghc": rghc,
+                        "result": fake_response(
+                            instruction, text, schema_model.item_model
+                        ),
+                    }
+                    for rghc, text in schema_model.split_text(unstructured_text)
+                ]
+            }
+        )
+    recordings = load_recordings()
+    if recordings:
+        key = recording_key(instruction, unstructured_text, schema_model)
+        recorded = recordings.get(f"response_{key}.json")
+        if recorded is None:
+            names = sorted(recordings)
+            recorded = recordings[names[text_seed(unstructured_text) % len(names)]]
+        return schema_model.model_validate(recorded)
+    rng = random.Random(text_seed(unstructured_text) ^ SEED)
+    return schema_model.model_validate(fake_payload(schema_model, rng))
+
+
+def draw_call(unstructured_text: str = "") -> tuple:
+    """
+    returns : (latency in seconds, injected error or None) for the next call
+    """
+    latency = LATENCY
+    if LATENCY_PER_1K_TOKENS > 0:
+        latency += LATENCY_PER_1K_TOKENS * count_tokens(unstructured_text) / 1000
+    with _random_lock:
+        if LATENCY_SIGMA > 0:
+            latency *= _random.lognormvariate(0, LATENCY_SIGMA)
+        draw = _random.random()
+    if draw < RATE_LIMIT_RATE:
+        return latency, FakeAPIError(429, retry_after=RETRY_AFTER)
+    if draw < RATE_LIMIT_RATE + ERROR_RATE:
+        return latency, FakeAPIError(500)
+    return latency, None
+
+
+def fake_call(
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+) -> T:
+    latency, error = draw_call(unstructured_text)
+    time.sleep(latency)
+    if error is not None:
+        raise error
+    return fake_response(instruction, unstructured_text, schema_model)
+
+
+async def afake_call(
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+) -> T:
+    latency, error = draw_call(unstructured_text)
+    await asyncio.sleep(latency)
+    if error is not None:
+        raise error
+    return fake_response(instruction, unstructured_text, schema_model)
+
+
+def fake_usage(prefix: str, unstructured_text: str) -> tuple:
+    """
+    Token usage of a call as reported by a provider with prompt-prefix caching :
+    the stable prefix (instruction and schema) is served from the cache after its first call
+    returns : (input tokens, cached input tokens)
+    """
+    with _random_lock:
+        seen = prefix in _prefix_tokens
+        if not seen:
+            _prefix_tokens[prefix] = count_tokens(prefix)
+        prefix_tokens = _prefix_tokens[prefix]
+    cached = prefix_tokens if seen and prefix_tokens >= MIN_CACHED_PREFIX else 0
+    return prefix_tokens + count_tokens(unstructured_text), cached
+
+
+def record_response(
+    instruction: str, unstructured_text: str, result: BaseModel
+) -> None:
+    """
+    Save a real provider response so that it can be replayed (see REPLAY_PATHS)
+    """
+    if RECORD_DIR is None:
+        return
+    key = recording_key(instruction, unstructured_text, type(result))
+    RECORD_DIR.mkdir(parents=True, exist_ok=True)
+    (RECORD_DIR / f"response_{key}.json").write_text(
+        json.dumps(result.model_dump(), indent=2, ensure_ascii=False)
+    )
+
+
+if __name__ == "__main__":
+    # throughput and tail latency of the extraction path against the fake provider
+    from api_calls import Provider, call_llm_structured
+    from structured_treatment import TreatmentLines
+    from resilience import configure_resilience
+    import fake_provider  # the module used by api_calls, not this __main__ copy
+    import statistics
+
+    n_calls = 300
+    configure_resilience(enabled=False)  # raw errors of the provider, not retried
+    fake_provider.configure_fake(
+        latency=0.01, latency_sigma=0.8, error_rate=0.02, rate_limit_rate=0.05
+    )
+
+    latencies, errors = [], {}
+    start = time.perf_counter()
+    for i in range(n_calls):
+        t0 = time.perf_counter()
+        try:
+            call_llm_structured(
+                Provider.FAKE,
+                "fake",
+                "",
+                f"patient {i}",
+                TreatmentLines,
+                use_cache=False,
+            )
+        except fake_provider.FakeAPIError as e:
+            errors[e.status_code] = errors.get(e.status_code, 0) + 1
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{n_calls} calls in {elapsed:.2f}s ({n_calls / elapsed:.1f} calls/s)")
+    print(
+        f"p50 {quantiles[49] * 1000:.1f} ms, p95 {quantiles[94] * 1000:.1f} ms, "
+        f"p99 {quantiles[98] * 1000:.1f} ms, errors {errors}"
+    )
+
+    fake_provider.configure_fake(
+        latency=0,
+        latency_sigma=0,
+        error_rate=0,
+        rate_limit_rate=0,
+        replay_paths=sorted(Path("src/txt").glob("response_*.json")),
+    )
+    replayed = call_llm_structured(
+        Provider.FAKE, "fake", "", "texto", TreatmentLines, use_cache=False
+    )
+    print(f"replayed response with {len(replayed.linhas)} treatment lines")
@@ -1,51 +1,160 @@
+import sys
+
+import numpy as np
 import pandas as pd
 
+from date_normalizer import DATE_FORMAT, parse_date_series
+
+
+SAMPLE_SIZE = 20  # values checked first, to reject the columns which are not dates
+DATE_VALUE = r"(\d{1,2})/(\d{1,2})/(\d{4})"  # DD/MM/YYYY as written by REDCap
+
+# date columns found per export schema (columns and dtypes), see date_columns
+_date_columns = {}
+
+
+def looks_like_dates(col: pd.Series) -> bool:
+    """
+    True when the first values of the column (missing values aside) are written DD/MM/YYYY
+    """
+    if col.dtype != object:
+        return False
+    sample = col.dropna().head(SAMPLE_SIZE)
+    return not sample.empty and bool(sample.astype(str).str.fullmatch(DATE_VALUE).all())
+
+
+def date_columns(df: pd.DataFrame) -> list:
+    """
+    The date columns of a REDCap export : every value (missing values aside) is a valid
+    DD/MM/YYYY date ; the distinct values of the candidate columns are parsed together once,
+    and the columns are found once per schema of export (columns and dtypes)
+    """
+    key = tuple(zip(df.columns, df.dtypes.astype(str)))
+    if key not in _date_columns:
+        candidates = [c for c in df.columns if looks_like_dates(df[c])]
+        values = df[candidates].to_numpy(dtype=object).T
+        codes, uniques = pd.factorize(values.ravel())
+        parsed = pd.to_datetime(
+            pd.Series(uniques, dtype=object).astype(str),
+            format=DATE_FORMAT,
+            errors="coerce",
+        )
+        # missing values (code -1) take the True appended last
+        valid = np.append(parsed.notna().to_numpy(), True)[codes]
+        is_date = valid.reshape(values.shape).all(axis=1)
+        _date_columns[key] = [c for c, date in zip(candidates, is_date) if date]
+    return _date_columns[key]
+
 
 def get_max_redcap_date(df: pd.DataFrame) -> pd.DataFrame:
     """
     Retrieve for each patient (rghc) the latest date in the redcap data
     """
-    ## retreive all the date columns in the redcap df
-    date_columns = []
-    for col in df.columns:
-        try:
-            pd.to_datetime(df[col], format="%d/%m/%Y", errors="raise")
-            date_columns.append(col)
-        except Exception as e:
-            print(e)
-
+    values = df.melt(id_vars="rghc", value_vars=date_columns(df)).dropna()
+    values["date"] = parse_date_series(values["value"])
+    # the patients without any date keep a NaT
+    patients = pd.Index(df["rghc"].dropna().unique(), name="rghc").sort_values()
     result = (
-        df.groupby("rghc")[date_columns]
-        .agg(list)
-        .apply(lambda row: [x for lst in row for x in lst if pd.notna(x)], axis=1)
-        .apply(lambda lst: pd.to_datetime(lst, format="%d/%m/%Y").max())
+        values.groupby("rghc")["date"]
+        .max()
+        .reindex(patients)
         .to_frame(name="max_redcap_date")
     )
 
     return result.reset_index()
 
 
-if __name__ == "__main__":
-    update_rghc_path = "/home/ohassanaly/work/hemapex/src/data/updated_rghc.pkl"
-    tasy_src_path = "/home/ohassanaly/work/hemapex/src/data/latest_tasy.csv"
-    redcap_input_path = (
-        "/home/ohassanaly/work/hemapex/src/data/mieloma_multiplo_redcap.csv"
-    )
-    import pickle
-
-    tasy_df = pd.read_csv(tasy_src_path)  # .drop_duplicates(subset = "rghc")
-    red_df = pd.read_csv(redcap_input_path, sep=";")
-    red_df.rename(columns={"RGHC": "rghc"}, inplace=True)
-
+def up_to_date_rghc(
+    tasy_df: pd.DataFrame, red_df: pd.DataFrame, max_gap_days: int = 30
+) -> list:
+    """
+    rghc whose REDCap record was updated less than max_gap_days before their latest Tasy
+    consultation : their labels are up to date for the evaluation (see compare_results),
+    they are the patients extracted by mm_pipeline, the manifest then leaving out the ones
+    whose inputs did not change (see manifest)
+    """
     date_df = get_max_redcap_date(red_df).merge(tasy_df[["rghc", "data_dt"]], on="rghc")
     date_df["data_dt"] = pd.to_datetime(
         date_df["data_dt"], format="%Y-%m-%d", errors="raise"
     )
     date_df["dt_diff"] = (date_df["data_dt"] - date_df["max_redcap_date"]).dt.days
-
-    update_rghc_list = date_df[date_df["dt_diff"] < 30].rghc.to_list()
     # 6 meses é o periodo do seguimento anterior
     # 1 mes para estar seguro que não vou ter grandes diferencias
+    return date_df[date_df["dt_diff"] < max_gap_days].rghc.to_list()
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["benchmark"]:
+    # python src/get_update_rghc.py benchmark [n_patients [n_columns]] : max date of wide
+    # synthetic REDCap exports against the previous implementation
+    from contextlib import redirect_stdout
+    from synthetic_data import make_redcap
+    import io
+    import time
+
+    def previous(df):
+        """
+        previous implementation : to_datetime on every column, lists per patient
+        """
+        date_columns = []
+        for col in df.columns:
+            try:
+                pd.to_datetime(df[col], format="%d/%m/%Y", errors="raise")
+                date_columns.append(col)
+            except Exception as e:
+                print(e)
+        result = (
+            df.groupby("rghc")[date_columns]
+            .agg(list)
+            .apply(lambda row: [x for lst in row for x in lst if pd.notna(x)], axis=1)
+            .apply(lambda lst: parse_date_series(pd.Series(lst, dtype=object)).max())
+            .to_frame(name="max_redcap_date")
+        )
+        return result.reset_index()
+
+    n_patients = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = np.random.default_rng(0)
+    base = make_redcap(n_patients).rename(columns={"RGHC": "rghc"})
+    days = pd.date_range("2000-01-01", "2025-12-31").strftime("%d/%m/%Y").to_numpy()
+    for n_columns in [int(sys.argv[3])] if len(sys.argv) > 3 else [100, 1000, 4000]:
+        # half dates (with missing values), half checkbox answers
+        extra = {}
+        for i in range(n_columns):
+            if i % 2:
+                values = rng.choice(days, len(base)).astype(object)
+                values[rng.random(len(base)) < 0.5] = None
+            else:
+                values = rng.choice(
+                    np.array(["Checked", "Unchecked"], dtype=object), len(base)
+                )
+            extra[f"extra_{i}"] = values
+        df = pd.concat([base, pd.DataFrame(extra)], axis=1)
+
+        _date_columns.clear()
+        start = time.perf_counter()
+        new = get_max_redcap_date(df)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        get_max_redcap_date(df)
+        cached = time.perf_counter() - start
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            old = previous(df)
+        elapsed = time.perf_counter() - start
+        pd.testing.assert_frame_equal(new, old, check_dtype=False)
+        print(
+            f"{len(df)} rows x {df.shape[1]} columns : previous {elapsed:.2f}s, "
+            f"new {first:.2f}s, with the date columns cached {cached:.2f}s"
+        )
+
+elif __name__ == "__main__":
+    tasy_src_path = "/home/ohassanaly/work/hemapex/src/data/latest_tasy.csv"
+    redcap_input_path = (
+        "/home/ohassanaly/work/hemapex/src/data/mieloma_multiplo_redcap.csv"
+    )
+    from table_io import read_table
+
+    tasy_df = read_table(tasy_src_path, columns=["rghc", "data_dt"])
+    red_df = pd.read_csv(redcap_input_path, sep=";")
+    red_df.rename(columns={"RGHC": "rghc"}, inplace=True)
 
-    with open(update_rghc_path, "wb") as file:
-        pickle.dump(update_rghc_list, file)
+    print(f"{len(up_to_date_rghc(tasy_df, red_df))} rghc with up to date labels")
@@ -0,0 +1,314 @@
+"""
+Hedged requests : duplicate the slow calls to cut the latency tail of a run
+
+A call which has not returned after a deadline, the HEDGE_QUANTILE of the latencies of the
+recent calls to the same provider and model, is duplicated : to the same provider, or to the
+fallback provider and model when one is configured. The first valid result is returned and the
+other call is cancelled. A call failing before the deadline is duplicated at once, so that the
+fallback also covers the errors the resilience layer gave up on.
+The hedges are counted with the provider which won and their extra cost, see get_hedge_stats.
+"""
+
+from collections import deque
+from typing import Awaitable, Callable, Optional, Type, TypeVar
+from pydantic import BaseModel
+import asyncio
+import logging
+import threading
+import time
+
+import numpy as np
+
+from api_calls import MODELS, Provider, acall_llm_structured
+from task_bundle import compile_task
+from telemetry import CANCELLED, OK, call_cost, collect_calls
+from token_count import count_tokens
+
+T = TypeVar("T", bound=BaseModel)
+
+HEDGE_ENABLED = True
+HEDGE_QUANTILE = 0.95  # latency quantile after which a call is duplicated
+MIN_SAMPLES = 20  # calls of a provider and model observed before hedging them
+LATENCY_WINDOW = 500  # recent latencies the deadline is computed on
+MIN_DEADLINE = 1.0  # seconds
+# provider and model of the hedges, None : the same as the hedged call
+FALLBACK_PROVIDER: Optional[Provider] = None
+FALLBACK_MODEL: Optional[str] = None
+
+_settings_lock = threading.Lock()
+
+
+def configure_hedging(
+    enabled: Optional[bool] = None,
+    quantile: Optional[float] = None,
+    min_samples: Optional[int] = None,
+    min_deadline: Optional[float] = None,
+    fallback: Optional[Provider] = None,
+    fallback_model: Optional[str] = None,
+) -> None:
+    """
+    Change the hedging settings, the observed latencies are kept
+    fallback : provider of the hedges, with fallback_model (default MODELS[fallback])
+    """
+    global HEDGE_ENABLED, HEDGE_QUANTILE, MIN_SAMPLES, MIN_DEADLINE
+    global FALLBACK_PROVIDER, FALLBACK_MODEL
+    with _settings_lock:
+        if enabled is not None:
+            HEDGE_ENABLED = enabled
+        if quantile is not None:
+            HEDGE_QUANTILE = quantile
+        if min_samples is not None:
+            MIN_SAMPLES = min_samples
+        if min_deadline is not None:
+            MIN_DEADLINE = min_deadline
+        if fallback is not None:
+            FALLBACK_PROVIDER = fallback
+            FALLBACK_MODEL = fallback_model or MODELS[fallback]
+
+
+class LatencyWindow:
+    """
+    Recent latencies of the answered calls, per provider and model
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}
+
+    def add(self, provider, model: str, latency: float) -> None:
+        with self._lock:
+            key = (str(getattr(provider, "value", provider)), model)
+            if key not in self._latencies:
+                self._latencies[key] = deque(maxlen=LATENCY_WINDOW)
+            self._latencies[key].append(latency)
+
+    def deadline(self, provider, model: str) -> Optional[float]:
+        """
+        returns : the seconds after which a call is hedged, None before MIN_SAMPLES calls
+        """
+        with self._lock:
+            key = (str(getattr(provider, "value", provider)), model)
+            latencies = list(self._latencies.get(key, ()))
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        return max(MIN_DEADLINE, float(np.quantile(latencies, HEDGE_QUANTILE)))
+
+
+class HedgeStats:
+    """
+    Hedged calls, the provider and model which won them and the cost of the extra calls
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._calls = 0
+            self._hedged = 0
+            self._wins = {}
+            self._extra_cost = 0.0
+
+    def record(self, hedged: bool, winner: Optional[str], extra_cost: float) -> None:
+        with self._lock:
+            self._calls += 1
+            if hedged:
+                self._hedged += 1
+                self._extra_cost += extra_cost
+                if winner is not None:
+                    self._wins[winner] = self._wins.get(winner, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self._calls,
+                "hedged": self._hedged,
+                "wins": dict(self._wins),
+                "extra_cost": round(self._extra_cost, 4),
+            }
+
+
+_latencies = LatencyWindow()
+_stats = HedgeStats()
+
+
+def get_hedge_stats() -> HedgeStats:
+    """
+    returns : the process-wide counts of the hedged calls
+    """
+    return _stats
+
+
+def wasted_cost(records, instruction: str, text: str, schema_model) -> float:
+    """
+    returns : the cost of the calls whose answer was not used ; the cancelled calls report
+    no usage, their prompt is counted as billed
+    """
+    cost = 0.0
+    for record in records:
+        if record.status == CANCELLED and record.input_tokens == 0:
+            prompt = compile_task(instruction, schema_model).system_message
+            input_tokens = count_tokens(prompt) + count_tokens(text)
+            cost += call_cost(record.model, input_tokens, 0, 0)
+        else:
+            cost += record.cost
+    return cost
+
+
+async def acall_hedged(
+    provider: Provider,
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[T],
+    call: Callable[..., Awaitable[T]] = acall_llm_structured,
+) -> T:
+    """
+    Same as acall_llm_structured, the call being duplicated after the deadline of its
+    provider and model (see LatencyWindow.deadline) ; the first valid result is returned
+    """
+    if not HEDGE_ENABLED:
+        return await call(
+            provider=provider,
+            model=model,
+            instruction=instruction,
+            unstructured_text=unstructured_text,
+            schema_model=schema_model,
+        )
+
+    attempts = {}  # task : (provider, model, records of its calls)
+
+    async def attempt(target_provider, target_model, records):
+        with collect_calls() as collected:
+            try:
+                return await call(
+                    provider=target_provider,
+                    model=target_model,
+                    instruction=instruction,
+                    unstructured_text=unstructured_text,
+                    schema_model=schema_model,
+                )
+            finally:
+                records.extend(collected)
+
+    def launch(target_provider, target_model):
+        records = []
+        task = asyncio.create_task(attempt(target_provider, target_model, records))
+        attempts[task] = (target_provider, target_model, records)
+        return task
+
+    hedge = (FALLBACK_PROVIDER or provider, FALLBACK_MODEL or model)
+    start = time.perf_counter()
+    deadline = _latencies.deadline(provider, model)
+    pending = {launch(provider, model)}
+    hedged = False
+    winner = None
+    errors = []
+    try:
+        while pending and winner is None:
+            timeout = None
+            if not hedged and deadline is not None:
+                timeout = max(0.0, start + deadline - time.perf_counter())
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task
+            if winner is None and not hedged and (not done or not pending):
+                # past the deadline, or every call in flight failed
+                hedged = True
+                pending.add(launch(*hedge))
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+    for task, (target_provider, target_model, records) in attempts.items():
+        for record in records:
+            if record.status == OK:
+                _latencies.add(target_provider, target_model, record.latency)
+
+    name = None
+    if winner is not None:
+        target_provider, target_model, _ = attempts[winner]
+        name = f"{getattr(target_provider, 'value', target_provider)}/{target_model}"
+    extra_cost = wasted_cost(
+        [r for task, a in attempts.items() if task is not winner for r in a[2]],
+        instruction,
+        unstructured_text,
+        schema_model,
+    )
+    _stats.record(hedged, name, extra_cost)
+    if hedged:
+        logging.info(
+            f"Hedged call won by {name} after {time.perf_counter() - start:.1f}s "
+            f"(deadline {deadline or 0:.1f}s), extra cost {extra_cost:.5f} USD"
+        )
+
+    if winner is None:
+        raise errors[0]
+    return winner.result()
+
+
+if __name__ == "__main__":
+    # wall time and latency tail of an extraction against the fake provider with a heavy
+    # latency tail, without hedging, hedged to the same model, then to a fallback model
+    # python src/hedging.py
+    from concurrent_extraction import extract_concurrently
+    from structured_treatment import TreatmentLines
+    from functools import partial
+    import fake_provider
+    import hedging  # the module used by the runs, not this __main__ copy
+    import telemetry
+
+    logging.basicConfig(level=logging.ERROR)
+    n_patients = 400
+    patients = [(i, f"paciente {i}") for i in range(n_patients)]
+    telemetry.PRICES["fake"] = telemetry.PRICES["gemini-2.5-pro"]
+    telemetry.PRICES["fake-fallback"] = telemetry.PRICES["gpt-4.1"]
+    fake_provider.configure_fake(latency=0.05, latency_sigma=1.0)
+    call = partial(acall_llm_structured, use_cache=False)
+
+    def run(label: str, runner_call) -> None:
+        latencies = []
+
+        async def timed(**kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await runner_call(**kwargs)
+            finally:
+                latencies.append(time.perf_counter() - t0)
+
+        tel = telemetry.configure_telemetry()
+        hedging.get_hedge_stats().clear()
+        start = time.perf_counter()
+        asyncio.run(
+            extract_concurrently(
+                patients,
+                Provider.FAKE,
+                "fake",
+                "",
+                TreatmentLines,
+                on_result=lambda rghc, result: None,
+                concurrency=32,
+                call=timed,
+            )
+        )
+        elapsed = time.perf_counter() - start
+        p50, p99 = np.quantile(latencies, [0.5, 0.99])
+        cost = sum(stats["cost"] for stats in tel.summary().values())
+        print(
+            f"{label}: {elapsed:.2f}s, p50 {p50 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms, "
+            f"cost {cost:.4f} USD, hedges {hedging.get_hedge_stats().stats()}"
+        )
+
+    run("no hedging", call)
+    hedging.configure_hedging(min_deadline=0.0)
+    run("hedged", partial(hedging.acall_hedged, call=call))
+    hedging.configure_hedging(fallback=Provider.FAKE, fallback_model="fake-fallback")
+    run("fallback", partial(hedging.acall_hedged, call=call))
@@ -1,43 +1,93 @@
+import logging
 import pandas as pd
+from pathlib import Path
+from typing import Iterable, Optional
 from config import tasy_tratamento_columns
+from corpus_store import build_corpus, corpus_path
+from table_io import write_table
+from text_dedup import dedup_frame
+
+
+def latest_consultations(chunks: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Running reduction keeping only the latest consultation of each patient (rghc)
+    memory is bounded by the number of patients, not by the number of consultations
+    ties on the date are won by the first consultation in the file
+    """
+    latest = None
+    for chunk in chunks:
+        chunk["data_dt"] = pd.to_datetime(chunk.data, format="%d/%m/%Y")
+        candidates = chunk if latest is None else pd.concat([latest, chunk])
+        latest = candidates.sort_values(
+            by=["data_dt"], ascending=False, kind="stable"
+        ).drop_duplicates(subset=["rghc"])
+    return latest
 
 
 def latest_tasy(
-    input_path: str, output_path: str, text_columns=tasy_tratamento_columns
+    input_path: str,
+    output_path: str,
+    text_columns=tasy_tratamento_columns,
+    chunksize: Optional[int] = None,
+    store: bool = True,
+    dedup: bool = False,
 ) -> None:
     """
     Input : the scrapping result of registro.tasy
     retrieve the latest consultation for each patient, with the "text" column containing the relevant text
-    export the result as a csv
+    export the result as a csv, or as parquet if output_path ends with .parquet (see table_io)
+    chunksize : stream the input by chunks of this number of rows, for scrapes larger than memory
+    store : also build the corpus store read by the pipelines next to the csv (see corpus_store)
+    dedup : remove the duplicate and near-duplicate paragraphs of the text (see text_dedup),
+    the token reduction per patient is written next to the output as <name>_dedup_report.csv
     """
-    source_df = pd.read_csv(input_path, low_memory=False)
-    source_df["data_dt"] = pd.to_datetime(source_df.data, format="%d/%m/%Y")
-    source_df[text_columns] = (
-        source_df[text_columns].astype(str).fillna("").replace("nan", "", regex=False)
-    )
+    read_options = {"dtype": {c: str for c in text_columns}, "low_memory": False}
+    if chunksize is None:
+        chunks = [pd.read_csv(input_path, **read_options)]
+    else:
+        chunks = pd.read_csv(input_path, chunksize=chunksize, **read_options)
+
     # keep the latest consultation for each patient
-    df = source_df.sort_values(by=["data_dt"], ascending=False).drop_duplicates(
-        subset=["rghc"]
+    df = latest_consultations(chunks)
+    df[text_columns] = (
+        df[text_columns].astype(str).fillna("").replace("nan", "", regex=False)
     )
     # concatenate the relevant sections into one single text
-    df["text"] = df[text_columns].apply(lambda row: " ".join(row.values), axis=1)
+    df["text"] = df[text_columns[0]].str.cat(df[text_columns[1:]], sep=" ")
+    if dedup:
+        df, report = dedup_frame(df)
+        output_path = Path(output_path)
+        report.to_csv(
+            output_path.with_name(f"{output_path.stem}_dedup_report.csv"), index=False
+        )
+        before, after = report.tokens_before.sum(), report.tokens_after.sum()
+        logging.info(
+            f"dedup : {before} -> {after} tokens "
+            f"({1 - after / max(before, 1):.1%} less)"
+        )
     # add a person_id for deidentification
     df["person_id"] = df.index
-    df[["rghc", "person_id", "data", "data_dt", "text"] + text_columns].to_csv(
-        output_path, index=False
+    write_table(
+        df[["rghc", "person_id", "data", "data_dt", "text"] + text_columns],
+        output_path,
+        date_cols=["data_dt"],
     )
+    if store:
+        build_corpus(df, corpus_path(output_path))
     return
 
 
 if __name__ == "__main__":
-    from pathlib import Path
-
+    logging.basicConfig(level=logging.INFO)
     latest_tasy(
         Path(".") / "src/data/tmo_tasy.csv",
         Path(".") / "src/data/tasy_api.csv",
         tasy_tratamento_columns,
+        dedup=True,
     )
     tdf = pd.read_csv(Path(".") / "src/data/tasy_api.csv")
     rdf = pd.read_csv(Path(".") / "src/data/tmo_redcap.csv")
     # keep only patients with a single transplant recorded
-    tdf[tdf.rghc.isin(rdf.rghc.tolist())].to_csv(Path(".") / "src/data/tasy_api.csv")
+    tdf = tdf[tdf.rghc.isin(rdf.rghc.tolist())]
+    tdf.to_csv(Path(".") / "src/data/tasy_api.csv")
+    build_corpus(tdf, corpus_path(Path(".") / "src/data/tasy_api.csv"))
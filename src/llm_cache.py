@@ -0,0 +1,259 @@
+"""
+Persistent cache of the structured API responses
+
+Entries are addressed by a hash of everything that determines the answer :
+provider, model, instruction, patient text and output schema.
+Re-running a pipeline on byte-identical inputs then costs no API call.
+"""
+
+from pathlib import Path
+from typing import Optional, Type, TypeVar
+from pydantic import BaseModel
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+from task_bundle import compile_task, sha256
+
+T = TypeVar("T", bound=BaseModel)
+
+CACHE_PATH = Path(".") / "src/cache/llm_cache.sqlite"
+CACHE_ENABLED = True
+MAX_SIZE_MB = 500
+MAX_AGE_DAYS = 180
+
+
+def make_key(
+    provider: str,
+    model: str,
+    instruction: str,
+    unstructured_text: str,
+    schema_model: Type[BaseModel],
+) -> str:
+    """
+    Content address of a call : sha256 over the hashes of each of its inputs
+    (the hashes of the instruction and schema are computed once, see task_bundle)
+    """
+    task = compile_task(instruction, schema_model)
+    digests = [
+        sha256(str(getattr(provider, "value", provider))),
+        sha256(model),
+        task.instruction_digest,
+        sha256(unstructured_text),
+        task.schema_digest,
+    ]
+    return hashlib.sha256("".join(digests).encode()).hexdigest()
+
+
+class LLMCache:
+    """
+    SQLite store of validated responses with size and age based eviction
+    """
+
+    def __init__(
+        self,
+        path=CACHE_PATH,
+        max_size_mb: float = MAX_SIZE_MB,
+        max_age_days: float = MAX_AGE_DAYS,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                provider TEXT,
+                model TEXT,
+                schema_name TEXT,
+                value TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_access REAL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key: str, schema_model: Type[T]) -> Optional[T]:
+        """
+        returns : the cached response validated as schema_model, None if absent or expired
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._conn.commit()
+        try:
+            result = schema_model.model_validate_json(row[0])
+        except Exception as e:
+            # stale entry for a schema that changed meanwhile
+            logging.warning(f"Dropping invalid cache entry {key}: {e}")
+            self.delete(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def set(
+        self, key: str, result: BaseModel, provider: str = "", model: str = ""
+    ) -> None:
+        value = result.model_dump_json()
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    str(getattr(provider, "value", provider)),
+                    model,
+                    type(result).__name__,
+                    value,
+                    len(value),
+                    now,
+                    now,
+                ),
+            )
+            self._conn.commit()
+            self._writes += 1
+            evict = self._writes % 100 == 0
+        if evict:
+            self.evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def invalidate(
+        self, provider: Optional[str] = None, model: Optional[str] = None
+    ) -> int:
+        """
+        Remove the entries of a provider and/or a model (everything if both are None)
+        returns : the number of entries removed
+        """
+        query, params = "DELETE FROM responses WHERE 1 = 1", []
+        if provider is not None:
+            query += " AND provider = ?"
+            params.append(str(getattr(provider, "value", provider)))
+        if model is not None:
+            query += " AND model = ?"
+            params.append(model)
+        with self._lock:
+            n = self._conn.execute(query, params).rowcount
+            self._conn.commit()
+        return n
+
+    def clear(self) -> int:
+        return self.invalidate()
+
+    def evict(self) -> None:
+        """
+        Remove the expired entries, then the least recently used ones until the size limit is met
+        """
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?",
+                (time.time() - self.max_age,),
+            )
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if total > self.max_size:
+                rows = self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access"
+                )
+                to_delete = []
+                for key, size in rows:
+                    if total <= self.max_size:
+                        break
+                    to_delete.append((key,))
+                    total -= size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "size_mb": round(size / 1024 / 1024, 3),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_cache(
+    enabled: Optional[bool] = None,
+    path=None,
+    max_size_mb: Optional[float] = None,
+    max_age_days: Optional[float] = None,
+) -> None:
+    """
+    Change the settings of the cache used by call_llm_structured
+    enabled=False bypasses the cache for every call
+    """
+    global _cache, CACHE_ENABLED, CACHE_PATH, MAX_SIZE_MB, MAX_AGE_DAYS
+    with _cache_lock:
+        if enabled is not None:
+            CACHE_ENABLED = enabled
+        if path is not None:
+            CACHE_PATH = Path(path)
+        if max_size_mb is not None:
+            MAX_SIZE_MB = max_size_mb
+        if max_age_days is not None:
+            MAX_AGE_DAYS = max_age_days
+        _cache = None
+
+
+def get_cache() -> Optional[LLMCache]:
+    """
+    returns : the process-wide cache, opened on first use ; None when the cache is disabled
+    """
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache(CACHE_PATH, MAX_SIZE_MB, MAX_AGE_DAYS)
+        return _cache
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python src/llm_cache.py [clear]
+    cache = LLMCache()
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        print(f"{cache.clear()} entries removed from {cache.path}")
+    print(cache.stats())
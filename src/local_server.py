@@ -0,0 +1,226 @@
+"""
+Local HTTP stand-in for the chat-completion endpoints of the providers (OpenAI compatible)
+and for the OpenAI Files and Batch endpoints
+
+Used to exercise the real SDK clients without network access nor API keys
+"""
+
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.n_connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        with self.server.lock:
+            self.server.n_requests += 1
+
+        if self.path.endswith("/chat/completions"):
+            time.sleep(self.server.latency)
+            body = json.loads(raw or b"{}")
+            self.send_json(200, self.chat_completion(body.get("model", "standin")))
+        elif self.path.endswith("/files"):
+            self.send_json(200, self.create_file(raw))
+        elif self.path.endswith("/batches"):
+            self.send_json(200, self.create_batch(json.loads(raw)))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches":
+            batch = self.server.batches.get(parts[-1])
+            if batch is not None:
+                self.run_batch(batch)
+                self.send_json(200, batch)
+                return
+        elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content":
+            content = self.server.files.get(parts[-2])
+            if content is not None:
+                self.send_bytes(200, content, "application/octet-stream")
+                return
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def chat_completion(self, model: str) -> dict:
+        return {
+            "id": f"standin-{self.server.n_requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": self.server.content,
+                    },
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0,
+            },
+        }
+
+    def create_file(self, raw: bytes) -> dict:
+        message = BytesParser(policy=email_policy).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + raw
+        )
+        content, filename, purpose = b"", "upload", "batch"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                content = part.get_payload(decode=True)
+                filename = part.get_filename() or filename
+            elif name == "purpose":
+                purpose = part.get_payload(decode=True).decode()
+        with self.server.lock:
+            file_id = f"file-{len(self.server.files) + 1}"
+            self.server.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    def create_batch(self, body: dict) -> dict:
+        with self.server.lock:
+            batch_id = f"batch-{len(self.server.batches) + 1}"
+            batch = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "created_at": int(time.time()),
+                "status": "validating",
+                "output_file_id": None,
+            }
+            self.server.batches[batch_id] = batch
+        return batch
+
+    def run_batch(self, batch: dict) -> None:
+        """
+        A batch is answered at its first poll, one chat completion per input line
+        """
+        with self.server.lock:
+            if batch["status"] != "validating":
+                return
+            lines = self.server.files[batch["input_file_id"]].decode().splitlines()
+            output = []
+            for i, line in enumerate(line for line in lines if line.strip()):
+                request = json.loads(line)
+                output.append(
+                    {
+                        "id": f"batch-req-{i}",
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "request_id": f"req-{i}",
+                            "body": self.chat_completion(request["body"]["model"]),
+                        },
+                        "error": None,
+                    }
+                )
+            output_id = f"file-{len(self.server.files) + 1}"
+            self.server.files[output_id] = "\n".join(
+                json.dumps(o) for o in output
+            ).encode()
+            batch["output_file_id"] = output_id
+            batch["status"] = "completed"
+
+    def send_json(self, status: int, payload: dict):
+        self.send_bytes(status, json.dumps(payload).encode(), "application/json")
+
+    def send_bytes(self, status: int, data: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_local_server(
+    content: str = '{"linhas": []}',
+    latency: float = 0.0,
+    handler=StandInHandler,
+    port: int = 0,
+) -> ThreadingHTTPServer:
+    """
+    Start the stand-in server in a background thread
+    content is the message returned by every chat completion, latency in seconds
+    returns : the server, its url is f"http://127.0.0.1:{server.server_port}"
+    (call server.shutdown() to stop it)
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.content = content
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.n_connections = 0
+    server.n_requests = 0
+    server.files = {}
+    server.batches = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    # microbenchmark of the per-call client overhead, fresh client vs pooled client
+    from api_calls import Provider, call_llm_structured, configure_clients
+    from resilience import configure_resilience
+    from structured_treatment import TreatmentLines
+    import os
+
+    n_calls = 200
+    os.environ.setdefault("GROQ_API_KEY", "standin")
+    # the rate limit of groq would be measured instead of the connections
+    configure_resilience(enabled=False)
+    server = start_local_server()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    for mode in ["fresh client per call", "pooled client"]:
+        configure_clients(base_urls={Provider.GROQ: url})
+        server.n_connections = 0
+        start = time.perf_counter()
+        for i in range(n_calls):
+            if mode == "fresh client per call":
+                # previous behaviour: the client is built again for every patient
+                configure_clients()
+            call_llm_structured(
+                provider=Provider.GROQ,
+                model="standin",
+                instruction="",
+                unstructured_text="texto",
+                schema_model=TreatmentLines,
+                use_cache=False,
+            )
+        elapsed = time.perf_counter() - start
+        print(
+            f"{mode}: {elapsed / n_calls * 1000:.2f} ms per call, "
+            f"{server.n_connections} connections opened for {n_calls} calls"
+        )
+
+    server.shutdown()
@@ -0,0 +1,185 @@
+"""
+Manifest of the inputs of the last successful extraction of each patient
+
+For each rghc it keeps the hash of the text sent, the hashes of the instruction and of the
+schema (see task_bundle) and the provider and model. An incremental run only sends the
+patients whose entry differs from the current inputs : new patients, new consultations,
+edited instructions or schemas, or another model ; their previous results are invalidated
+before the run. The patients answered without a call (see prefilter) also keep the digest of
+the terms of the pre-filter : they are sent again when the terms change, or without the
+pre-filter. The results done before the manifest existed (or imported, see
+ResultStore.import_files) are adopted with their current inputs rather than paid again.
+The manifest lives next to the result store, and is sharded and merged with it
+(see sharded_runner).
+"""
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, NamedTuple
+import sqlite3
+import threading
+import time
+
+from corpus_store import READ_CHUNK, sql_value
+from task_bundle import TaskBundle
+
+
+class Inputs(NamedTuple):
+    text_hash: str
+    instruction_hash: str
+    schema_hash: str
+    model: str  # provider/model
+    terms_hash: str = ""  # terms of the pre-filter, for the skipped patients only
+
+
+def manifest_path(results_path) -> Path:
+    """
+    The manifest is kept next to the result store, with the same name
+    """
+    path = Path(results_path)
+    return path.with_name(f"{path.stem}_manifest{path.suffix}")
+
+
+def fingerprints(
+    text_hashes: Iterable, task: TaskBundle, provider, model: str
+) -> Dict[object, Inputs]:
+    """
+    returns : {rghc: inputs of its extraction} for the (rghc, sha256 of the text) pairs,
+    such as CorpusStore.text_hashes (the texts are hashed once, when the corpus is built)
+    """
+    model = f"{getattr(provider, 'value', provider)}/{model}"
+    return {
+        sql_value(rghc): Inputs(
+            text_hash, task.instruction_digest, task.schema_digest, model
+        )
+        for rghc, text_hash in text_hashes
+    }
+
+
+class Manifest:
+    """
+    SQLite store of the inputs of the last successful extraction, per rghc
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS manifest (
+                rghc PRIMARY KEY,
+                text_hash TEXT,
+                instruction_hash TEXT,
+                schema_hash TEXT,
+                model TEXT,
+                updated_at REAL,
+                terms_hash TEXT DEFAULT ''
+            )
+            """
+        )
+        # manifests written before the terms of the pre-filter were kept
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(manifest)")]
+        if "terms_hash" not in columns:
+            self._conn.execute(
+                "ALTER TABLE manifest ADD COLUMN terms_hash TEXT DEFAULT ''"
+            )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM manifest").fetchone()[0]
+
+    def entries(self, rghcs: Iterable) -> Dict[object, Inputs]:
+        """
+        returns : {rghc: inputs of its last extraction} for the rghc in the manifest,
+        read chunk by chunk
+        """
+        ids = [sql_value(rghc) for rghc in rghcs]
+        recorded = {}
+        for start in range(0, len(ids), READ_CHUNK):
+            chunk = ids[start : start + READ_CHUNK]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT rghc, {', '.join(Inputs._fields)} "
+                    f"FROM manifest WHERE rghc IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            recorded.update((row[0], Inputs(*row[1:])) for row in rows)
+        return recorded
+
+    def changed(
+        self,
+        current: Dict[object, Inputs],
+        is_done: Callable[[object], bool],
+        terms_hash: str = "",
+    ) -> list:
+        """
+        Adopt the done rghc of current without entry (results stored before the manifest)
+        with their current inputs
+        terms_hash : digest of the terms of the pre-filter of the run, "" without it
+        returns : the rghc of current whose inputs differ from their last extraction,
+        the skipped ones being compared with terms_hash, in the order of current
+        """
+        recorded = self.entries(current)
+        adopted = {
+            rghc: inputs
+            for rghc, inputs in current.items()
+            if rghc not in recorded and is_done(rghc)
+        }
+        self.record_many(adopted)
+        stale = []
+        for rghc, inputs in current.items():
+            if rghc not in recorded:
+                continue
+            if recorded[rghc].terms_hash:
+                # answered without a call, from the terms of the pre-filter
+                inputs = inputs._replace(terms_hash=terms_hash)
+            if recorded[rghc] != inputs:
+                stale.append(rghc)
+        return stale
+
+    def record(self, rghc, inputs: Inputs) -> None:
+        self.record_many({rghc: inputs})
+
+    def record_many(self, entries: Dict[object, Inputs]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO manifest (rghc, {', '.join(Inputs._fields)}, "
+                "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((sql_value(rghc), *inputs, now) for rghc, inputs in entries.items()),
+            )
+            self._conn.commit()
+
+    def merge(self, path) -> None:
+        """
+        Copy the entries of the manifest at path (such as a shard, see sharded_runner),
+        the most recent entry of a rghc being kept
+        """
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS other", (str(path),))
+            try:
+                # the shard may predate the terms_hash column : columns named
+                columns = ", ".join(
+                    row[1]
+                    for row in self._conn.execute("PRAGMA other.table_info(manifest)")
+                )
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO manifest ({columns}) "
+                    f"SELECT {columns} FROM other.manifest o "
+                    "WHERE o.rghc NOT IN (SELECT rghc FROM manifest m "
+                    "WHERE m.updated_at >= o.updated_at)"
+                )
+                self._conn.commit()
+            finally:
+                self._conn.execute("DETACH DATABASE other")
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python src/manifest.py <results.sqlite> : number of patients in the manifest of a store
+    manifest = Manifest(manifest_path(sys.argv[1]))
+    print(f"{len(manifest)} rghc in {manifest.path}")
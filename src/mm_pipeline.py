@@ -1,19 +1,51 @@
-from api_calls import Provider, MODELS, call_llm_structured
+from api_calls import Provider, MODELS, CONCURRENCY
+from config import date_col_list, str_col_list
+from corpus_store import CorpusStore, corpus_path
+from get_update_rghc import up_to_date_rghc
+from hedging import configure_hedging
+from llm_cache import configure_cache
+from pipeline_runner import run_pipeline
+from result_store import ResultStore
+from task_bundle import load_task
+from sharded_runner import current_shard, select_shard, shard_path
+from telemetry import METRICS_DIR, configure_telemetry
 from pathlib import Path
 
 test_mode = False
 erase_mode = False
+concurrent_mode = False  # run the API calls concurrently (see concurrent_extraction)
+packed_mode = False  # with concurrent_mode, several short texts per request (see packed_extraction)
+hedge_mode = False  # with concurrent_mode, duplicate the slowest calls (see hedging)
+# provider of the duplicates, e.g. Provider.OPENAI (None : same provider)
+hedge_fallback = None
+batch_mode = False  # submit the whole cohort as a provider batch job (see batch_calls)
+use_cache = True  # answer identical calls from the local cache (see llm_cache)
+incremental_mode = True  # only extract the patients whose inputs changed (see manifest)
+# only the patients whose REDCap labels are up to date (see get_update_rghc)
+up_to_date_only = True
+prefilter_mode = False  # answer locally the notes without any task term (see prefilter)
+retry_passes = 1  # passes over the failed patients at the end of a run (see resilience)
+output_format = "csv"  # or "parquet", with typed dates and drugs (see table_io)
+# extract long texts window by window then merge, not with packed_mode (see chunked_extraction)
+chunked_mode = False
 n_test = 2
 tasy_src_path = Path(".") / "src/data/latest_tasy.csv"
 # redcap_src_path = Path(".") / "src/data/redcap_treatment_labels.csv"
-update_rghc_path = Path(".") / "src/data/updated_rghc.pkl"
+redcap_export_path = Path(".") / "src/data/mieloma_multiplo_redcap.csv"
+instruction_path = Path(".") / "src/txt/mm_instructions.txt"
 
 provider = Provider.GEMINI
 model = MODELS[provider]
-single_dir = Path(".") / f"src/results/{provider.value}_rghc/"
+concurrency = CONCURRENCY[provider]
+# shard of this process when run by sharded_runner, each shard owns its outputs
+shard, n_shards = current_shard()
+results_path = shard_path(
+    Path(".") / f"src/results/{provider.value}_results.sqlite", shard, n_shards
+)
+# per-rghc result files of the runs before the result store, imported once
+legacy_dir = Path(".") / f"src/results/{provider.value}_rghc/"
 global_dir = Path(".") / f"src/results/{provider.value}_full_result/"
 
-single_dir.mkdir(parents=True, exist_ok=True)
 global_dir.mkdir(parents=True, exist_ok=True)
 
 
@@ -23,15 +55,15 @@ if __name__ == "__main__":
 
     from dotenv import load_dotenv
     import pandas as pd
-    from tqdm import tqdm
 
     import logging
-    import pickle
 
     load_dotenv()
+    configure_cache(enabled=use_cache)
+    configure_hedging(fallback=hedge_fallback)
 
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    log_path = Path(".") / f"src/logs/log_{timestamp}.log"
+    log_path = shard_path(Path(".") / f"src/logs/log_{timestamp}.log", shard, n_shards)
 
     logging.basicConfig(
         level=logging.INFO,
@@ -40,67 +72,73 @@ if __name__ == "__main__":
         filemode="a",
     )
 
+    # tokens, cost and latency of every call (see telemetry)
+    metrics_path = shard_path(
+        METRICS_DIR / f"{provider.value}_{timestamp}.jsonl", shard, n_shards
+    )
+    telemetry = configure_telemetry(metrics_path)
+
     load_dotenv()
 
-    with open(update_rghc_path, "rb") as file:
-        update_rghc_list = pickle.load(file)
-    text_df = pd.read_csv(tasy_src_path)
+    # texts are read lazily from the corpus store built by latest_tasy
+    corpus = CorpusStore(corpus_path(tasy_src_path))
     # label_df = pd.read_csv(redcap_src_path)
 
-    if test_mode:
-        api_df = text_df[text_df.rghc.isin(update_rghc_list)].iloc[:n_test][
-            ["rghc", "text"]
-        ]
-        # api_df = text_df[text_df.rghc.isin(label_df.rghc.tolist())].iloc[:n_test][
-        #     ["rghc", "text"]
-        # ]
-        logging.info(f"Extracting treatments for {api_df.rghc.nunique()} rghc")
+    update_rghc_list = None
+    if up_to_date_only:
+        red_df = pd.read_csv(redcap_export_path, sep=";", low_memory=False)
+        red_df.rename(columns={"RGHC": "rghc"}, inplace=True)
+        update_rghc_list = up_to_date_rghc(corpus.to_frame(["rghc", "data_dt"]), red_df)
+    rghc_list = corpus.rghcs(update_rghc_list, limit=n_test if test_mode else None)
+    # rghc_list = corpus.rghcs(label_df.rghc.tolist(), limit=n_test if test_mode else None)
+    rghc_list = select_shard(rghc_list, shard, n_shards)
+    logging.info(f"Extracting treatments for {len(rghc_list)} rghc")
+
+    # instruction and schema are compiled once for the whole run (see task_bundle)
+    task = load_task(instruction_path, TreatmentLines)
+
+    # results are committed one by one, a run resumes where the previous one stopped
+    results = ResultStore(results_path)
+    if erase_mode:
+        results.clear()
     else:
-        api_df = text_df[text_df.rghc.isin(update_rghc_list)][["rghc", "text"]]
-        # api_df = text_df[text_df.rghc.isin(label_df.rghc.tolist())][["rghc", "text"]]
-        logging.info(f"Extracting treatments for {api_df.rghc.nunique()} rghc")
-
-    df = pd.DataFrame()
-
-    for index, row in tqdm(api_df.iterrows()):
-        rghc = row["rghc"]
-        logging.info(f"Processing rghc : {rghc}")
-        single_output_path = single_dir / f"{rghc}.csv"
-        # check if the patient was already processed
-        if not erase_mode and single_output_path.exists():
-            logging.info(f"Patient {rghc} already processed")
-            continue
-
-        else:
-            result = call_llm_structured(
-                provider=provider,
-                model=model,
-                instruction=open(Path(".") / "src/txt/instructions.txt").read(),
-                unstructured_text=row["text"],
-                schema_model=TreatmentLines,
-            )
-
-            try:
-                data = result.model_dump()
-            except Exception as e:
-                print(f"Failed to save response for {provider.value}: {e}")
-
-            try:
-                df1 = pd.DataFrame(data["linhas"])
-                df1["rghc"] = rghc
-                # save results one by one for safety
-                df1.to_csv(Path(single_output_path), index=False)
-                logging.info(f"Response for {rghc} saved to {single_output_path}")
-                df = pd.concat([df, df1])
-            except Exception as e:
-                logging.error(e)
+        results.import_files(
+            legacy_dir, TreatmentLines, explode="linhas", rghcs=rghc_list
+        )
+
+    run_pipeline(
+        corpus,
+        rghc_list,
+        task,
+        provider,
+        model,
+        results,
+        concurrent_mode=concurrent_mode,
+        packed_mode=packed_mode,
+        hedge_mode=hedge_mode,
+        batch_mode=batch_mode,
+        chunked_mode=chunked_mode,
+        incremental_mode=incremental_mode,
+        prefilter_mode=prefilter_mode,
+        retry_passes=retry_passes,
+        concurrency=concurrency,
+        telemetry=telemetry,
+    )
 
     # final save
     try:
-        global_output_path = (
-            global_dir / f"{api_df.rghc.nunique()}_rghc_{timestamp}.csv"
+        global_output_path = shard_path(
+            global_dir / f"{len(rghc_list)}_rghc_{timestamp}.{output_format}",
+            shard,
+            n_shards,
+        )
+        results.export_table(
+            global_output_path,
+            explode="linhas",
+            rghcs=rghc_list,
+            date_cols=date_col_list,
+            category_cols=str_col_list,
         )
-        df.to_csv(global_output_path, index=False)
         logging.info(f"Full extraction saved to {global_output_path}")
     except Exception as e:
         logging.error(e)
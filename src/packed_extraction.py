@@ -0,0 +1,315 @@
+"""
+Packed extraction : several short patient texts per request
+
+The instruction and the schema are a fixed overhead of every call, which dominates for short
+notes. The patients are grouped in packs filling a token budget, each pack is sent as one
+request with a wrapper schema holding one result per rghc, and the results are split back
+into per-patient results. A pack whose answer does not validate, or does not hold exactly
+its patients, is extracted again patient by patient.
+Texts longer than the budget are sent alone, as before.
+"""
+
+from functools import lru_cache
+from typing import (
+    Awaitable,
+    Callable,
+    ClassVar,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+from pydantic import BaseModel, Field, create_model
+import asyncio
+import logging
+import re
+
+import pandas as pd
+from tqdm import tqdm
+
+from api_calls import CONCURRENCY, Provider, acall_llm_structured
+from corpus_store import iter_patients
+from telemetry import patient
+from token_count import count_tokens
+
+PACK_TOKENS = 3000  # maximum tokens of patient text per pack
+MAX_PACK_SIZE = 8  # maximum patients per pack, bounds the size of the answer
+
+PACK_HEADER = "### rghc: {rghc}"
+_HEADER = re.compile(r"^### rghc: (.+)$", re.MULTILINE)
+PACK_INSTRUCTION = """
+- O texto contém as consultas de vários pacientes, cada uma precedida por uma linha "### rghc: <rghc>".
+- Extraia as informações de cada paciente separadamente, somente a partir da sua própria consulta, e retorne um item por paciente em "patients", com o seu rghc.
+"""
+
+
+class PackError(ValueError):
+    """
+    The answer to a pack does not hold exactly one result per patient of the pack
+    """
+
+
+class PackedResults(BaseModel):
+    """
+    Base of the wrapper schemas built by pack_schema
+    """
+
+    item_model: ClassVar[Type[BaseModel]]
+
+    @staticmethod
+    def split_text(text: str) -> List[Tuple[str, str]]:
+        """
+        returns : the (rghc, text) pairs of a pack text built by pack_text
+        """
+        parts = _HEADER.split(text)
+        return [
+            (rghc, body.strip("\n")) for rghc, body in zip(parts[1::2], parts[2::2])
+        ]
+
+
+@lru_cache(maxsize=None)
+def pack_schema(schema_model: Type[BaseModel]) -> Type[PackedResults]:
+    """
+    returns : the wrapper schema of a list of (rghc, schema_model result)
+    """
+    item = create_model(
+        f"Patient{schema_model.__name__}",
+        rghc=(str, Field(..., description="rghc do paciente")),
+        result=(schema_model, ...),
+    )
+    packed = create_model(
+        f"Packed{schema_model.__name__}",
+        __base__=PackedResults,
+        patients=(List[item], ...),
+    )
+    packed.item_model = schema_model
+    return packed
+
+
+def pack_text(pack: List[Tuple]) -> str:
+    return "\n\n".join(
+        f"{PACK_HEADER.format(rghc=rghc)}\n{text}" for rghc, text in pack
+    )
+
+
+def make_packs(
+    patients: Iterable[Tuple],
+    budget_tokens: int = PACK_TOKENS,
+    max_patients: int = MAX_PACK_SIZE,
+) -> Iterator[List[Tuple]]:
+    """
+    Group the (rghc, text) pairs, in their order, in packs of at most budget_tokens of text
+    and max_patients ; a text longer than the budget makes a pack of its own
+    """
+    pack, size = [], 0
+    for rghc, text in patients:
+        n = count_tokens(text)
+        if pack and (size + n > budget_tokens or len(pack) >= max_patients):
+            yield pack
+            pack, size = [], 0
+        pack.append((rghc, text))
+        size += n
+    if pack:
+        yield pack
+
+
+def split_results(pack: List[Tuple], packed: PackedResults) -> Dict:
+    """
+    returns : {rghc: result} for the patients of the pack
+    """
+    results = {item.rghc.strip(): item.result for item in packed.patients}
+    expected = {str(rghc): rghc for rghc, _ in pack}
+    if len(packed.patients) != len(pack) or results.keys() != expected.keys():
+        raise PackError(
+            f"Expected results for {sorted(expected)}, received {[i.rghc for i in packed.patients]}"
+        )
+    return {expected[key]: result for key, result in results.items()}
+
+
+async def acall_packed(
+    provider: Provider,
+    model: str,
+    instruction: str,
+    pack: List[Tuple],
+    schema_model: Type[BaseModel],
+    call: Callable[..., Awaitable[BaseModel]] = acall_llm_structured,
+) -> Dict:
+    """
+    Extraction of the (rghc, text) pairs of a pack in one request
+    when the answer does not validate, the patients are extracted one by one
+    returns : {rghc: result, or the exception of its call}
+    """
+    if len(pack) == 1:
+        rghc, text = pack[0]
+        with patient(rghc):
+            return {
+                rghc: await call(
+                    provider=provider,
+                    model=model,
+                    instruction=instruction,
+                    unstructured_text=text,
+                    schema_model=schema_model,
+                )
+            }
+    try:
+        with patient([rghc for rghc, _ in pack]):
+            packed = await call(
+                provider=provider,
+                model=model,
+                instruction=instruction + PACK_INSTRUCTION,
+                unstructured_text=pack_text(pack),
+                schema_model=pack_schema(schema_model),
+            )
+        return split_results(pack, packed)
+    except ValueError as e:
+        # the answer does not validate (ValidationError) or does not hold the pack
+        # (PackError), or the call cannot take a pack (such as acall_chunked, whose
+        # windows of a pack cannot be merged)
+        logging.warning(f"Pack of {len(pack)} patients extracted one by one: {e}")
+
+    results = {}
+    for rghc, text in pack:
+        try:
+            with patient(rghc):
+                results[rghc] = await call(
+                    provider=provider,
+                    model=model,
+                    instruction=instruction,
+                    unstructured_text=text,
+                    schema_model=schema_model,
+                )
+        except Exception as e:
+            results[rghc] = e
+    return results
+
+
+async def extract_packed(
+    api_df: pd.DataFrame | Iterable[Tuple],
+    provider: Provider,
+    model: str,
+    instruction: str,
+    schema_model: Type[BaseModel],
+    on_result: Callable[[str, BaseModel], None],
+    is_done: Callable[[str], bool] = lambda rghc: False,
+    on_error: Callable[[str, Exception], None] = lambda rghc, e: None,
+    concurrency: Optional[int] = None,
+    call: Callable[..., Awaitable[BaseModel]] = acall_llm_structured,
+    budget_tokens: int = PACK_TOKENS,
+    max_patients: int = MAX_PACK_SIZE,
+) -> List[str]:
+    """
+    Same as concurrent_extraction.extract_concurrently, the patients being sent in packs
+    (see make_packs), the packs running concurrently
+    returns : the list of rghc whose call failed (they can be retried on a next run)
+    """
+    limit = concurrency or CONCURRENCY[provider]
+    semaphore = asyncio.Semaphore(limit)
+    failed = []
+    progress = tqdm(total=len(api_df) if hasattr(api_df, "__len__") else None)
+
+    def handle_error(rghc, e):
+        failed.append(rghc)
+        on_error(rghc, e)
+
+    async def extract_pack(pack):
+        async with semaphore:
+            logging.info(f"Processing rghc : {[rghc for rghc, _ in pack]}")
+            try:
+                results = await acall_packed(
+                    provider, model, instruction, pack, schema_model, call=call
+                )
+            except Exception as e:
+                logging.error(f"API call failed for {len(pack)} patients: {e}")
+                results = {rghc: e for rghc, _ in pack}
+        for rghc, _ in pack:
+            result = results[rghc]
+            if isinstance(result, Exception):
+                logging.error(f"API call failed for {rghc}: {result}")
+                handle_error(rghc, result)
+                continue
+            try:
+                on_result(rghc, result)
+            except Exception as e:
+                logging.error(e)
+                handle_error(rghc, e)
+        progress.update(len(pack))
+
+    def todo():
+        for rghc, text in iter_patients(api_df):
+            if is_done(rghc):
+                logging.info(f"Patient {rghc} already processed")
+                progress.update()
+                continue
+            yield rghc, text
+
+    pending = set()
+    for pack in make_packs(todo(), budget_tokens, max_patients):
+        if len(pending) >= 2 * limit:
+            _, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+        pending.add(asyncio.create_task(extract_pack(pack)))
+
+    if pending:
+        await asyncio.wait(pending)
+    progress.close()
+
+    return failed
+
+
+if __name__ == "__main__":
+    # requests, input tokens and wall time of packed vs per-patient extraction of short notes
+    # against the fake provider (fixed latency per call plus latency per input token)
+    from concurrent_extraction import extract_concurrently
+    from config import tasy_tratamento_columns
+    from latest_tasy import latest_consultations
+    from structured_treatment import TreatmentLines
+    from synthetic_data import make_tasy
+    from task_bundle import get_prompt_usage
+    from functools import partial
+    from pathlib import Path
+    import fake_provider
+    import time
+
+    n_patients = 400
+    fake_provider.configure_fake(latency=0.5, latency_per_1k_tokens=0.1)
+    instruction = (Path(".") / "src/txt/mm_instructions.txt").read_text()
+    call = partial(acall_llm_structured, use_cache=False)
+
+    df = latest_consultations([make_tasy(n_patients)])
+    df["text"] = df[tasy_tratamento_columns[0]].str.cat(
+        df[tasy_tratamento_columns[1:]], sep=" "
+    )
+
+    outputs = {}
+    for name, runner in [
+        ("per patient", extract_concurrently),
+        ("packed", extract_packed),
+    ]:
+        get_prompt_usage().clear()
+        results = {}
+        start = time.perf_counter()
+        failed = asyncio.run(
+            runner(
+                df,
+                Provider.FAKE,
+                "fake",
+                instruction,
+                TreatmentLines,
+                on_result=results.__setitem__,
+                concurrency=16,
+                call=call,
+            )
+        )
+        elapsed = time.perf_counter() - start
+        usage = get_prompt_usage().stats()["fake"]
+        outputs[name] = results
+        print(
+            f"{name}: {len(results)} patients in {elapsed:.2f}s, {usage['calls']} requests, "
+            f"{usage['input_tokens']} input tokens, {len(failed)} failed"
+        )
+    same = sum(outputs["packed"][r] == outputs["per patient"][r] for r in df.rghc)
+    print(f"same result for {same}/{len(df)} patients")
@@ -0,0 +1,186 @@
+"""
+Extraction flow shared by the pipelines (mm_pipeline, tmo_pipeline)
+
+A pipeline selects its patients, compiles its task and opens its result store, then
+run_pipeline extracts the patients whose inputs changed (see manifest) with the mode of
+the run (serial, concurrent, packed, hedged, chunked or batch), retries the failed ones
+and reports the cache, hedging and telemetry statistics. The export of the results,
+which differs between the pipelines, is left to them.
+"""
+
+from functools import partial
+from typing import List, Optional
+import logging
+
+from api_calls import Provider, acall_llm_structured, call_llm_structured
+from chunked_extraction import acall_chunked, call_chunked
+from corpus_store import CorpusStore
+from hedging import acall_hedged, get_hedge_stats
+from llm_cache import get_cache
+from manifest import Manifest, fingerprints, manifest_path
+from prefilter import empty_result, prefilter, terms_digest
+from result_store import ResultStore
+from task_bundle import TaskBundle, get_prompt_usage
+from telemetry import Telemetry, patient
+
+
+def run_pipeline(
+    corpus: CorpusStore,
+    rghc_list: List,
+    task: TaskBundle,
+    provider: Provider,
+    model: str,
+    results: ResultStore,
+    concurrent_mode: bool = False,
+    packed_mode: bool = False,
+    hedge_mode: bool = False,
+    batch_mode: bool = False,
+    chunked_mode: bool = False,
+    incremental_mode: bool = True,
+    prefilter_mode: bool = False,
+    retry_passes: int = 1,
+    concurrency: Optional[int] = None,
+    telemetry: Optional[Telemetry] = None,
+) -> None:
+    """
+    Extract the patients of rghc_list not done yet (or whose inputs changed) into results,
+    then retry the failed ones retry_passes times ; the modes are the flags of the pipelines
+    """
+    from tqdm import tqdm
+
+    if packed_mode and chunked_mode:
+        # a pack fills more tokens than a window : it would be split and never merged
+        raise ValueError("packed_mode and chunked_mode cannot be combined")
+    schema_model = task.schema_model
+    terms_hash = terms_digest(schema_model) if prefilter_mode else ""
+
+    # inputs of the extraction of each patient : text, instruction, schema and model
+    inputs = fingerprints(corpus.text_hashes(rghc_list), task, provider, model)
+    manifest = Manifest(manifest_path(results.path))
+    todo = rghc_list
+    if incremental_mode:
+        # the results of the patients whose inputs changed are stale, they are extracted
+        # again along with the patients never extracted ; the results stored before the
+        # manifest are adopted as they are ; the skipped patients are sent again when the
+        # terms of the pre-filter changed, or without the pre-filter
+        results.invalidate(manifest.changed(inputs, results.is_done, terms_hash))
+        todo = [rghc for rghc in rghc_list if not results.is_done(rghc)]
+        logging.info(f"Incremental run : {len(todo)} rghc to extract")
+
+    def save_result(rghc, result):
+        results.record(rghc, result)
+        manifest.record(rghc, inputs[rghc])
+        logging.info(f"Response for {rghc} saved to {results.path}")
+
+    def extract(rghcs):
+        if concurrent_mode:
+            from concurrent_extraction import extract_concurrently
+            from packed_extraction import extract_packed
+            import asyncio
+
+            runner = extract_packed if packed_mode else extract_concurrently
+            call = acall_hedged if hedge_mode else acall_llm_structured
+            failed = asyncio.run(
+                runner(
+                    corpus.texts(rghcs),
+                    provider=provider,
+                    model=model,
+                    instruction=task.instruction,
+                    schema_model=schema_model,
+                    on_result=save_result,
+                    is_done=results.is_done,
+                    on_error=results.record_error,
+                    concurrency=concurrency,
+                    call=(
+                        # the windows share the limit of the run, see window_limiter
+                        partial(acall_chunked, call=call, concurrency=concurrency)
+                        if chunked_mode
+                        else call
+                    ),
+                )
+            )
+            if failed:
+                logging.warning(
+                    f"{len(failed)} rghc failed and can be retried: {failed}"
+                )
+
+        elif batch_mode:
+            from batch_calls import run_batch
+
+            failed = run_batch(
+                corpus.texts(rghcs),
+                provider=provider,
+                model=model,
+                instruction=task.instruction,
+                schema_model=schema_model,
+                on_result=save_result,
+                is_done=results.is_done,
+                on_error=results.record_error,
+                # the job in progress is kept next to the store, to resume it
+                batch_dir=results.path.with_name(f"{results.path.stem}_batches"),
+            )
+            if failed:
+                logging.warning(
+                    f"{len(failed)} rghc failed and can be retried: {failed}"
+                )
+
+        else:
+            call = call_chunked if chunked_mode else call_llm_structured
+            for rghc, text in tqdm(corpus.texts(rghcs), total=len(rghcs)):
+                logging.info(f"Processing rghc : {rghc}")
+                # check if the patient was already processed
+                if results.is_done(rghc):
+                    logging.info(f"Patient {rghc} already processed")
+                    continue
+                try:
+                    with patient(rghc):
+                        result = call(
+                            provider=provider,
+                            model=model,
+                            instruction=task.instruction,
+                            unstructured_text=text,
+                            schema_model=schema_model,
+                        )
+                    save_result(rghc, result)
+                except Exception as e:
+                    # routed to the retry pass instead of aborting the run
+                    logging.error(f"API call failed for {rghc}: {e}")
+                    results.record_error(rghc, e)
+
+    if prefilter_mode:
+        # the patients whose note has no term of the task get an empty result without a call
+        todo, skipped = prefilter(
+            (
+                (rghc, text)
+                for rghc, text in corpus.texts(todo)
+                if not results.is_done(rghc)
+            ),
+            schema_model,
+        )
+        for rghc, reason in skipped:
+            results.record_skipped(rghc, empty_result(schema_model), reason)
+            manifest.record(rghc, inputs[rghc]._replace(terms_hash=terms_hash))
+        logging.info(
+            f"Prefilter : {len(skipped)} calls saved, {len(todo)} rghc to extract"
+        )
+
+    extract(todo)
+    # the patients whose call failed, in this run or a previous one, are retried
+    # once the providers had time to recover (see resilience)
+    wanted = set(rghc_list)
+    for retry in range(retry_passes):
+        failed = [rghc for rghc, _ in results.failed() if rghc in wanted]
+        if not failed:
+            break
+        logging.info(f"Retry pass {retry + 1} for {len(failed)} rghc")
+        extract(failed)
+
+    if get_cache() is not None:
+        logging.info(f"LLM cache: {get_cache().stats()}")
+    logging.info(f"Prompt cache: {get_prompt_usage().stats()}")
+    if hedge_mode:
+        logging.info(f"Hedging: {get_hedge_stats().stats()}")
+    if telemetry is not None:
+        logging.info(f"Telemetry: {telemetry.write_summary()}")
+        if telemetry.path is not None:
+            telemetry.write_prometheus(telemetry.path.with_suffix(".prom"))
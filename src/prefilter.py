@@ -0,0 +1,183 @@
+"""
+Keyword pre-filter of the patients sent to the models
+
+A note which mentions none of the terms of a task (no drug or regimen of drug_lexicon,
+no therapy, transplant or relapse term) cannot hold a treatment line or a relapse, yet it costs
+a full call answering an empty list of lines or no relapse. The texts are accent-folded and
+lowercased, then searched with a single compiled alternation of the terms of the task ;
+the patients without any match are answered locally with the empty result of the task,
+and the reason is logged. The terms of each task can be changed with configure_prefilter ;
+their digest is kept in the manifest of the skipped patients, which are sent again when
+the terms change.
+"""
+
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple, Type
+from pydantic import BaseModel
+import logging
+import re
+
+from drug_lexicon import alternation, drug_names, fold, on_configure, regimen_names
+from task_bundle import sha256
+from structured_relapse import Relapse
+from structured_treatment import TreatmentLines
+
+# names of the drugs and regimens of drug_lexicon, refreshed by configure_drugs
+DRUGS = drug_names()
+REGIMENS = regimen_names()
+THERAPY = [
+    "quimioterapia",
+    "radioterapia",
+    "inducao",
+    "consolidacao",
+    "manutencao",
+    "ciclo",
+]
+TRANSPLANT = [
+    "transplante",
+    "TMO",
+    "ATMO",
+    "TCTH",
+    "TACTH",
+    "autologo",
+    "alogenico",
+    "condicionamento",
+    "mobilizacao",
+]
+RELAPSE = [
+    "recaida",
+    "recaiu",
+    "recidiva",
+    "recorrencia",
+    "progressao",
+    "progrediu",
+    "refratari",
+    "resgate",
+    "perda de resposta",
+]
+
+# terms of each task, matched at the start of a word
+TERMS = {
+    TreatmentLines: {
+        "drug": DRUGS,
+        "regimen": REGIMENS,
+        "therapy": THERAPY,
+        "transplant": TRANSPLANT,
+    },
+    Relapse: {
+        "transplant": TRANSPLANT,
+        "relapse": RELAPSE,
+    },
+}
+
+# result of the task for a note without any of its terms
+EMPTY_RESULTS = {
+    TreatmentLines: {"linhas": []},
+    Relapse: {"relapse": False, "relapse_dt": None},
+}
+
+
+def configure_prefilter(schema_model: Type[BaseModel], terms: Dict[str, List[str]]):
+    """
+    Replace the terms of the task of schema_model : {group name: terms}
+    """
+    TERMS[schema_model] = terms
+    pattern.cache_clear()
+    terms_digest.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def pattern(schema_model: Type[BaseModel]) -> re.Pattern:
+    """
+    Alternation of the terms of the task (see drug_lexicon.alternation)
+    """
+    return alternation(term for group in TERMS[schema_model].values() for term in group)
+
+
+@lru_cache(maxsize=None)
+def terms_digest(schema_model: Type[BaseModel]) -> str:
+    """
+    sha256 of the folded terms of the task, the input of the skipped patients (see manifest)
+    """
+    return sha256(
+        "\n".join(
+            sorted(
+                {fold(term) for group in TERMS[schema_model].values() for term in group}
+            )
+        )
+    )
+
+
+def _refresh_drugs() -> None:
+    """
+    Follow configure_drugs : the lists are updated in place, as TERMS holds them
+    """
+    DRUGS[:] = drug_names()
+    REGIMENS[:] = regimen_names()
+    pattern.cache_clear()
+    terms_digest.cache_clear()
+
+
+on_configure(_refresh_drugs)
+
+
+def empty_result(schema_model: Type[BaseModel]) -> BaseModel:
+    return schema_model.model_validate(EMPTY_RESULTS[schema_model])
+
+
+def is_relevant(text, schema_model: Type[BaseModel]) -> bool:
+    """
+    True when the text mentions at least one term of the task
+    """
+    return isinstance(text, str) and bool(pattern(schema_model).search(fold(text)))
+
+
+def prefilter(
+    texts: Iterable[Tuple], schema_model: Type[BaseModel]
+) -> Tuple[List, List[Tuple]]:
+    """
+    Split the (rghc, text) pairs between the patients to send to the model
+    and the patients answered locally
+    returns : ([rghc to send], [(rghc, reason) answered with empty_result])
+    """
+    reason = f"no {', '.join(TERMS[schema_model])} term"
+    kept, skipped = [], []
+    for rghc, text in texts:
+        if is_relevant(text, schema_model):
+            kept.append(rghc)
+        else:
+            skipped.append((rghc, reason))
+            logging.info(f"Patient {rghc} answered without a call : {reason}")
+    return kept, skipped
+
+
+if __name__ == "__main__":
+    # share of the synthetic patients answered locally, and throughput of the pre-filter :
+    # patients with a treatment history mixed with follow-up notes only
+    # python src/prefilter.py
+    from config import tasy_tratamento_columns
+    from latest_tasy import latest_consultations
+    from synthetic_data import SENTENCES, make_tasy
+    import random
+    import time
+
+    rng = random.Random(0)
+    n_patients = 20_000
+    df = latest_consultations([make_tasy(n_patients // 2)])
+    treated = df[tasy_tratamento_columns[0]].str.cat(
+        df[tasy_tratamento_columns[1:]], sep=" "
+    )
+    follow_up = [" ".join(rng.sample(SENTENCES, 4)) for _ in range(n_patients // 2)]
+    texts = [(f"t{i}", text) for i, text in enumerate(treated)]
+    texts += [(f"f{i}", text) for i, text in enumerate(follow_up)]
+
+    for schema_model in [TreatmentLines, Relapse]:
+        start = time.perf_counter()
+        kept, skipped = prefilter(texts, schema_model)
+        elapsed = time.perf_counter() - start
+        lost = sum(rghc.startswith("t") for rghc, _ in skipped)
+        print(
+            f"{schema_model.__name__}: {len(skipped)}/{len(texts)} calls saved "
+            f"({lost} patients with a treatment history skipped) "
+            f"in {elapsed:.2f}s ({len(texts) / elapsed:.0f} texts/s)"
+        )
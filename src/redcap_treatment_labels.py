@@ -1,30 +1,51 @@
+import numpy as np
 import pandas as pd
 from config import (
     src_drug_cols_dict,
     final_drug_cols_dict,
     rename_columns_dict,
     label_cols,
+    date_col_list,
+    str_col_list,
 )
+from table_io import write_table
 from utils import retrieve_drugs
 
 
 def redcap_labels(redcap_input_path: str, label_output_path: str) -> None:
     """
     Retrieve the relevant treatment labels from REDCAP database to evaluate the results of API calls
+    label_output_path : csv, or parquet with typed dates and drugs (see table_io)
     """
-    redcap_df = pd.read_csv(redcap_input_path, sep=";", low_memory=False)
+    # only read the columns used below, exports are very wide
+    needed_cols = {"RGHC", "Repeat Instrument", "Sexo", "Desfecho final do paciente"}
+    needed_cols |= set(rename_columns_dict)
+    drug_questions = tuple(src_drug_cols_dict.values())
+    redcap_df = pd.read_csv(
+        redcap_input_path,
+        sep=";",
+        low_memory=False,
+        usecols=lambda c: c in needed_cols or c.startswith(drug_questions),
+    )
 
     redcap_df.rename(columns={"RGHC": "rghc"}, inplace=True)
     # recasting check formular data
-    redcap_df.replace({"Checked": True, "Unchecked": False}, inplace=True)
+    choice_cols = [c for c in redcap_df.columns if "(choice=" in c]
+    redcap_df[choice_cols] = redcap_df[choice_cols].eq("Checked")  # else "Unchecked"
 
-    # adding rghc to treatment lines
-    rghc = ""  # variable initialization
-    for index, row in redcap_df.iterrows():
-        if row["Repeat Instrument"] == "Linha de Tratamento":
-            redcap_df.at[index, "rghc"] = rghc
-        else:
-            rghc = row["rghc"]
+    # adding rghc to treatment lines : the rghc of the last patient row above them
+    is_line = (redcap_df["Repeat Instrument"] == "Linha de Tratamento").to_numpy()
+    patient_number = np.cumsum(~is_line)
+    patient_rghc = pd.Series(
+        redcap_df["rghc"].to_numpy()[~is_line], index=patient_number[~is_line]
+    )
+    line_rghc = patient_rghc.reindex(patient_number[is_line]).to_numpy()
+    # lines above the first patient row get an empty rghc
+    leading = patient_number[is_line] == 0
+    if leading.any():
+        line_rghc = line_rghc.astype(object)
+        line_rghc[leading] = ""
+    redcap_df.loc[is_line, "rghc"] = line_rghc
 
     redcap_df = retrieve_drugs(
         redcap_df, src_drug_cols_dict["inducao"], final_drug_cols_dict["inducao"]
@@ -50,7 +71,7 @@ def redcap_labels(redcap_input_path: str, label_output_path: str) -> None:
     # keep only treatment lines
     redcap_df = redcap_df[redcap_df["Repeat Instrument"] == "Linha de Tratamento"]
 
-    redcap_df[label_cols].to_csv(label_output_path, index=False)
+    write_table(redcap_df[label_cols], label_output_path, date_col_list, str_col_list)
 
     return
 
@@ -0,0 +1,352 @@
+"""
+Resilience of the provider calls : rate limiting, retries and circuit breaking, per provider
+
+Each provider has a guard made of :
+- a token bucket limiting the request rate, which halves its rate on a 429 (and pauses for
+  the retry-after delay when the provider sends one), then regains it call after call ;
+- retries of the transient errors (429, 5xx, timeouts, connection errors) with jittered
+  exponential backoff ;
+- a circuit breaker which pauses every call to the provider for a cooldown after
+  consecutive failures, instead of hammering a provider which is down.
+Errors which are not transient (bad request, authentication, validation) are raised at once,
+and the pipelines route the patients whose call failed to a retry pass (see mm_pipeline).
+"""
+
+from typing import Callable, Optional, Tuple
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from telemetry import current_call
+
+RESILIENCE_ENABLED = True
+# requests per second per provider, None for no limit
+RATE_LIMITS = {
+    "openai": 10.0,
+    "gemini": 5.0,
+    "mistral": 1.0,  # free tier
+    "groq": 4.0,
+    "fake": None,
+}
+MIN_RATE = 0.1  # requests per second, floor of the adaptive rate
+RATE_RECOVERY = 0.05  # share of the rate limit regained at each successful call
+MAX_RETRIES = 5
+BASE_DELAY = 1.0  # seconds, first backoff delay (doubled at each retry)
+MAX_DELAY = 60.0  # seconds
+FAILURE_THRESHOLD = 5  # consecutive failures opening the circuit
+COOLDOWN = 30.0  # seconds the circuit stays open
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+def configure_resilience(
+    enabled: Optional[bool] = None,
+    rate_limits: Optional[dict] = None,
+    max_retries: Optional[int] = None,
+    base_delay: Optional[float] = None,
+    max_delay: Optional[float] = None,
+    failure_threshold: Optional[int] = None,
+    cooldown: Optional[float] = None,
+) -> None:
+    """
+    Change the resilience settings, the guards are rebuilt at the next call
+    rate_limits : {provider: requests per second or None}, merged into RATE_LIMITS
+    """
+    global RESILIENCE_ENABLED, MAX_RETRIES, BASE_DELAY, MAX_DELAY
+    global FAILURE_THRESHOLD, COOLDOWN
+    with _guards_lock:
+        if enabled is not None:
+            RESILIENCE_ENABLED = enabled
+        if rate_limits is not None:
+            for provider, rate in rate_limits.items():
+                RATE_LIMITS[str(getattr(provider, "value", provider))] = rate
+        if max_retries is not None:
+            MAX_RETRIES = max_retries
+        if base_delay is not None:
+            BASE_DELAY = base_delay
+        if max_delay is not None:
+            MAX_DELAY = max_delay
+        if failure_threshold is not None:
+            FAILURE_THRESHOLD = failure_threshold
+        if cooldown is not None:
+            COOLDOWN = cooldown
+        _guards.clear()
+
+
+def error_status(error: Exception) -> Tuple[Optional[int], Optional[float]]:
+    """
+    returns : (HTTP status, retry-after seconds) of an SDK error, None when unknown
+    """
+    status = getattr(error, "status_code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "code", None)  # google-genai errors
+    if not isinstance(status, int):
+        status = None
+    retry_after = getattr(error, "retry_after", None)
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if retry_after is None and headers is not None:
+        try:
+            retry_after = float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+    return status, retry_after
+
+
+def is_transient(error: Exception, status: Optional[int]) -> bool:
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # timeouts and connection errors of asyncio, httpx and the SDKs
+    names = [cls.__name__ for cls in type(error).__mro__]
+    return isinstance(error, (TimeoutError, ConnectionError)) or any(
+        "Timeout" in name or "Connect" in name for name in names
+    )
+
+
+class TokenBucket:
+    """
+    Request rate limit which adapts to the 429 of the provider (None : no limit)
+    """
+
+    def __init__(self, rate: Optional[float]):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate) if rate is not None else 1.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token
+        returns : the seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate is not None:
+                elapsed = now - self.updated
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def throttle(self, retry_after: Optional[float] = None) -> None:
+        """
+        The provider answered 429 : halve the rate and pause for retry_after seconds
+        """
+        with self._lock:
+            if self.rate is not None:
+                self.rate = max(MIN_RATE, self.rate / 2)
+            if retry_after:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+
+    def recover(self) -> None:
+        with self._lock:
+            if self.rate is not None:
+                self.rate = min(
+                    self.max_rate, self.rate + RATE_RECOVERY * self.max_rate
+                )
+
+
+class CircuitBreaker:
+    """
+    Opened for COOLDOWN seconds after FAILURE_THRESHOLD consecutive failures ;
+    after the cooldown a new failure opens it again at once, a success closes it
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> float:
+        """
+        returns : the seconds left before the provider can be called again
+        """
+        with self._lock:
+            return max(0.0, self.opened_until - time.monotonic())
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            now = time.monotonic()
+            if self.failures >= FAILURE_THRESHOLD and self.opened_until <= now:
+                self.opened_until = now + COOLDOWN
+                logging.warning(
+                    f"Circuit opened for {self.name} after {self.failures} "
+                    f"consecutive failures, calls paused for {COOLDOWN}s"
+                )
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+
+class ProviderGuard:
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.bucket = TokenBucket(RATE_LIMITS.get(provider))
+        self.breaker = CircuitBreaker(provider)
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        Account for the failure of a call
+        returns : the seconds to wait before retrying, None when the error must be raised
+        """
+        status, retry_after = error_status(error)
+        if not is_transient(error, status):
+            return None
+        if status == 429:
+            self.bucket.throttle(retry_after)
+        else:
+            self.breaker.record_failure()
+        if attempt >= MAX_RETRIES:
+            return None
+        # full jitter, so that the concurrent calls do not retry all together
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2**attempt))
+        return max(delay, retry_after or 0.0)
+
+    def record_success(self) -> None:
+        self.breaker.record_success()
+        self.bucket.recover()
+
+
+def get_guard(provider) -> ProviderGuard:
+    provider = str(getattr(provider, "value", provider))
+    with _guards_lock:
+        if provider not in _guards:
+            _guards[provider] = ProviderGuard(provider)
+        return _guards[provider]
+
+
+def count_retry(provider, attempt: int, error: Exception, delay: float) -> None:
+    record = current_call()
+    if record is not None:
+        record.retries += 1
+    logging.warning(
+        f"{getattr(provider, 'value', provider)} call failed ({type(error).__name__}: "
+        f"{error}), retry {attempt} in {delay:.1f}s"
+    )
+
+
+def call_guarded(provider, request: Callable, *args):
+    """
+    request(*args) with the rate limit, retries and circuit breaker of the provider
+    """
+    if not RESILIENCE_ENABLED:
+        return request(*args)
+    guard = get_guard(provider)
+    attempt = 0
+    while True:
+        time.sleep(guard.breaker.wait())
+        time.sleep(guard.bucket.reserve())
+        try:
+            result = request(*args)
+        except Exception as e:
+            delay = guard.retry_delay(e, attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            count_retry(provider, attempt, e, delay)
+            time.sleep(delay)
+            continue
+        guard.record_success()
+        return result
+
+
+async def acall_guarded(provider, request: Callable, *args):
+    """
+    Same as call_guarded for a coroutine function request
+    """
+    if not RESILIENCE_ENABLED:
+        return await request(*args)
+    guard = get_guard(provider)
+    attempt = 0
+    while True:
+        await asyncio.sleep(guard.breaker.wait())
+        await asyncio.sleep(guard.bucket.reserve())
+        try:
+            result = await request(*args)
+        except Exception as e:
+            delay = guard.retry_delay(e, attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            count_retry(provider, attempt, e, delay)
+            await asyncio.sleep(delay)
+            continue
+        guard.record_success()
+        return result
+
+
+if __name__ == "__main__":
+    # extraction of a cohort against the fake provider with injected faults (500 and 429),
+    # without then with the resilience layer, then an outage opening the circuit
+    # python src/resilience.py
+    from api_calls import Provider, acall_llm_structured
+    from concurrent_extraction import extract_concurrently
+    from structured_treatment import TreatmentLines
+    from telemetry import configure_telemetry
+    from functools import partial
+    import fake_provider
+    import resilience  # the module used by api_calls, not this __main__ copy
+
+    logging.basicConfig(level=logging.ERROR)
+    n_patients = 300
+    patients = [(i, f"paciente {i}") for i in range(n_patients)]
+    call = partial(acall_llm_structured, use_cache=False)
+
+    def run(label: str) -> None:
+        results = {}
+        telemetry = configure_telemetry()
+        start = time.perf_counter()
+        failed = asyncio.run(
+            extract_concurrently(
+                patients,
+                Provider.FAKE,
+                "fake",
+                "",
+                TreatmentLines,
+                on_result=results.__setitem__,
+                concurrency=32,
+                call=call,
+            )
+        )
+        elapsed = time.perf_counter() - start
+        stats = telemetry.summary()["fake/fake"]
+        print(
+            f"{label}: {len(results)}/{len(patients)} extracted, {len(failed)} failed, "
+            f"{stats['retries']} retries in {elapsed:.2f}s"
+        )
+
+    fake_provider.configure_fake(
+        latency=0.02, error_rate=0.1, rate_limit_rate=0.1, retry_after=0.2
+    )
+    resilience.configure_resilience(enabled=False)
+    run("without resilience")
+    resilience.configure_resilience(
+        enabled=True, base_delay=0.05, max_delay=1.0, failure_threshold=10, cooldown=1.0
+    )
+    run("with resilience")
+
+    # outage : every call fails, the circuit opens and the calls are paused
+    fake_provider.configure_fake(error_rate=1.0, rate_limit_rate=0.0)
+    resilience.configure_resilience(max_retries=2)
+    guard = resilience.get_guard(Provider.FAKE)
+    patients = patients[:20]
+    run("provider down")
+    print(
+        f"circuit open for {guard.breaker.wait():.2f}s more "
+        f"after {guard.breaker.failures} consecutive failures"
+    )
@@ -0,0 +1,313 @@
+"""
+Durable store of the extraction results of a pipeline
+
+Each patient's validated output (or the error of its call) is committed as soon as it is
+received, so that a crashed or interrupted run resumes where it stopped : the rghc already
+done are loaded once in memory and checked in constant time. The patients answered without a
+call (see prefilter) are stored apart, with the skipped status and its reason, and count as
+done.
+The global csv / json outputs are materialized at the end by streaming the store,
+without holding every result in memory.
+The per-rghc csv / json files written by the pipelines before the store are imported once
+(see import_files), so that the results already paid for stay done.
+"""
+
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple, Type
+from pydantic import BaseModel
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from corpus_store import sql_value
+from table_io import write_table_chunks
+
+DONE = "done"
+SKIPPED = "skipped"  # empty result given without a call, the reason in the error column
+FAILED = "failed"
+ANSWERED = (DONE, SKIPPED)  # statuses holding a result
+READ_CHUNK = 1000  # results fetched per query when streaming the store
+
+
+class ResultStore:
+    """
+    SQLite store of one result per rghc, with its status and error
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                rghc PRIMARY KEY,
+                status TEXT,
+                schema_name TEXT,
+                value TEXT,
+                error TEXT,
+                updated_at REAL
+            )
+            """
+        )
+        self._conn.commit()
+        self._done = self._load_done()
+
+    def _load_done(self) -> set:
+        return {
+            row[0]
+            for row in self._conn.execute(
+                "SELECT rghc FROM results WHERE status IN (?, ?)", ANSWERED
+            )
+        }
+
+    def _write(self, rghc, status, schema_name, value, error) -> None:
+        rghc = sql_value(rghc)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (rghc, status, schema_name, value, error, time.time()),
+            )
+            self._conn.commit()
+            if status in ANSWERED:
+                self._done.add(rghc)
+            else:
+                self._done.discard(rghc)
+
+    def record(self, rghc, result: BaseModel) -> None:
+        self._write(rghc, DONE, type(result).__name__, result.model_dump_json(), None)
+
+    def record_skipped(self, rghc, result: BaseModel, reason: str) -> None:
+        self._write(
+            rghc, SKIPPED, type(result).__name__, result.model_dump_json(), reason
+        )
+
+    def record_error(self, rghc, error: Exception) -> None:
+        self._write(rghc, FAILED, None, None, f"{type(error).__name__}: {error}")
+
+    def is_done(self, rghc) -> bool:
+        return sql_value(rghc) in self._done
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def failed(self) -> List[Tuple]:
+        """
+        returns : [(rghc, error)] of the patients whose last attempt failed
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT rghc, error FROM results WHERE status = ? ORDER BY rowid",
+                (FAILED,),
+            ).fetchall()
+
+    def skipped(self) -> List[Tuple]:
+        """
+        returns : [(rghc, reason)] of the patients answered without a call
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT rghc, error FROM results WHERE status = ? ORDER BY rowid",
+                (SKIPPED,),
+            ).fetchall()
+
+    def invalidate(self, rghcs: Iterable) -> None:
+        """
+        Remove the results of rghcs, which are extracted again by the next run
+        """
+        ids = [(sql_value(rghc),) for rghc in rghcs]
+        with self._lock:
+            self._conn.executemany("DELETE FROM results WHERE rghc = ?", ids)
+            self._conn.commit()
+            self._done.difference_update(rghc for (rghc,) in ids)
+
+    def merge(self, path) -> int:
+        """
+        Copy the results of the store at path (such as a shard, see sharded_runner),
+        a failure never replacing a result already done (or skipped) here
+        returns : the number of rows copied
+        """
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS other", (str(path),))
+            try:
+                cursor = self._conn.execute(
+                    "INSERT OR REPLACE INTO results SELECT * FROM other.results o "
+                    "WHERE o.status IN (?, ?) OR o.rghc NOT IN "
+                    "(SELECT rghc FROM results WHERE status IN (?, ?))",
+                    ANSWERED + ANSWERED,
+                )
+                self._conn.commit()
+            finally:
+                self._conn.execute("DETACH DATABASE other")
+            self._done = self._load_done()
+        return cursor.rowcount
+
+    def import_files(
+        self,
+        directory,
+        schema_model: Type[BaseModel],
+        explode: Optional[str] = None,
+        rghcs: Optional[Iterable] = None,
+    ) -> int:
+        """
+        Import the per-rghc result files of directory written before the store : <rghc>.json
+        (a result), or <rghc>.csv (one row per item of the list field explode, such as
+        "linhas"), restricted to rghcs if given ; the rghc already done are left as they are
+        returns : the number of results imported
+        """
+        directory = Path(directory)
+        if not directory.is_dir():
+            return 0
+        if rghcs is None:
+            wanted = None
+        else:
+            wanted = {str(sql_value(rghc)): sql_value(rghc) for rghc in rghcs}
+        rows = []
+        for path in sorted(directory.iterdir()):
+            if path.suffix not in (".json", ".csv") or (
+                path.suffix == ".csv" and explode is None
+            ):
+                continue
+            if wanted is None:
+                rghc = int(path.stem) if path.stem.isdigit() else path.stem
+            elif path.stem in wanted:
+                rghc = wanted[path.stem]
+            else:
+                continue
+            if self.is_done(rghc):
+                continue
+            try:
+                if path.suffix == ".json":
+                    data = json.loads(path.read_text())
+                else:
+                    df = pd.read_csv(path, dtype=str).drop(
+                        columns="rghc", errors="ignore"
+                    )
+                    data = {
+                        explode: df.astype(object)
+                        .where(df.notna(), None)
+                        .to_dict("records")
+                    }
+                result = schema_model.model_validate(data)
+            except Exception as e:
+                logging.warning(f"Result file {path} not imported: {e}")
+                continue
+            rows.append(
+                (
+                    rghc,
+                    DONE,
+                    schema_model.__name__,
+                    result.model_dump_json(),
+                    None,
+                    time.time(),
+                )
+            )
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+            self._done.update(row[0] for row in rows)
+        if rows:
+            logging.info(f"{len(rows)} results imported from {directory}")
+        return len(rows)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM results")
+            self._conn.commit()
+            self._done.clear()
+
+    def results(self, rghcs: Optional[Iterable] = None) -> Iterator[Tuple]:
+        """
+        Lazy (rghc, result as a dict) of the done (and skipped) patients, restricted to rghcs if given
+        (in their order), otherwise in the order they were recorded
+        """
+        if rghcs is not None:
+            ids = [sql_value(rghc) for rghc in rghcs if self.is_done(rghc)]
+            for start in range(0, len(ids), READ_CHUNK):
+                chunk = ids[start : start + READ_CHUNK]
+                with self._lock:
+                    found = dict(
+                        self._conn.execute(
+                            "SELECT rghc, value FROM results "
+                            f"WHERE rghc IN ({', '.join('?' * len(chunk))})",
+                            chunk,
+                        ).fetchall()
+                    )
+                for rghc in chunk:
+                    yield rghc, json.loads(found[rghc])
+            return
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, rghc, value FROM results "
+                    "WHERE status IN (?, ?) AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (*ANSWERED, last, READ_CHUNK),
+                ).fetchall()
+            if not rows:
+                return
+            for last, rghc, value in rows:
+                yield rghc, json.loads(value)
+
+    def export_table(
+        self,
+        path,
+        explode: str,
+        rghcs: Optional[Iterable] = None,
+        date_cols=(),
+        category_cols=(),
+    ) -> int:
+        """
+        One row per item of the list field explode (such as "linhas"), with a rghc column,
+        written chunk by chunk to a csv or parquet file (see table_io)
+        returns : the number of rows written
+        """
+
+        def chunks():
+            columns, rows, n_chunks = None, [], 0
+            for rghc, data in self.results(rghcs):
+                rows += [{**item, "rghc": rghc} for item in data[explode]]
+                if len(rows) >= READ_CHUNK:
+                    df = pd.DataFrame(rows, columns=columns)
+                    columns, rows, n_chunks = list(df.columns), [], n_chunks + 1
+                    yield df
+            if rows or not n_chunks:
+                yield pd.DataFrame(rows, columns=columns)
+
+        return write_table_chunks(chunks(), path, date_cols, category_cols)
+
+    def export_json(self, path, rghcs: Optional[Iterable] = None) -> int:
+        """
+        {rghc: result} json file, formatted as json.dump(..., indent=4), written result by result
+        returns : the number of results written
+        """
+        n = 0
+        with open(path, "w") as f:
+            f.write("{")
+            for rghc, data in self.results(rghcs):
+                f.write(",\n    " if n else "\n    ")
+                f.write(f"{json.dumps(str(rghc))}: ")
+                f.write(json.dumps(data, indent=4).replace("\n", "\n    "))
+                n += 1
+            f.write("\n}" if n else "}")
+        return n
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python src/result_store.py <store.sqlite> : status of a result store
+    store = ResultStore(sys.argv[1])
+    failed = store.failed()
+    skipped = store.skipped()
+    print(f"{len(store)} rghc done ({len(skipped)} skipped), {len(failed)} failed")
+    for rghc, error in failed:
+        print(f"{rghc}: {error}")
@@ -0,0 +1,205 @@
+"""
+Sharded runs of the pipelines over several processes or machines
+
+A single process is bound by the validation, the pandas work and the GIL long before the
+providers are, at the scale of the whole cohort. The rghc are split in N shards by a stable
+hash of the rghc (the same on every machine and every run), and each shard runs the pipeline
+in its own process, selected by the HEMAPEX_SHARD and HEMAPEX_SHARDS environment variables.
+Each shard owns its result store (and metrics, logs and exports) named after the shard,
+so that it resumes on its own. The merge step copies the shard stores into the store of the
+pipeline, then runs the pipeline once unsharded : every patient being done, it only retries
+the failed ones and exports the global result.
+
+usage :
+python src/sharded_runner.py src/mm_pipeline.py 4        : run 4 shards here, then merge
+python src/sharded_runner.py src/mm_pipeline.py 4 merge  : merge only, the shards having run
+    elsewhere with HEMAPEX_SHARD=<i> HEMAPEX_SHARDS=4 python src/mm_pipeline.py
+python src/sharded_runner.py benchmark [n_patients [max_processes]] : scaling from 1 to N cores
+"""
+
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+from corpus_store import sql_value
+from manifest import Manifest, manifest_path
+from result_store import ResultStore
+
+SHARD_ENV = "HEMAPEX_SHARD"
+SHARDS_ENV = "HEMAPEX_SHARDS"
+
+
+def shard_of(rghc, n_shards: int) -> int:
+    """
+    returns : the shard of rghc, stable across processes, machines and Python versions
+    (unlike hash(), which is salted per process)
+    """
+    digest = hashlib.blake2b(str(sql_value(rghc)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n_shards
+
+
+def select_shard(rghcs: Iterable, shard: int, n_shards: int) -> List:
+    """
+    returns : the rghc of the shard, in their order
+    """
+    if n_shards == 1:
+        return list(rghcs)
+    return [rghc for rghc in rghcs if shard_of(rghc, n_shards) == shard]
+
+
+def current_shard() -> Tuple[int, int]:
+    """
+    returns : (shard, number of shards) of this process, (0, 1) when not sharded
+    """
+    n_shards = int(os.environ.get(SHARDS_ENV, 1))
+    shard = int(os.environ.get(SHARD_ENV, 0))
+    if n_shards < 1 or not 0 <= shard < n_shards:
+        raise ValueError(f"Invalid shard {shard} of {n_shards}")
+    return shard, n_shards
+
+
+def shard_path(path, shard: int, n_shards: int) -> Path:
+    """
+    returns : the partition of path owned by the shard, path itself when not sharded
+    """
+    path = Path(path)
+    if n_shards == 1:
+        return path
+    return path.with_name(f"{path.stem}_shard{shard}of{n_shards}{path.suffix}")
+
+
+def run_shards(script, n_shards: int, shards: Optional[Iterable[int]] = None) -> dict:
+    """
+    Run the pipeline script once per shard (all of them by default), in parallel processes
+    returns : {shard: exit code}
+    """
+    processes = {}
+    for shard in range(n_shards) if shards is None else shards:
+        env = {**os.environ, SHARD_ENV: str(shard), SHARDS_ENV: str(n_shards)}
+        processes[shard] = subprocess.Popen([sys.executable, str(script)], env=env)
+    return {shard: process.wait() for shard, process in processes.items()}
+
+
+def merge_shards(results_path, n_shards: int) -> ResultStore:
+    """
+    Copy the results of the shard stores, and their manifests, into the store at results_path
+    returns : the merged store
+    """
+    store = ResultStore(results_path)
+    manifest = Manifest(manifest_path(results_path))
+    for shard in range(n_shards):
+        path = shard_path(results_path, shard, n_shards)
+        if path.exists():
+            store.merge(path)
+            if manifest_path(path).exists():
+                manifest.merge(manifest_path(path))
+        else:
+            print(f"Missing shard {shard} : {path}")
+    return store
+
+
+def benchmark_shard(corpus_file, results_file, shard: int, n_shards: int) -> float:
+    """
+    Extraction of the patients of a shard against the fake provider (no latency),
+    the cost left being the one of this process : validation, serialization and storage
+    returns : the wall time of the extraction
+    """
+    from api_calls import Provider, acall_llm_structured
+    from concurrent_extraction import extract_concurrently
+    from corpus_store import CorpusStore
+    from structured_treatment import TreatmentLines
+    from functools import partial
+    import asyncio
+    import fake_provider
+    import logging
+
+    logging.disable(logging.WARNING)
+    fake_provider.configure_fake(
+        latency=0, latency_sigma=0, error_rate=0, rate_limit_rate=0
+    )
+    corpus = CorpusStore(corpus_file)
+    results = ResultStore(shard_path(results_file, shard, n_shards))
+    rghcs = select_shard(corpus.rghcs(), shard, n_shards)
+    start = time.perf_counter()
+    asyncio.run(
+        extract_concurrently(
+            corpus.texts(rghcs),
+            Provider.FAKE,
+            "fake",
+            "",
+            TreatmentLines,
+            on_result=results.record,
+            is_done=results.is_done,
+            call=partial(acall_llm_structured, use_cache=False),
+        )
+    )
+    return time.perf_counter() - start
+
+
+def benchmark(n_patients: int = 20_000, max_workers: Optional[int] = None) -> None:
+    """
+    Throughput of the sharded extraction from 1 to max_workers processes (default the cores)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    from corpus_store import CorpusStore, corpus_path
+    from latest_tasy import latest_tasy
+    from synthetic_data import write_synthetic_data
+    import tempfile
+
+    max_workers = max_workers or os.cpu_count()
+    counts = sorted({1, *(2**i for i in range(1, 8) if 2**i <= max_workers)})
+    counts = sorted({*counts, max_workers})
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_synthetic_data(n_patients, tmp)
+        latest_tasy(paths["tasy"], Path(tmp) / "latest_tasy.csv")
+        corpus_file = corpus_path(Path(tmp) / "latest_tasy.csv")
+        n_corpus = len(CorpusStore(corpus_file))
+        base = None
+        for workers in counts:
+            results_file = Path(tmp) / f"results_{workers}.sqlite"
+            start = time.perf_counter()
+            with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as pool:
+                times = list(
+                    pool.map(
+                        benchmark_shard,
+                        [corpus_file] * workers,
+                        [results_file] * workers,
+                        range(workers),
+                        [workers] * workers,
+                    )
+                )
+            wall = time.perf_counter() - start
+            merged = merge_shards(results_file, workers)
+            rate = n_corpus / max(times)
+            base = base or rate
+            print(
+                f"{workers} processes : {len(merged)}/{n_corpus} patients merged, "
+                f"{wall:.2f}s wall (with startup), slowest shard {max(times):.2f}s, "
+                f"{rate:.0f} patients/s, speedup {rate / base:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "benchmark":
+        benchmark(*(int(n) for n in sys.argv[2:4]))
+        sys.exit()
+
+    script, n_shards = Path(sys.argv[1]), int(sys.argv[2])
+    if sys.argv[3:4] != ["merge"]:
+        codes = run_shards(script, n_shards)
+        failed = [shard for shard, code in codes.items() if code != 0]
+        if failed:
+            sys.exit(f"Shards {failed} failed, rerun them before merging")
+
+    # the unsharded store of the pipeline, read from its settings
+    sys.path.insert(0, str(script.parent))
+    pipeline = __import__(script.stem)
+    store = merge_shards(pipeline.results_path, n_shards)
+    print(f"{len(store)} rghc done, {len(store.failed())} failed after merging")
+    # unsharded run : retries the failed patients and exports the global result
+    sys.exit(subprocess.run([sys.executable, str(script)]).returncode)
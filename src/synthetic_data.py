@@ -0,0 +1,167 @@
+"""
+Synthetic Tasy and REDCAP exports, with the layouts of the real ones, for benchmarks
+
+No real patient data is involved : texts, dates and treatments are drawn at random
+(with a fixed seed so that two runs produce the same files)
+"""
+
+from pathlib import Path
+import json
+import random
+
+import pandas as pd
+
+from config import (
+    drugs_ref,
+    rename_columns_dict,
+    src_drug_cols_dict,
+    tasy_tratamento_columns,
+)
+
+REGIMENS = {
+    "VCd": "Bortezomibe + Ciclofosfamida + Dexametasona",
+    "VRd": "Bortezomibe + Lenalidomida + Dexametasona",
+    "VTD": "Bortezomibe + Talidomida + Dexametasona",
+    "Dara-VRd": "Daratumumabe + Bortezomibe + Lenalidomida + Dexametasona",
+}
+
+SENTENCES = [
+    "Paciente em seguimento ambulatorial, sem queixas.",
+    "Nega dor óssea, febre ou sangramentos.",
+    "Exames laboratoriais sem alterações relevantes.",
+    "EFP sérica com pico monoclonal em queda.",
+    "Mantém boa tolerância ao tratamento.",
+    "Retorno em 3 meses com exames.",
+]
+
+
+def random_date(
+    rng: random.Random, start_year: int = 2008, end_year: int = 2025
+) -> str:
+    return f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(start_year, end_year)}"
+
+
+def treatment_history(rng: random.Random) -> str:
+    """
+    Treatment paragraph such as the ones copied from visit to visit in Tasy notes
+    """
+    lines = ["# Tratamento:"]
+    for _ in range(rng.randint(1, 3)):
+        regimen = rng.choice(list(REGIMENS))
+        lines.append(
+            f"- {regimen} ({REGIMENS[regimen]}) início em {random_date(rng)} - "
+            f"{rng.randint(1, 8)} ciclos"
+        )
+    if rng.random() < 0.5:
+        lines.append(f"- ATMO ({random_date(rng)})")
+    if rng.random() < 0.4:
+        lines.append(
+            f"- Manutenção com {rng.choice(drugs_ref)} desde {random_date(rng)}"
+        )
+    return "\n".join(lines)
+
+
+def make_tasy(
+    n_patients: int, visits_per_patient: int = 3, seed: int = 0
+) -> pd.DataFrame:
+    """
+    Scraping result of registro.tasy : one row per consultation
+    """
+    rng = random.Random(seed)
+    history_col, evolution_col, impression_col = tasy_tratamento_columns
+    rows = []
+    for i in range(n_patients):
+        rghc = 10_000_000 + i
+        history = treatment_history(rng)
+        for _ in range(visits_per_patient):
+            diagnosis = f"Mieloma múltiplo dx {random_date(rng)}."
+            rows.append(
+                {
+                    "rghc": rghc,
+                    "data": random_date(rng, 2020, 2025),
+                    history_col: f"{diagnosis}\n{history}",
+                    evolution_col: " ".join(rng.sample(SENTENCES, 3)),
+                    impression_col: history if rng.random() < 0.7 else "",
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def make_redcap(n_patients: int, seed: int = 0) -> pd.DataFrame:
+    """
+    REDCAP export : one patient row (with RGHC) followed by its "Linha de Tratamento" rows
+    (without RGHC), drugs as "(choice=...)" checkbox columns
+    """
+    rng = random.Random(seed)
+    date_cols = [
+        c
+        for c, v in rename_columns_dict.items()
+        if v.endswith(("_start", "_end", "_dt"))
+    ]
+    drug_cols = {
+        step: [f"{question} (choice={drug})" for drug in drugs_ref]
+        for step, question in src_drug_cols_dict.items()
+    }
+    rows = []
+    for i in range(n_patients):
+        rghc = 10_000_000 + i
+        rows.append(
+            {
+                "Record ID": i,
+                "RGHC": rghc,
+                "Repeat Instrument": None,
+                "Repeat Instance": None,
+                "Sexo": rng.choice(["Masculino", "Feminino"]),
+                "Desfecho final do paciente": rng.choice(["Vivo", "Óbito", None]),
+                "Data do diagnostico": random_date(rng, 2005, 2015),
+            }
+        )
+        for line in range(1, rng.randint(1, 3) + 1):
+            row = {
+                "Record ID": i,
+                "RGHC": None,
+                "Repeat Instrument": "Linha de Tratamento",
+                "Repeat Instance": line,
+                "Tipo de transplante:": rng.choice(["Autologo", "Alogenico", None]),
+            }
+            for col in date_cols:
+                row[col] = random_date(rng) if rng.random() < 0.6 else None
+            for cols in drug_cols.values():
+                chosen = set(rng.sample(cols, rng.randint(0, 3)))
+                for col in cols:
+                    row[col] = "Checked" if col in chosen else "Unchecked"
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_synthetic_data(n_patients: int, data_dir, seed: int = 0) -> dict:
+    """
+    Write the synthetic Tasy scrape (csv) and REDCAP export (csv with ; separator),
+    and their number of rows in meta.json
+    returns : the paths of the files
+    """
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    paths = {
+        "tasy": data_dir / "tasy.csv",
+        "redcap": data_dir / "redcap.csv",
+        "meta": data_dir / "meta.json",
+    }
+    tasy_df = make_tasy(n_patients, seed=seed)
+    tasy_df.to_csv(paths["tasy"], index=False)
+    redcap_df = make_redcap(n_patients, seed=seed)
+    redcap_df.to_csv(paths["redcap"], sep=";", index=False)
+    paths["meta"].write_text(
+        json.dumps(
+            {
+                "n_patients": n_patients,
+                "tasy_rows": len(tasy_df),
+                "redcap_rows": len(redcap_df),
+            }
+        )
+    )
+    return paths
+
+
+if __name__ == "__main__":
+    print(write_synthetic_data(100, Path(".") / "src/data/synthetic"))
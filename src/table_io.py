@@ -0,0 +1,119 @@
+"""
+Tabular files exchanged between the stages : csv, or parquet when the path ends with .parquet
+
+Parquet keeps the dtypes that csv loses : the dd/mm/YYYY date columns are stored as
+datetime64 and the drug columns as categoricals (dictionary encoded), so they are not
+re-parsed by every stage, the files are smaller and only the requested columns are read.
+Parquet needs the optional pyarrow package, csv works without it.
+"""
+
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+from date_normalizer import parse_date_series
+
+
+def is_parquet(path) -> bool:
+    return Path(path).suffix == ".parquet"
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError(
+            "Parquet files need pyarrow : pip install pyarrow, or use a .csv path"
+        ) from e
+    return pyarrow
+
+
+def arrow_table(df: pd.DataFrame, date_cols=(), category_cols=(), schema=None):
+    """
+    Arrow table of df with the date columns parsed to timestamps (see date_normalizer,
+    invalid dates become null) and the category columns dictionary encoded
+    (empty strings become null)
+    schema : cast to this schema, so that successive chunks of a file are consistent
+    """
+    pa = require_pyarrow()
+    arrays = []
+    for col in df.columns:
+        values = df[col]
+        if col in date_cols:
+            values = parse_date_series(values)
+            array = pa.array(values, type=pa.timestamp("ns"), from_pandas=True)
+        elif col in category_cols:
+            # empty strings are missing values, as when the csv is read back
+            values = values.astype(object).where(values != "", None)
+            array = pa.array(
+                values, type=pa.string(), from_pandas=True
+            ).dictionary_encode()
+        else:
+            array = pa.array(values, from_pandas=True)
+            if pa.types.is_null(array.type):
+                array = array.cast(pa.string())
+        arrays.append(array)
+    table = pa.Table.from_arrays(arrays, names=[str(c) for c in df.columns])
+    return table if schema is None else table.cast(schema)
+
+
+def write_table_chunks(
+    chunks: Iterable[pd.DataFrame],
+    path,
+    date_cols=(),
+    category_cols=(),
+) -> int:
+    """
+    Write successive dataframes with the same columns to a single csv or parquet file,
+    without holding them all in memory
+    returns : the number of rows written
+    """
+    n_rows = 0
+    if not is_parquet(path):
+        for df in chunks:
+            df.to_csv(path, mode="a" if n_rows else "w", header=not n_rows, index=False)
+            n_rows += len(df)
+        return n_rows
+
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for df in chunks:
+            schema = writer.schema if writer is not None else None
+            table = arrow_table(df, date_cols, category_cols, schema)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            n_rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+def write_table(df: pd.DataFrame, path, date_cols=(), category_cols=()) -> int:
+    return write_table_chunks([df], path, date_cols, category_cols)
+
+
+def read_table(path, columns: Optional[List[str]] = None, **csv_kwargs) -> pd.DataFrame:
+    """
+    Read a csv or parquet file, only the given columns are read (in their order)
+    """
+    if is_parquet(path):
+        require_pyarrow()
+        return pd.read_parquet(path, columns=columns)
+    df = pd.read_csv(path, usecols=columns, **csv_kwargs)
+    return df if columns is None else df[columns]
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python src/table_io.py <input> <output> : convert a table between csv and parquet
+    from config import date_col_list, str_col_list
+
+    df = read_table(sys.argv[1])
+    n = write_table(df, sys.argv[2], date_col_list, str_col_list)
+    print(f"{n} rows written to {sys.argv[2]}")
@@ -0,0 +1,122 @@
+"""
+Compiled extraction tasks and provider prompt-prefix caching
+
+A TaskBundle holds what every call of a run shares : the instruction, the JSON schema of the
+output model serialized once, and the system message of the chat-completion providers.
+It is compiled once per (instruction, schema) and reused by every call.
+
+The requests put this stable part first and the patient text last, so that the prompt-prefix
+caches of the providers (automatic above ~1024 tokens for OpenAI, Gemini and Groq) serve the
+shared prefix at a lower price and latency. The input and cached tokens reported by the
+providers are accumulated per provider, see get_prompt_usage.
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Type
+from pydantic import BaseModel
+import hashlib
+import json
+import threading
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@dataclass(frozen=True)
+class TaskBundle:
+    instruction: str
+    schema_model: Type[BaseModel]
+    schema: dict  # schema_model.model_json_schema()
+    system_message: str  # instruction and schema, for the chat-completion providers
+    instruction_digest: str  # sha256 of the instruction, see llm_cache.make_key
+    schema_digest: str  # sha256 of the sorted schema, see llm_cache.make_key
+
+    @property
+    def prefix_key(self) -> str:
+        """
+        short identifier of the stable prefix, routes the requests to the same cache
+        """
+        return self.instruction_digest[:16] + self.schema_digest[:16]
+
+
+@lru_cache(maxsize=64)
+def compile_task(instruction: str, schema_model: Type[BaseModel]) -> TaskBundle:
+    """
+    returns : the bundle of instruction and schema_model, built on first use and then reused
+    """
+    schema = schema_model.model_json_schema()
+    system_message = ("\n").join(
+        [
+            instruction,
+            "You MUST produce JSON that matches this schema exactly :",
+            json.dumps(schema),
+        ]
+    )
+    return TaskBundle(
+        instruction=instruction,
+        schema_model=schema_model,
+        schema=schema,
+        system_message=system_message,
+        instruction_digest=sha256(instruction),
+        schema_digest=sha256(json.dumps(schema, sort_keys=True)),
+    )
+
+
+def load_task(instruction_path, schema_model: Type[BaseModel]) -> TaskBundle:
+    """
+    Bundle of the instruction file and schema_model, the file being read once per run
+    """
+    return compile_task(Path(instruction_path).read_text(), schema_model)
+
+
+class PromptUsage:
+    """
+    Input tokens sent and input tokens served from the provider prompt cache, per provider
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def record(self, provider, input_tokens: int, cached_tokens: int) -> None:
+        provider = str(getattr(provider, "value", provider))
+        with self._lock:
+            counts = self._counts.setdefault(provider, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += input_tokens or 0
+            counts[2] += cached_tokens or 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                provider: {
+                    "calls": calls,
+                    "input_tokens": input_tokens,
+                    "cached_tokens": cached_tokens,
+                    "cached_ratio": round(cached_tokens / input_tokens, 3)
+                    if input_tokens
+                    else None,
+                }
+                for provider, (
+                    calls,
+                    input_tokens,
+                    cached_tokens,
+                ) in self._counts.items()
+            }
+
+
+_usage = PromptUsage()
+
+
+def get_prompt_usage() -> PromptUsage:
+    """
+    returns : the process-wide token counts of the calls sent to the providers
+    """
+    return _usage
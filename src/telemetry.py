@@ -0,0 +1,373 @@
+"""
+Per-call telemetry of the structured API calls : tokens, cost, latency and failures
+
+Every call of call_llm_structured / acall_llm_structured is recorded with its provider, model
+and rghc (see patient), its wall-clock latency, the token usage returned by the SDK, its cost
+from PRICES, its status (ok, cache hit, validation error, error, cancelled) and its retries.
+The records are appended as json lines to the metrics file of the run, and summarized at the
+end (p50/p95/p99 latency, tokens and cost per provider and model). The summary can also be
+exported in the Prometheus text format, to a file or served over HTTP for scraping.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from pydantic import ValidationError
+import asyncio
+import json
+import threading
+import time
+
+import numpy as np
+
+METRICS_DIR = Path(".") / "src/results/metrics/"
+
+# USD per million tokens : (input, cached input, output)
+PRICES = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gemini-2.5-pro": (1.25, 0.125, 10.00),
+    "open-mistral-7b": (0.25, 0.25, 0.25),
+    "moonshotai/kimi-k2-instruct-0905": (1.00, 0.50, 3.00),
+}
+
+OK = "ok"
+CACHE_HIT = "cache_hit"
+VALIDATION_ERROR = "validation_error"
+ERROR = "error"
+CANCELLED = "cancelled"  # abandoned for another call, see hedging
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+@dataclass
+class CallRecord:
+    provider: str
+    model: str
+    rghc: Optional[str]
+    started_at: float
+    latency: float = 0.0  # seconds
+    status: str = OK
+    error: Optional[str] = None
+    retries: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    cost: float = 0.0  # USD
+
+
+_rghc = ContextVar("rghc", default=None)
+_current = ContextVar("current_call", default=None)
+_collected = ContextVar("collected_calls", default=None)
+
+
+@contextmanager
+def patient(rghc):
+    """
+    Attribute the calls made inside the block (or the task) to rghc,
+    or to a list of rghc for a call about several patients
+    """
+    if isinstance(rghc, (list, tuple)):
+        rghc = ",".join(str(r) for r in rghc)
+    token = _rghc.set(None if rghc is None else str(rghc))
+    try:
+        yield
+    finally:
+        _rghc.reset(token)
+
+
+def current_call() -> Optional[CallRecord]:
+    """
+    returns : the record of the call in progress, to add its usage and retries
+    """
+    return _current.get()
+
+
+@contextmanager
+def collect_calls():
+    """
+    Collect the records of the calls made inside the block (or the task) in the yielded list
+    """
+    records = []
+    token = _collected.set(records)
+    try:
+        yield records
+    finally:
+        _collected.reset(token)
+
+
+def call_cost(model: str, input_tokens: int, cached_tokens: int, output_tokens: int):
+    input_price, cached_price, output_price = PRICES.get(model, (0.0, 0.0, 0.0))
+    uncached = input_tokens - cached_tokens
+    return (
+        uncached * input_price
+        + cached_tokens * cached_price
+        + output_tokens * output_price
+    ) / 1e6
+
+
+class Telemetry:
+    """
+    Records of the calls of a run, appended to a json lines file when path is given
+    """
+
+    def __init__(self, path=None):
+        self.path = None if path is None else Path(path)
+        self._lock = threading.Lock()
+        self._records = []
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def track(self, provider, model: str):
+        """
+        Record the call made inside the block : its latency, and its status from the
+        exception raised if any ; the usage is added by the provider code (see current_call)
+        """
+        record = CallRecord(
+            provider=str(getattr(provider, "value", provider)),
+            model=model,
+            rghc=_rghc.get(),
+            started_at=time.time(),
+        )
+        token = _current.set(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except ValidationError as e:
+            record.status, record.error = VALIDATION_ERROR, type(e).__name__
+            raise
+        except asyncio.CancelledError:
+            record.status = CANCELLED
+            raise
+        except Exception as e:
+            record.status, record.error = ERROR, f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.latency = time.perf_counter() - start
+            record.cost = call_cost(
+                model, record.input_tokens, record.cached_tokens, record.output_tokens
+            )
+            _current.reset(token)
+            self.add(record)
+            collected = _collected.get()
+            if collected is not None:
+                collected.append(record)
+
+    @classmethod
+    def from_file(cls, path) -> "Telemetry":
+        """
+        returns : the telemetry of the records of a metrics file, for analysis
+        """
+        telemetry = cls()
+        with open(path) as f:
+            telemetry._records = [CallRecord(**json.loads(line)) for line in f]
+        return telemetry
+
+    def add(self, record: CallRecord) -> None:
+        with self._lock:
+            self._records.append(record)
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(asdict(record)) + "\n")
+
+    def summary(self) -> dict:
+        """
+        returns : {"provider/model": statistics of its calls}, the latency quantiles
+        being computed on the calls answered by the provider (not the cache hits
+        nor the cancelled calls)
+        """
+        with self._lock:
+            records = list(self._records)
+        groups = {}
+        for record in records:
+            groups.setdefault(f"{record.provider}/{record.model}", []).append(record)
+
+        summary = {}
+        for name, group in groups.items():
+            sent = [r for r in group if r.status != CACHE_HIT]
+            latencies = np.array([r.latency for r in sent if r.status != CANCELLED])
+            # the calls of a pack are attributed to the comma-joined rghc of its patients
+            patients = {
+                rghc for r in group if r.rghc is not None for rghc in r.rghc.split(",")
+            }
+            cost = sum(r.cost for r in group)
+            summary[name] = {
+                "calls": len(group),
+                "patients": len(patients),
+                "cache_hits": len(group) - len(sent),
+                "validation_errors": sum(r.status == VALIDATION_ERROR for r in group),
+                "errors": sum(r.status == ERROR for r in group),
+                "cancelled": sum(r.status == CANCELLED for r in group),
+                "retries": sum(r.retries for r in group),
+                **{
+                    f"latency_p{round(q * 100)}": round(
+                        float(np.quantile(latencies, q)), 3
+                    )
+                    if len(latencies)
+                    else None
+                    for q in QUANTILES
+                },
+                "input_tokens": sum(r.input_tokens for r in group),
+                "cached_tokens": sum(r.cached_tokens for r in group),
+                "output_tokens": sum(r.output_tokens for r in group),
+                "cost": round(cost, 4),
+                "cost_per_patient": round(cost / len(patients), 5)
+                if patients
+                else None,
+            }
+        return summary
+
+    def write_summary(self, path=None) -> dict:
+        """
+        Write the summary as json, next to the records by default
+        """
+        summary = self.summary()
+        if path is None and self.path is not None:
+            path = self.path.with_name(f"{self.path.stem}_summary.json")
+        if path is not None:
+            Path(path).write_text(json.dumps(summary, indent=4))
+        return summary
+
+    def prometheus(self) -> str:
+        """
+        returns : the summary in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help_text, values):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in values:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        summary = self.summary()
+        groups = []
+        for name, stats in summary.items():
+            provider, model = name.split("/", 1)
+            groups.append(({"provider": provider, "model": model}, stats))
+
+        metric(
+            "llm_calls_total",
+            "counter",
+            "Structured extraction calls",
+            [
+                ({**labels, "status": status}, stats[key])
+                for labels, stats in groups
+                for status, key in [
+                    (CACHE_HIT, "cache_hits"),
+                    (VALIDATION_ERROR, "validation_errors"),
+                    (ERROR, "errors"),
+                    (CANCELLED, "cancelled"),
+                ]
+            ]
+            + [
+                (
+                    {**labels, "status": OK},
+                    stats["calls"]
+                    - stats["cache_hits"]
+                    - stats["validation_errors"]
+                    - stats["errors"]
+                    - stats["cancelled"],
+                )
+                for labels, stats in groups
+            ],
+        )
+        metric(
+            "llm_retries_total",
+            "counter",
+            "Retried requests",
+            [(labels, stats["retries"]) for labels, stats in groups],
+        )
+        metric(
+            "llm_tokens_total",
+            "counter",
+            "Tokens reported by the providers",
+            [
+                ({**labels, "kind": kind}, stats[f"{kind}_tokens"])
+                for labels, stats in groups
+                for kind in ["input", "cached", "output"]
+            ],
+        )
+        metric(
+            "llm_cost_usd_total",
+            "counter",
+            "Cost of the calls in USD (see telemetry.PRICES)",
+            [(labels, stats["cost"]) for labels, stats in groups],
+        )
+        metric(
+            "llm_call_latency_seconds",
+            "gauge",
+            "Latency quantiles of the calls answered by the providers",
+            [
+                ({**labels, "quantile": str(q)}, stats[f"latency_p{round(q * 100)}"])
+                for labels, stats in groups
+                for q in QUANTILES
+                if stats[f"latency_p{round(q * 100)}"] is not None
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path) -> None:
+        """
+        Write the metrics for the textfile collector of the Prometheus node exporter
+        """
+        path = Path(path)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(self.prometheus())
+        tmp.replace(path)  # the collector never reads a partial file
+
+
+def serve_prometheus(port: int = 9464) -> ThreadingHTTPServer:
+    """
+    Serve the metrics of the current telemetry at http://<host>:port/metrics
+    in a background thread (call server.shutdown() to stop it)
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = get_telemetry().prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_telemetry = Telemetry()
+_telemetry_lock = threading.Lock()
+
+
+def configure_telemetry(path=None) -> Telemetry:
+    """
+    Start recording the calls of a new run, appended to path if given
+    returns : the new telemetry
+    """
+    global _telemetry
+    with _telemetry_lock:
+        _telemetry = Telemetry(path)
+        return _telemetry
+
+
+def get_telemetry() -> Telemetry:
+    """
+    returns : the telemetry of the current run, the calls are kept in memory by default
+    """
+    return _telemetry
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python src/telemetry.py <metrics.jsonl> : summary of the calls of a run
+    print(json.dumps(Telemetry.from_file(sys.argv[1]).summary(), indent=4))
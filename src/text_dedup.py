@@ -0,0 +1,226 @@
+"""
+Removal of the exact and near-duplicate paragraphs of the patient texts
+
+Tasy notes are copied from visit to visit, so the text built by latest_tasy repeats the same
+treatment history several times. Each paragraph (line) is normalized (lowercase, punctuation
+and spaces collapsed) : exact duplicates are dropped from their hash, near duplicates from
+the MinHash signature of their word shingles, with LSH bands to only compare candidates.
+Of two near-duplicate paragraphs the longer one is kept, at the place of the first,
+so that an updated copy of a paragraph is not lost.
+
+The whole corpus is processed at once : lines are exploded and exactly deduplicated with
+pandas, signatures are computed with numpy once per distinct line, and only the patients
+with two lines in a same LSH bucket go through the paragraph by paragraph comparison.
+"""
+
+from typing import Tuple
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from token_count import count_tokens
+
+SHINGLE_WORDS = 3  # words per shingle
+NUM_PERM = 64  # size of the MinHash signatures
+BANDS = 16  # LSH bands of NUM_PERM // BANDS rows
+THRESHOLD = 0.8  # estimated Jaccard similarity above which paragraphs are duplicates
+BLOCK = 5000  # paragraphs per block of signature computation
+
+_PRIME = (1 << 31) - 1
+_MIX = 1_000_003
+_rng = np.random.default_rng(0)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)[:, None]
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)[:, None]
+_BAND_MIX = _rng.integers(1, 1 << 63, NUM_PERM // BANDS, dtype=np.uint64)
+
+
+def normalize(paragraphs: pd.Series) -> pd.Series:
+    return paragraphs.str.lower().str.replace(r"\W+", " ", regex=True).str.strip()
+
+
+def shingle_hashes(normalized: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    hashes of the shingles of SHINGLE_WORDS consecutive words of each non empty paragraph
+    (a single shingle of all its words for a shorter paragraph)
+    returns : (hashes, position of the paragraph of each hash), ordered by paragraph
+    """
+    words = normalized.reset_index(drop=True).str.split(" ").explode()
+    paragraph = words.index.to_numpy()
+    codes, uniques = pd.factorize(words.to_numpy())
+    word_hash = np.array(
+        [zlib.crc32(w.encode()) % _PRIME for w in uniques], dtype=np.uint64
+    )[codes]
+
+    n = len(word_hash)
+    starts = np.r_[0, np.flatnonzero(np.diff(paragraph)) + 1]
+    lengths = np.diff(np.r_[starts, n])
+    position = np.arange(n) - np.repeat(starts, lengths)
+    length = np.repeat(lengths, lengths)
+
+    hashes = word_hash.copy()
+    for j in range(1, SHINGLE_WORDS):
+        following = np.zeros(n, dtype=np.uint64)
+        following[:-j] = np.where(
+            paragraph[j:] == paragraph[:-j], word_hash[j:], np.uint64(0)
+        )
+        hashes = (hashes * np.uint64(_MIX) + following) % np.uint64(_PRIME)
+    keep = (position <= length - SHINGLE_WORDS) | (
+        (length < SHINGLE_WORDS) & (position == 0)
+    )
+    return hashes[keep], paragraph[keep]
+
+
+def signatures(normalized: pd.Series) -> np.ndarray:
+    """
+    MinHash signatures (one row per paragraph) of non empty normalized paragraphs
+    """
+    hashes, paragraph = shingle_hashes(normalized)
+    offsets = np.searchsorted(paragraph, np.arange(len(normalized) + 1))
+    result = np.empty((len(normalized), NUM_PERM), dtype=np.uint64)
+    for start in range(0, len(normalized), BLOCK):
+        end = min(start + BLOCK, len(normalized))
+        lo, hi = offsets[start], offsets[end]
+        values = (_A * hashes[None, lo:hi] + _B) % np.uint64(_PRIME)
+        result[start:end] = np.minimum.reduceat(
+            values, offsets[start:end] - lo, axis=1
+        ).T
+    return result
+
+
+def band_keys(sigs: np.ndarray) -> np.ndarray:
+    """
+    one LSH bucket key per band of each signature
+    """
+    rows = NUM_PERM // BANDS
+    return (sigs.reshape(len(sigs), BANDS, rows) * _BAND_MIX).sum(axis=2)
+
+
+def resolve_near_duplicates(
+    raws: list, sigs: np.ndarray, keys: np.ndarray, threshold: float
+) -> list:
+    """
+    paragraph by paragraph comparison of the lines of one patient
+    returns : the kept lines, a near duplicate replacing the kept one if it is longer
+    """
+    kept, kept_sigs, buckets = [], [], {}
+    for raw, sig, key in zip(raws, sigs, keys):
+        bands = list(enumerate(key.tolist()))
+        candidates = sorted({i for band in bands for i in buckets.get(band, ())})
+        match = next(
+            (i for i in candidates if (kept_sigs[i] == sig).mean() >= threshold),
+            None,
+        )
+        if match is not None:
+            if len(raw) > len(kept[match]):
+                kept[match] = raw
+            continue
+        for band in bands:
+            buckets.setdefault(band, []).append(len(kept))
+        kept.append(raw)
+        kept_sigs.append(sig)
+    return kept
+
+
+def dedup_series(texts: pd.Series, threshold: float = THRESHOLD) -> pd.Series:
+    """
+    texts without their empty, duplicate and near-duplicate lines (missing texts stay missing)
+    """
+    lines = texts.reset_index(drop=True).fillna("").str.split("\n").explode()
+    frame = pd.DataFrame(
+        {"patient": lines.index.to_numpy(), "raw": lines.to_numpy(dtype=object)}
+    )
+    frame["normalized"] = normalize(frame.raw)
+    frame = frame[frame.normalized != ""]
+    frame = frame.drop_duplicates(subset=["patient", "normalized"])
+
+    codes, uniques = pd.factorize(frame.normalized)
+    sigs = signatures(pd.Series(uniques, dtype=object))
+    keys = band_keys(sigs)[codes]
+    sigs = sigs[codes]
+
+    # lines sharing a bucket with another line of the same patient
+    patient = frame.patient.to_numpy()
+    collides = np.zeros(len(frame), dtype=bool)
+    for band in range(BANDS):
+        collides |= (
+            pd.DataFrame({"p": patient, "k": keys[:, band]})
+            .duplicated(keep=False)
+            .to_numpy()
+        )
+    to_resolve = np.isin(patient, np.unique(patient[collides]))
+
+    joined = frame[~to_resolve].groupby("patient").raw.agg("\n".join)
+    resolved = {}
+    positions = np.flatnonzero(to_resolve)
+    if len(positions):
+        raws = frame.raw.to_numpy()
+        bounds = np.r_[0, np.flatnonzero(np.diff(patient[positions])) + 1]
+        for lo, hi in zip(bounds, np.r_[bounds[1:], len(positions)]):
+            rows = positions[lo:hi]
+            kept = resolve_near_duplicates(
+                raws[rows].tolist(), sigs[rows], keys[rows], threshold
+            )
+            resolved[patient[rows[0]]] = "\n".join(kept)
+
+    result = pd.Series("", index=range(len(texts)), dtype=object)
+    result[joined.index] = joined.to_numpy()
+    if resolved:
+        result[list(resolved)] = list(resolved.values())
+    result[texts.reset_index(drop=True).isna()] = None
+    return pd.Series(result.to_numpy(), index=texts.index, name=texts.name)
+
+
+def dedup_paragraphs(text: str, threshold: float = THRESHOLD) -> str:
+    """
+    text without its empty, duplicate and near-duplicate lines
+    """
+    if not isinstance(text, str):
+        return text
+    return dedup_series(pd.Series([text]), threshold).iloc[0]
+
+
+def dedup_frame(
+    df: pd.DataFrame, text_col: str = "text", id_col: str = "rghc"
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    returns : (df with deduplicated texts, report of the tokens before and after per patient)
+    """
+    deduplicated = dedup_series(df[text_col])
+    report = pd.DataFrame(
+        {
+            id_col: df[id_col].to_numpy(),
+            "tokens_before": df[text_col].fillna("").map(count_tokens).to_numpy(),
+            "tokens_after": deduplicated.fillna("").map(count_tokens).to_numpy(),
+        }
+    )
+    report["reduction"] = 1 - report.tokens_after / report.tokens_before.where(
+        report.tokens_before > 0
+    )
+    df = df.assign(**{text_col: deduplicated})
+    return df, report
+
+
+if __name__ == "__main__":
+    # speed and token reduction on a synthetic corpus
+    # python src/text_dedup.py [n_patients]
+    from latest_tasy import latest_consultations
+    from config import tasy_tratamento_columns
+    from synthetic_data import make_tasy
+    import sys
+    import time
+
+    n_patients = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    df = latest_consultations([make_tasy(n_patients)])
+    df["text"] = df[tasy_tratamento_columns[0]].str.cat(
+        df[tasy_tratamento_columns[1:]], sep=" "
+    )
+    start = time.perf_counter()
+    deduplicated = dedup_series(df.text)
+    elapsed = time.perf_counter() - start
+    print(f"{n_patients} patients deduplicated in {elapsed:.2f}s")
+    df, report = dedup_frame(df)
+    print(
+        f"tokens {report.tokens_before.sum()} -> {report.tokens_after.sum()}, "
+        f"median reduction per patient {report.reduction.median():.1%}"
+    )
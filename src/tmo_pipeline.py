@@ -1,17 +1,42 @@
-from api_calls import Provider, MODELS, call_llm_structured
+from api_calls import Provider, MODELS, CONCURRENCY
+from corpus_store import CorpusStore, corpus_path
+from hedging import configure_hedging
+from llm_cache import configure_cache
+from pipeline_runner import run_pipeline
+from result_store import ResultStore
+from task_bundle import load_task
+from sharded_runner import current_shard, select_shard, shard_path
+from telemetry import METRICS_DIR, configure_telemetry
 from pathlib import Path
 
 test_mode = False
 erase_mode = False
+concurrent_mode = False  # run the API calls concurrently (see concurrent_extraction)
+packed_mode = False  # with concurrent_mode, several short texts per request (see packed_extraction)
+hedge_mode = False  # with concurrent_mode, duplicate the slowest calls (see hedging)
+# provider of the duplicates, e.g. Provider.OPENAI (None : same provider)
+hedge_fallback = None
+batch_mode = False  # submit the whole cohort as a provider batch job (see batch_calls)
+use_cache = True  # answer identical calls from the local cache (see llm_cache)
+incremental_mode = True  # only extract the patients whose inputs changed (see manifest)
+prefilter_mode = False  # answer locally the notes without any task term (see prefilter)
+retry_passes = 1  # passes over the failed patients at the end of a run (see resilience)
 n_test = 2
 tasy_src_path = Path(".") / "src/data/tasy_api.csv"
+instruction_path = Path(".") / "src/txt/tmo_instructions.txt"
 
 provider = Provider.OPENAI
 model = MODELS[provider]
-single_dir = Path(".") / f"src/results/tmo_{provider.value}_rghc/"
+concurrency = CONCURRENCY[provider]
+# shard of this process when run by sharded_runner, each shard owns its outputs
+shard, n_shards = current_shard()
+results_path = shard_path(
+    Path(".") / f"src/results/tmo_{provider.value}_results.sqlite", shard, n_shards
+)
+# per-rghc result files of the runs before the result store, imported once
+legacy_dir = Path(".") / f"src/results/tmo_{provider.value}_rghc/"
 global_dir = Path(".") / f"src/results/tmo_{provider.value}_full_result/"
 
-single_dir.mkdir(parents=True, exist_ok=True)
 global_dir.mkdir(parents=True, exist_ok=True)
 
 
@@ -20,16 +45,15 @@ if __name__ == "__main__":
     from datetime import datetime
 
     from dotenv import load_dotenv
-    import pandas as pd
-    from tqdm import tqdm
 
     import logging
-    import json
 
     load_dotenv()
+    configure_cache(enabled=use_cache)
+    configure_hedging(fallback=hedge_fallback)
 
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    log_path = Path(".") / f"src/logs/tmo_{timestamp}.log"
+    log_path = shard_path(Path(".") / f"src/logs/tmo_{timestamp}.log", shard, n_shards)
 
     logging.basicConfig(
         level=logging.INFO,
@@ -38,55 +62,54 @@ if __name__ == "__main__":
         filemode="a",
     )
 
+    # tokens, cost and latency of every call (see telemetry)
+    metrics_path = shard_path(
+        METRICS_DIR / f"tmo_{provider.value}_{timestamp}.jsonl", shard, n_shards
+    )
+    telemetry = configure_telemetry(metrics_path)
+
     load_dotenv()
-    text_df = pd.read_csv(tasy_src_path)
+    # texts are read lazily from the corpus store built by latest_tasy
+    corpus = CorpusStore(corpus_path(tasy_src_path))
+
+    rghc_list = corpus.rghcs(limit=n_test if test_mode else None)
+    rghc_list = select_shard(rghc_list, shard, n_shards)
+    logging.info(f"Extracting treatments for {len(rghc_list)} rghc")
 
-    if test_mode:
-        api_df = text_df.iloc[:n_test][["rghc", "text"]]
-        logging.info(f"Extracting treatments for {api_df.rghc.nunique()} rghc")
+    # instruction and schema are compiled once for the whole run (see task_bundle)
+    task = load_task(instruction_path, Relapse)
+
+    # results are committed one by one, a run resumes where the previous one stopped
+    results = ResultStore(results_path)
+    if erase_mode:
+        results.clear()
     else:
-        api_df = text_df[["rghc", "text"]]
-        logging.info(f"Extracting treatments for {api_df.rghc.nunique()} rghc")
-
-    full_data = {}
-
-    for index, row in tqdm(api_df.iterrows()):
-        rghc = row["rghc"]
-        logging.info(f"Processing rghc : {rghc}")
-        single_output_path = single_dir / f"{rghc}.json"
-        # check if the patient was already processed
-        if not erase_mode and single_output_path.exists():
-            logging.info(f"Patient {rghc} already processed")
-            continue
-
-        else:
-            result = call_llm_structured(
-                provider=provider,
-                model=model,
-                instruction=open(Path(".") / "src/txt/tmo_instructions.txt").read(),
-                unstructured_text=row["text"],
-                schema_model=Relapse,
-            )
-
-            try:
-                data = result.model_dump()
-            except Exception as e:
-                print(f"Failed to save response for {provider.value}: {e}")
-
-            try:
-                full_data[rghc] = data
-                # save results one by one for safety
-                with open(single_output_path, "w") as f:
-                    json.dump(data, f, indent=4)
-                logging.info(f"Response for {rghc} saved to {single_output_path}")
-            except Exception as e:
-                logging.error(e)
+        results.import_files(legacy_dir, Relapse, rghcs=rghc_list)
+
+    run_pipeline(
+        corpus,
+        rghc_list,
+        task,
+        provider,
+        model,
+        results,
+        concurrent_mode=concurrent_mode,
+        packed_mode=packed_mode,
+        hedge_mode=hedge_mode,
+        batch_mode=batch_mode,
+        incremental_mode=incremental_mode,
+        prefilter_mode=prefilter_mode,
+        retry_passes=retry_passes,
+        concurrency=concurrency,
+        telemetry=telemetry,
+    )
 
     # final save
     try:
-        global_output_path = global_dir / f"tmo_rghc_{timestamp}.csv"
-        with open(global_output_path, "w") as f:
-            json.dump(full_data, f, indent=4)
+        global_output_path = shard_path(
+            global_dir / f"tmo_rghc_{timestamp}.csv", shard, n_shards
+        )
+        results.export_json(global_output_path, rghcs=rghc_list)
         logging.info(f"Full extraction saved to {global_output_path}")
     except Exception as e:
         logging.error(e)
@@ -0,0 +1,34 @@
+"""
+Token counts of the texts sent to the providers
+
+Uses the tiktoken encoding of the OpenAI models when the optional tiktoken package is installed,
+otherwise an approximation (word pieces of up to 4 characters and punctuation marks)
+which is close enough for the Portuguese clinical notes to size windows and report savings.
+"""
+
+from functools import lru_cache
+import re
+
+ENCODING = "o200k_base"  # encoding of gpt-4.1 / gpt-4o
+_WORD_PIECE = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    """
+    returns : the tiktoken encoding, None when tiktoken is not installed
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding(ENCODING)
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(_WORD_PIECE.findall(text))
@@ -1,37 +1,44 @@
+import numpy as np
 import pandas as pd
-from config import drugs_ref
 from typing import List
-import re
+
+
+def decode_choice_columns(columns, src_drug_col: str) -> tuple:
+    """
+    REDCAP checkbox columns are named "<question> (choice=<drug>)"
+    returns : (checkbox columns of the question, drug name of each column)
+    """
+    drug_cols = [c for c in columns if c.startswith(src_drug_col)]
+    drug_names = [col.split("(choice=")[1].rstrip(")") for col in drug_cols]
+    return drug_cols, drug_names
+
+
+def join_checked(mask: np.ndarray, names: List[str]) -> np.ndarray:
+    """
+    comma-separated names of the checked columns of each row of the boolean matrix mask
+    the distinct rows (checkbox patterns) are few, so each pattern is joined only once
+    """
+    if mask.shape[1] == 0:
+        return np.full(mask.shape[0], "", dtype=object)
+    packed = np.ascontiguousarray(np.packbits(mask, axis=1))
+    keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    patterns, inverse = np.unique(keys, return_inverse=True)
+    names = np.array(names, dtype=object)
+    pattern_mask = np.unpackbits(
+        patterns.view(np.uint8).reshape(len(patterns), -1), axis=1
+    )[:, : mask.shape[1]].astype(bool)
+    joined = np.array([", ".join(names[row]) for row in pattern_mask], dtype=object)
+    return joined[inverse.ravel()]
 
 
 def retrieve_drugs(
     df: pd.DataFrame, src_drug_col: str, target_drug_col: str
 ) -> pd.DataFrame:
-    drug_cols = [c for c in df.columns if c.startswith(src_drug_col)]
+    drug_cols, drug_names = decode_choice_columns(df.columns, src_drug_col)
     df[drug_cols] = (
         df[drug_cols].fillna(False).astype(bool)
     )  # reversing fillna and astype generates error
 
-    df[target_drug_col] = df[drug_cols].apply(
-        lambda row: [
-            col.split("(choice=")[1].rstrip(")") for col in drug_cols if row[col]
-        ],
-        axis=1,
-    )
     ##comma-separated string instead of a list:
-    df[target_drug_col] = df[target_drug_col].apply(lambda x: ", ".join(x))
+    df[target_drug_col] = join_checked(df[drug_cols].to_numpy(dtype=bool), drug_names)
     return df
-
-
-def post_process_drugs(api_text: str, drug_list: List[str] = drugs_ref) -> str:
-    if pd.isna(api_text):
-        return None
-    drugs = [d.strip() for d in re.split(r"[(),]", api_text) if d.strip()]
-    filtered = [d for d in drugs if d in drug_list]
-    return ", ".join(filtered) if filtered else None
-
-
-def sort_drugs(s: str) -> str:
-    if not isinstance(s, str):
-        return None
-    return ", ".join(sorted((d.strip() for d in s.split(",")), key=str.lower))